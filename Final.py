@@ -1,17 +1,32 @@
 import os
 import argparse
-import json
-import re
 import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
 import mysql.connector
-import speech_recognition as sr
-from gtts import gTTS
-from playsound import playsound
 from typing import List, Dict, Any, Tuple, Optional
 from dotenv import load_dotenv
 from rapidfuzz import process as fuzz_process
-from word2number import w2n
-from flask import request
+import matching
+import db
+import tracing
+# Shared with the web API; re-exported here for existing callers of Final.
+from ordering import (  # noqa: F401
+    get_db_connection,
+    extract_quantity,
+    process_order,
+    ensure_mysql_connection_alive,
+    get_user_name,
+    confirm_order,
+    fetch_store_menu,
+    fetch_product_details,
+    fetch_product_attributes,
+    fetch_menu_questions,
+    _parse_multi_sizes,
+    _parse_multi_options,
+    transform_variation,
+    add_to_cart,
+    _parse_free_form_order,
+)
 
 
 word_to_digit = {
@@ -24,40 +39,52 @@ word_to_digit = {
 
 # ─────────────────────────── CONFIG ───────────────────────────
 load_dotenv()
-recognizer = sr.Recognizer()
+# speech_recognition, gtts and playsound are imported by the voice functions on first
+# use, so importing this module (or ordering.py) never loads audio libraries.
+recognizer = None
 
-# ─────────────────── GLOBAL DATABASE CONNECTION ───────────────────
-_db_connection = None
 
-def get_db_connection():
-    global _db_connection
-    if _db_connection is None or not _db_connection.is_connected():
-        try:
-            _db_connection = mysql.connector.connect(
-                host=os.getenv("DB_HOST"),
-                user=os.getenv("DB_USER"),
-                password=os.getenv("DB_PASSWORD"),
-                database=os.getenv("DB_NAME"),
-                autocommit=True,
-                charset="utf8mb4",
-                use_pure=True
-            ) 
-        except mysql.connector.Error as e:
-            print(f"Database connection failed: {e}")
-            return None
-    return _db_connection
+def _get_recognizer():
+    global recognizer
+    if recognizer is None:
+        import speech_recognition as sr
+        recognizer = sr.Recognizer()
+    return recognizer
 
 
 # ───────────────────────── TTS / STT ──────────────────────────
+def _play_gtts(text: str) -> None:
+    from gtts import gTTS
+    from playsound import playsound
+    tts = gTTS(text=text, lang="en", tld="co.in")
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as fp:
+        path = fp.name.replace("\\", "/")
+    tts.save(path)
+    playsound(path)
+    os.remove(path)
+
+
+def _microphone():
+    import speech_recognition as sr
+    return sr.Microphone()
+
+
+def _recognize_google(recognizer, audio) -> str:
+    return recognizer.recognize_google(audio)
+
+
+# Where speech goes, where it comes from and what transcribes it. bench/voice_pipeline.py
+# swaps these for a null sink, recorded WAV files and a local recognizer.
+tts_sink = _play_gtts
+audio_source = _microphone
+recognize = _recognize_google
+
+
 def speak(text: str) -> None:
     print(f"\nAssistant: {text}")
     try:
-        tts = gTTS(text=text, lang="en", tld="co.in")
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as fp:
-            path = fp.name.replace("\\", "/")
-        tts.save(path)
-        playsound(path)
-        os.remove(path)
+        with tracing.stage("synthesis"):
+            tts_sink(text)
     except Exception as e:
         print(f"[ERROR] TTS failed: {e}")
 
@@ -91,37 +118,19 @@ def ask_boolean_question(question_text: str, max_retries: int = 2) -> Optional[b
         return False
     return None
 
-#-----------------------------------------------
-def extract_quantity(text: str) -> int:
-    
-    # Try direct digits
-    digit_match = re.search(r"\b\d+\b", text)
-    if digit_match:
-        return int(digit_match.group())
-
-    # Try word-to-number conversion
-    try:
-        return w2n.word_to_num(text)
-    except:
-        return 1  # Default quantity if not found
-
-
-# ------------------------------------------------
-def process_order(user_input: str, item: Dict[str, Any]) -> Dict[str, Any]:
-    
-    if 'quantity' not in item or item['quantity'] is None:
-        quantity = extract_quantity(user_input)
-        if quantity is not None:
-            item['quantity'] = quantity
-    return item
 #------------------------------------------------
 def listen() -> str:
-    with sr.Microphone() as source:
+    import speech_recognition as sr
+    recognizer = _get_recognizer()
+    with audio_source() as source:
         print("Listening...")
-        recognizer.adjust_for_ambient_noise(source)
+        with tracing.stage("calibration"):
+            recognizer.adjust_for_ambient_noise(source)
         try:
-            audio = recognizer.listen(source, timeout=2)
-            query = recognizer.recognize_google(audio)
+            with tracing.stage("capture"):
+                audio = recognizer.listen(source, timeout=2)
+            with tracing.stage("recognition"):
+                query = recognize(recognizer, audio)
             print(f"You: {query}")
             return query
         except (sr.WaitTimeoutError, sr.UnknownValueError, sr.RequestError):
@@ -133,168 +142,14 @@ def listen() -> str:
 #     return request.json.get("user_input", "")
 
 
-#------------------------------------
-def ensure_mysql_connection_alive(obj):
-    try:
-        conn = getattr(obj, "connection", None) or getattr(obj, "_connection", None) or obj
-        conn.ping(reconnect=True, attempts=3, delay=2)
-    except mysql.connector.Error as e:
-        print(f"[MySQL Warning] Lost connection. Attempting to reconnect... ({e})")
-        raise
-
-#-------------------------------------
-
-
-def get_user_name(cur, id: int) -> str:
-    cur.execute("SELECT name FROM tbl_user WHERE id = %s AND ustatus = 1;", (id,))
-    row = cur.fetchone()
-    return row["name"] if row and row["name"] else "Customer"
-
-#-----------------------------------
-def confirm_order(item_name: str, qty: int, variations: Optional[Dict[str, Any]] = None):
-    item_display = f"{item_name}{'s' if int(qty) > 1 and not item_name.endswith('s') else ''}"
-    if variations:
-        summary_text = _get_variation_summary(variations)
-        print(f"Got it. You want {qty} {item_display} with {summary_text}")
-    else:
-        print(f"Got it. You want {qty} {item_display}.") 
-
-# ----------------------------
-def _get_variation_summary(variations: Dict[str, Any]) -> str:
-    summary = []
-    if "selected_options" in variations:
-        option_summary = [f"{opt['quantity']} {opt['name']}" for opt in variations["selected_options"]]
-        summary.append(f"sizes: {', '.join(option_summary)}")
-    if "selected_addons" in variations:
-        addon_summary = [f"{addon['addon_name']}" for addon in variations["selected_addons"]]
-        summary.append(f"{', '.join(addon_summary)}")
-    return ", ".join(summary)
-
-
-# ───────────────────────── MENU FETCH ─────────────────────────
-def fetch_store_menu(conn, store_id):
-    try:
-        with conn.cursor(dictionary=True, buffered=True) as cursor:
-            query = """
-                SELECT
-                    s.title AS store_name,
-                    p.id AS item_id,
-                    p.title AS item_name,
-                    p.description,
-                    p.status,
-                    p.store_id,
-                    p.cat_id AS subcategory_id,
-                    sub.sub_name AS subcategory_name,
-                    main.id AS category_id,
-                    main.title AS category_name,
-                    pa.title AS attribute_title
-                FROM tbl_product AS p
-                LEFT JOIN tbl_mcat_sub AS sub ON sub.sub_id = p.cat_id
-                LEFT JOIN tbl_mcat AS main ON main.id = sub.mcat_id
-                LEFT JOIN service_details AS s ON s.id = p.store_id
-                LEFT JOIN tbl_product_attribute AS pa ON pa.product_id = p.id
-                WHERE p.store_id = %s AND p.status = 1
-            """
-            cursor.execute(query, (store_id,))
-            result = cursor.fetchall()
-            return result
-    except mysql.connector.Error as err:
-        print(f"Database error in fetch_store_menu: {err}")
-        return []
-
-def fetch_product_details(conn, item_id: int):
-    """Fetches options and add-ons for a specific product."""
-    details = {"options": [], "addons": [], "normal_price": None}
-    try:  
-        with conn.cursor(dictionary=True, buffered=True) as cursor:
-            # Fetch Options    
-            cursor.execute("""
-                SELECT option_name, option_values, is_required, max_selections
-                FROM tbl_product_options
-                WHERE product_id = %s AND status = 1;
-            """, (item_id,)) 
-            options_data = cursor.fetchall()
-            for opt in options_data:
-                opt['option_values'] = json.loads(opt['option_values'])
-            details["options"] = options_data
-
-            # Fetch Add-ons
-            cursor.execute("""
-                SELECT addon_name, addon_price, addon_category, is_required
-                FROM tbl_product_addons
-                WHERE product_id = %s AND status = 1;
-            """, (item_id,))
-            details["addons"] = cursor.fetchall()
-            
-            # Fetch normal price
-            cursor.execute("""
-                SELECT normal_price FROM tbl_product_attribute WHERE product_id = %s;
-            """, (item_id,))
-            price_data = cursor.fetchone()
-            if price_data and 'normal_price' in price_data and price_data['normal_price'] is not None:
-                details['normal_price'] = float(price_data['normal_price'])
-
-    except mysql.connector.Error as err:
-        print(f"Database error in fetch_product_details: {err}")
-    except json.JSONDecodeError as err:
-        print(f"JSON decode error for product options: {err}")
-    return details
-
-def fetch_product_attributes(conn, item_id: int) -> List[str]:
-    """Fetches attributes for a specific product."""
-    try:
-        with conn.cursor(dictionary=True) as cursor:
-            cursor.execute("""
-                SELECT title FROM tbl_product_attribute WHERE product_id = %s;
-            """, (item_id,))
-            return [row['title'] for row in cursor.fetchall()]
-    except mysql.connector.Error as err:
-        print(f"Database error in fetch_product_attributes: {err}")
-        return []
-
-
-# ───────────────────────── QUESTIONS ──────────────────────────
-def fetch_menu_questions(cur, item_id: int) -> List[Dict[str, Any]]:
-    
-    """Fetches dynamic questions for a specific product from the menu_questions table."""
-    try:
-        cur.execute("""
-            SELECT question_text, question_type, required, sort_order
-            FROM menu_questions
-            WHERE item_id = %s
-            ORDER BY sort_order;
-        """, (item_id,))
-        return cur.fetchall()
-    except mysql.connector.Error as err:
-        print(f"Database error in fetch_menu_questions: {err}")
-        return []
-#-------------------------------------
-def _parse_multi_sizes(sentence: str, allowed: List[str]) -> List[Dict[str, Any]]:
-    sizes_found = {}
-    size_pat = "|".join(map(re.escape, allowed)) if allowed else r"[a-z0-9]+"
-    rex = re.compile(rf"(?:\b(\w+)\s*)?(?:x\s*)?\b({size_pat})\b", re.I)
-
-    for qty_word, size in rex.findall(sentence):
-        qty = w2n.word_to_num(qty_word) if qty_word and not qty_word.isdigit() else int(qty_word or 1)
-        sizes_found[size.lower()] = sizes_found.get(size.lower(), 0) + qty
-    
-    return [{"name": s.capitalize(), "quantity": q} for s, q in sizes_found.items()]
-
-#------------------------------------------
-def _parse_multi_options(sentence: str, allowed: List[str]) -> List[Dict[str, Any]]:
-    canon = {o.lower(): o for o in allowed}
-    rex = r"(?:(\d+)\s*)?(?:x\s*)?(" + "|".join(re.escape(o.lower()) for o in allowed) + r")"
-    found = re.findall(rex, sentence.lower())
-    result = []
-    for qty_s, opt_lc in found:
-        qty = int(qty_s) if qty_s else 1
-        result.append({"name": canon[opt_lc], "quantity": qty})
-    return result
-
 #---------------------------------
-def ask_dynamic_questions(conn, item: Dict[str, Any], prefilled: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-    details = fetch_product_details(conn, item["item_id"])
-    questions = fetch_menu_questions(conn.cursor(dictionary=True), item["item_id"])
+def ask_dynamic_questions(conn, item: Dict[str, Any], prefilled: Optional[Dict[str, Any]] = None,
+                          plan: Optional[Tuple[Dict[str, Any], List[Dict[str, Any]]]] = None) -> Dict[str, Any]:
+    if plan:
+        details, questions = plan
+    else:
+        details = fetch_product_details(conn, item["item_id"], item.get("store_id"))
+        questions = fetch_menu_questions(conn.cursor(dictionary=True), item["item_id"])
     answers = {"selected_options": [], "selected_addons": []}
     prefilled = prefilled or {}
 
@@ -349,95 +204,6 @@ def ask_dynamic_questions(conn, item: Dict[str, Any], prefilled: Optional[Dict[s
     
     return answers  
 
-# ──────────────── VARIATION CONVERTER ────────────────
-def transform_variation(variation: Dict[str, Any]) -> str:
-    if not variation:
-        return None
-
-    structured = []
-    
-    # Options (e.g., Sizes)
-    if "selected_options" in variation:
-        for opt in variation["selected_options"]:
-            
-            price = opt.get("price", 0) # Assuming the price is part of the option dict now
-            structured.append({
-                "name": opt["name"],
-                "values": {"label": f"Quantity: {opt['quantity']}", "price": price}
-            })
-    
-    # Add-ons
-    if "selected_addons" in variation:
-        for addon in variation["selected_addons"]:
-            structured.append({
-                "name": addon["addon_name"],
-                "values": {"label": "Add-on", "price": str(addon["addon_price"])}
-            })
-
-    return json.dumps(structured)
-
-
-# ───────────────────────── CART & ORDER ───────────────────────
-
-def add_to_cart(user_id: int,
-              store_id: int,
-              item: Dict[str, Any],
-              total_qty: int,
-              price: float,
-              variation: Optional[Dict[str, Any]],
-              visible: int) -> None:
-    conn = get_db_connection()
-    if not conn:
-        print("Cart insert failed: No database connection.")
-        return
-
-    cur = conn.cursor()
-
-    variation_str = transform_variation(variation) if variation else None
-    product_id = item.get("item_id")
-    product_title = item.get("item_name", "Unnamed Product")
-    product_img = item.get("image", "")
-    cart_type = "normal"
-    subscription_data = None
-    
-
-    fetch_attribute_id_query = """
-        SELECT id FROM tbl_product_attribute
-        WHERE product_id = %s AND store_id = %s
-        LIMIT 1 
-    """
-    cur.execute(fetch_attribute_id_query, (product_id, store_id))
-    result = cur.fetchone()
-
-    attribute_id = result[0] if result else 0
-
-    cur.execute("""
-        INSERT INTO tbl_cart_data (
-            uid, store_id, product_id, attribute_id, quantity, price,
-            product_title, product_img, cart_type, variation, visible, subscription_data
-        )
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-    """, (
-        user_id,
-        store_id,
-        product_id,
-        attribute_id,
-        total_qty,
-        price,
-        product_title,
-        product_img,
-        cart_type,
-        variation_str,
-        visible,
-        subscription_data
-    ))
-
-    conn.commit()
-    cur.close()
-
-    # The confirmation message needs to be adjusted slightly to be accurate
-    confirm_order(item_name=product_title, qty=total_qty, variations=variation)
-
 def confirm_order_summary(orders: List[Tuple[Dict[str, Any], int, Dict[str, Any]]]) -> Tuple[str, float, List[Tuple[Dict[str, Any], int, Dict[str, Any], float]]]:
     total_price_final = 0.0
     speak("Here is your order summary:")
@@ -450,7 +216,7 @@ def confirm_order_summary(orders: List[Tuple[Dict[str, Any], int, Dict[str, Any]
     finalized_orders_with_prices = []
 
     for item, total_item_quantity, cust_variations in orders:
-        item_details = fetch_product_details(conn, item["item_id"])
+        item_details = fetch_product_details(conn, item["item_id"], item.get("store_id"))
         
         options_summary = []
         item_base_price_with_options = 0.0
@@ -473,16 +239,7 @@ def confirm_order_summary(orders: List[Tuple[Dict[str, Any], int, Dict[str, Any]
             base_price = item_details.get("normal_price", 0.0)       ######
             item_total_before_discount = (base_price * total_item_quantity) + (addon_price_per_item * total_item_quantity)
 
-        discount_rate = 0.0
-        try:
-            # Re-establish a new cursor here to avoid the disconnected cursor error
-            with conn.cursor(dictionary=True) as cur:
-                cur.execute("SELECT discount FROM tbl_product_attribute WHERE product_id = %s", (item["item_id"],))
-                result = cur.fetchone()
-                if result:
-                    discount_rate = float(result.get("discount", 0.0))
-        except mysql.connector.Error as e:
-            print(f"[DB Error] Could not fetch discount: {e}")
+        discount_rate = item_details.get("discount", 0.0)
 
         item_discount_amount = item_total_before_discount * (discount_rate / 100)
         item_total_after_discount = item_total_before_discount - item_discount_amount
@@ -546,6 +303,7 @@ def handle_store_assistant(user_id: int, store_id: int) -> None:
 
     store_name = menu[0].get("store_name", "our store")
     user_name = get_user_name(cur, user_id)
+    index = matching.MenuIndex(store_id, menu)
 
     speak(f"Hello {user_name}! You're chatting with {store_name}'s assistant. What would you like to eat today?")
 
@@ -569,20 +327,31 @@ def handle_store_assistant(user_id: int, store_id: int) -> None:
         _display_full_menu(menu)
         user_input = listen()
 
-    parsed_orders = _parse_free_form_order(user_input, options_map)
+    parsed_orders = _parse_free_form_order(user_input, options_map, store_id=store_id, version=index.version, index=index)
     final_orders: List[Tuple[Dict[str, Any], int, Dict[str, Any]]] = []
 
+    names = [m["item_name"] for m in menu]
     for order in parsed_orders:
-        names = [m["item_name"] for m in menu]
-        results = fuzz_process.extract(order["item_name"], names, limit=20)
-        best_score = results[0][1] if results else 0
-        matches = [menu[idx] for _, score, idx in results if score >= best_score - 20]
+        candidates = order.pop("candidates", None)
+        sounds_like = [] if candidates else index.phonetic_exact(order["item_name"])
+        if candidates:
+            # Ranked by the part's own scores from the parse pass; no second search.
+            best_score = candidates[0][1]
+            matches = [index.items_by_name[name] for name, score, _ in candidates if score >= best_score - 20]
+        elif sounds_like:
+            matches = [index.items_by_name[index.names[idx]] for idx in sounds_like]
+        else:
+            results = matching.extract(store_id, index.version, "menu", order["item_name"], names, limit=20)
+            best_score = results[0][1] if results else 0
+            matches = [menu[idx] for _, score, idx in results if score >= best_score - 20]
 
         if not matches:
             speak(f"Sorry, I couldn’t find anything similar to '{order['item_name']}'.")
             continue
 
+        plans = _prefetch_item_plans(matches) if len(matches) > 1 else {}
         item = _resolve_ambiguity(matches, order["item_name"])
+        plan = _take_item_plan(plans, item)
 
         prefilled = {
             "quantity": order.get("quantity"),
@@ -598,7 +367,7 @@ def handle_store_assistant(user_id: int, store_id: int) -> None:
         if not conn:
             speak("I am unable to process your order due to a connection error.")
             return
-        custom = ask_dynamic_questions(conn, item, prefilled)
+        custom = ask_dynamic_questions(conn, item, prefilled, plan)
 
         qty_final = custom.get("quantity", 1)
         if custom.get("selected_options"):
@@ -628,6 +397,7 @@ def handle_store_assistant(user_id: int, store_id: int) -> None:
                     price=final_price,
                     variation=cust,
                     visible=visibility,
+                    conn=conn,
                 )
             except mysql.connector.Error as e:
                 print(f"[Cart Insert Error] Failed to add item: {e}")
@@ -659,47 +429,6 @@ def _display_full_menu(menu: List[Dict[str, Any]]):
     for i, item_name in enumerate(sorted_items, 1):
         print(f" {i}. {item_name}")
 
-# -------------------
-def _parse_free_form_order(
-    text: str,
-    options_map: Dict[str, Dict[str, Any]]
-) -> List[Dict[str, Any]]:
-    
-    orders = []
-    parts = re.split(r"\s+(?:and|&|with|,)\s+", text.lower())
-
-    for part in parts:
-        order_data = {
-            "item_name": part.strip(),
-            "quantity": extract_quantity(part),
-        }
-        
-        best_match, score, _ = fuzz_process.extractOne(part, options_map.keys())
-        if score < 70:
-            continue
-            
-        item_name_key = best_match
-        order_data["item_name"] = item_name_key
-
-        item_details = options_map.get(item_name_key, {})
-        
-        for opt_def in item_details.get("options", []):
-            opt_name = opt_def["name"].lower()
-            opt_values = [v.lower() for v in opt_def["values"]]
-            
-            for value in opt_values:
-                if value in part:
-                    order_data[opt_name] = value
-                    break
-        
-        for addon_name in item_details.get("addons", []):
-            if addon_name.lower() in part:
-                order_data[addon_name.lower()] = True
-
-        orders.append(order_data)
-
-    return orders
-
 # ----------------------
 def _resolve_ambiguity(matches: List[Dict[str, Any]], original_text: Optional[str] = None) -> Dict[str, Any]:
     if len(matches) == 1:
@@ -707,18 +436,8 @@ def _resolve_ambiguity(matches: List[Dict[str, Any]], original_text: Optional[st
 
     speak("I found these options:")
     for idx, m in enumerate(matches, start=1):
-        attribute_title = 'N/A'
-        db_title = m.get('attribute_title')
-
-        if db_title:
-            try:
-                titles = json.loads(db_title)
-                if titles and isinstance(titles, list):
-                    attribute_title = '(["{}"])'.format('", "'.join(titles))
-                else:
-                    attribute_title = f"({db_title})"
-            except (json.JSONDecodeError, TypeError):
-                attribute_title = f"({db_title})"
+        titles = m.get('attribute_titles')
+        attribute_title = '(["{}"])'.format('", "'.join(titles)) if titles else 'N/A'
         
         label = f"{idx}. {m['item_name']} - {attribute_title}"
         print(label)
@@ -733,6 +452,40 @@ def _resolve_ambiguity(matches: List[Dict[str, Any]], original_text: Optional[st
                 return matches[idx - 1]
         speak("Invalid number, please try again.")
 
+# -----------------
+_plan_executor: Optional[ThreadPoolExecutor] = None
+
+def _load_item_plan(item_id: int, store_id: Optional[int]) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    conn = db.get_connection()
+    try:
+        details = fetch_product_details(conn, item_id, store_id)
+        with conn.cursor(dictionary=True) as cur:
+            questions = fetch_menu_questions(cur, item_id)
+        return details, questions
+    finally:
+        conn.close()
+
+def _prefetch_item_plans(matches: List[Dict[str, Any]]) -> Dict[int, Future]:
+    """Starts fetching details and questions of every candidate on pooled connections while the user chooses."""
+    global _plan_executor
+    if _plan_executor is None:
+        _plan_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="prefetch")
+    plans = {}
+    for m in matches:
+        if m["item_id"] not in plans:
+            plans[m["item_id"]] = _plan_executor.submit(_load_item_plan, m["item_id"], m.get("store_id"))
+    return plans
+
+def _take_item_plan(plans: Dict[int, Future], item: Dict[str, Any]) -> Optional[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+    future = plans.get(item["item_id"])
+    if future is None:
+        return None
+    try:
+        return future.result(timeout=5)
+    except Exception as e:
+        print(f"[Prefetch Warning] Falling back to a direct lookup: {e}")
+        return None
+
 # -----------------
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
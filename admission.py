@@ -0,0 +1,188 @@
+"""
+Admission control for the chat API, per worker process.
+
+A request holds a slot of its store's limiter and of the global limiter for its
+whole lifetime; expensive operations (menu loads, order confirmations) take an
+extra slot of their own budget when they start. When a limiter is full the
+request waits in a bounded queue for up to ADMISSION_QUEUE_TIMEOUT seconds and
+is then turned away with ``Rejected``: 429 when its own store is over its share,
+503 when the worker as a whole is saturated. Slots are released when the
+request ends (see release_all).
+"""
+import os
+import time
+import threading
+from typing import Any, Callable, Dict, List, Optional
+from flask import g
+
+# ─────────────────────────── CONFIG ───────────────────────────
+# In-flight request limits per worker process; 0 disables a limit.
+ADMISSION_GLOBAL_LIMIT = int(os.getenv("ADMISSION_GLOBAL_LIMIT", "0"))
+ADMISSION_STORE_LIMIT = int(os.getenv("ADMISSION_STORE_LIMIT", "0"))
+# Requests allowed to wait for a slot, per limiter, and for how long.
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "16"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "0.5"))
+# Concurrent expensive operations per worker process; 0 disables a budget.
+ADMISSION_BUDGETS = {
+    "menu_load": int(os.getenv("ADMISSION_MENU_LOAD_LIMIT", "0")),
+    "confirmation": int(os.getenv("ADMISSION_CONFIRM_LIMIT", "0")),
+}
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+# Store limiters kept per worker; past this, idle ones are dropped when a new store arrives.
+ADMISSION_STORE_LIMITERS = int(os.getenv("ADMISSION_STORE_LIMITERS", "1024"))
+
+
+class Rejected(Exception):
+    """A request turned away by a limiter; app.py turns it into a 429/503 with Retry-After."""
+
+    def __init__(self, limiter: str, reason: str, status: int, retry_after: int = ADMISSION_RETRY_AFTER):
+        super().__init__(f"{limiter}: {reason}")
+        self.limiter = limiter
+        self.reason = reason
+        self.status = status
+        self.retry_after = retry_after
+
+
+class Limiter:
+    """At most ``limit`` holders, at most ``queue_size`` waiters, waiting at most ``timeout`` seconds."""
+
+    def __init__(self, name: str, limit: int, queue_size: int = ADMISSION_QUEUE_SIZE,
+                 timeout: float = ADMISSION_QUEUE_TIMEOUT, status: int = 503):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.status = status
+        self.in_flight = 0
+        self.waiting = 0
+        self.peak_waiting = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self._cond = threading.Condition()
+
+    def acquire(self) -> None:
+        with self._cond:
+            if self.in_flight < self.limit:
+                self.in_flight += 1
+                self.admitted += 1
+                return
+            if self.waiting >= self.queue_size:
+                self.rejected_queue_full += 1
+                raise Rejected(self.name, "queue full", self.status)
+
+            self.waiting += 1
+            self.peak_waiting = max(self.peak_waiting, self.waiting)
+            deadline = time.monotonic() + self.timeout
+            try:
+                while self.in_flight >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected_timeout += 1
+                        raise Rejected(self.name, "timed out in queue", self.status)
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+            self.admitted += 1
+
+    def release(self) -> None:
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def idle(self) -> bool:
+        with self._cond:
+            return self.in_flight == 0 and self.waiting == 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "limit": self.limit,
+                "in_flight": self.in_flight,
+                "queue_depth": self.waiting,
+                "peak_queue_depth": self.peak_waiting,
+                "admitted": self.admitted,
+                "rejected_queue_full": self.rejected_queue_full,
+                "rejected_timeout": self.rejected_timeout,
+            }
+
+
+_global = Limiter("global", ADMISSION_GLOBAL_LIMIT) if ADMISSION_GLOBAL_LIMIT > 0 else None
+_budgets = {name: Limiter(name, limit) for name, limit in ADMISSION_BUDGETS.items() if limit > 0}
+# store_id -> Limiter, created on a store's first request. Store ids come from the client, so
+# idle limiters are dropped once there are ADMISSION_STORE_LIMITERS; one with holders or
+# waiters never is, or its store would get a second, empty limiter.
+_stores: Dict[Any, Limiter] = {}
+_stores_lock = threading.Lock()
+
+
+def _store_limiter(store_id: Any) -> Optional[Limiter]:
+    if ADMISSION_STORE_LIMIT <= 0:
+        return None
+    limiter = _stores.get(store_id)
+    if limiter is None:
+        with _stores_lock:
+            limiter = _stores.get(store_id)
+            if limiter is None:
+                if len(_stores) >= ADMISSION_STORE_LIMITERS:
+                    for idle in [key for key, other in _stores.items() if other.idle()]:
+                        del _stores[idle]
+                limiter = _stores[store_id] = Limiter(f"store:{store_id}", ADMISSION_STORE_LIMIT, status=429)
+    return limiter
+
+
+def _hold(limiter: Optional[Limiter]) -> None:
+    if limiter is None:
+        return
+    limiter.acquire()
+    held: List[Limiter] = g.setdefault("admission_held", [])
+    held.append(limiter)
+
+
+def admit(store_id: Any) -> None:
+    """
+    Admits the current request for ``store_id`` or raises ``Rejected``. The store
+    limiter is taken first, so a store over its share queues on its own limiter
+    without holding a global slot.
+    """
+    while True:
+        limiter = _store_limiter(store_id)
+        _hold(limiter)
+        # Dropped as idle between the lookup and the acquire: hold the store's current one instead.
+        if limiter is None or _stores.get(store_id) is limiter:
+            break
+        g.admission_held.pop()
+        limiter.release()
+    _hold(_global)
+
+
+def spend(budget: str) -> None:
+    """Takes a slot of an expensive-operation budget for the rest of the request, or raises ``Rejected``."""
+    _hold(_budgets.get(budget))
+
+
+def budgeted(budget: str, connect: Callable[[], Any]) -> Callable[[], Any]:
+    """Wraps a lazy ``connect`` callable (see catalog.py) so it spends ``budget`` only when actually called."""
+    def wrapper():
+        spend(budget)
+        return connect()
+    return wrapper
+
+
+def release_all() -> None:
+    """Releases every slot the current request holds, newest first."""
+    held = g.pop("admission_held", None) or []
+    for limiter in reversed(held):
+        limiter.release()
+
+
+def stats() -> Dict[str, Any]:
+    with _stores_lock:
+        stores = dict(_stores)
+    return {
+        "pid": os.getpid(),
+        "global": _global.stats() if _global else None,
+        "budgets": {name: limiter.stats() for name, limiter in _budgets.items()},
+        "stores": {str(store_id): limiter.stats() for store_id, limiter in stores.items()},
+    }
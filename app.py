@@ -1,136 +1,235 @@
 import os
-import json
+import hmac
+import math
 import uuid  
+import time
+import threading
 from flask import Flask, request, jsonify, g
-import mysql.connector
+from flask.json.provider import JSONProvider
 from dotenv import load_dotenv
 from mysql.connector import Error
-from Final import (
-    _parse_multi_sizes,
-    fetch_menu_questions,
-    get_user_name,
-    fetch_store_menu,
+from ordering import (
     fetch_product_details,
-    extract_quantity,
-    transform_variation,
     add_to_cart,
+    cart_row,
 )
-from rapidfuzz import process as fuzz_process
+from conversation import parse_boolean_answer, build_item_questions
+import db
+import admission
+import catalog
+import cart_journal
+import conversation
+import fastjson
+import fanout
+import matching
+import memory_debug
+import popularity
+import profiling
+import session_store
+import tracing
+from cache import LRUCache
 
 load_dotenv()
+
+
+class FastJSONProvider(JSONProvider):
+    """Flask's JSON provider on top of fastjson (orjson when it is installed)."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return fastjson.dumps_str(obj)
+
+    def loads(self, s, **kwargs):
+        return fastjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(fastjson.dumps(obj), mimetype="application/json")
+
+
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
+
+# Adds X-Chat-Branch / X-DB-Queries headers to every response (used by bench/loadtest.py)
+EXPOSE_TURN_STATS = os.getenv("EXPOSE_TURN_STATS", "0") == "1"
+# Required in the X-Admin-Token header by the /api/v1/admin endpoints; unset disables them.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+# Type-ahead suggestions per request: default and maximum ?limit=.
+SUGGEST_LIMIT = int(os.getenv("SUGGEST_LIMIT", "5"))
+SUGGEST_MAX_LIMIT = int(os.getenv("SUGGEST_MAX_LIMIT", "20"))
+
+# Constant replies, serialized once.
+START_FIELDS_MISSING = fastjson.dumps({"error": "user_id and store_id are required."})
+CHAT_FIELDS_MISSING = fastjson.dumps({"error": "session_id and user_input are required."})
+INVALID_SESSION = fastjson.dumps({"error": "Invalid or expired session_id."})
+ORDER_CONFIRMED = fastjson.dumps(conversation.confirmed_reply())
+ORDER_CANCELLED = fastjson.dumps(conversation.cancelled_reply())
+EMPTY_CART = fastjson.dumps(conversation.empty_cart_reply())
 
 # --- In-Memory Session Cache ---
 # In production, replace this with a connection to Redis or Memcached
-session_cache = {}
+session_cache = session_store.SessionStore()
+
+# session_id -> newest type-ahead ?seq= seen, so a keystroke a later one overtook is skipped
+_suggest_seqs = LRUCache(maxsize=16384)
+_suggest_seqs_lock = threading.Lock()
+
+# Replays cart lines a previous run journaled but did not write.
+if cart_journal.CART_WRITE_BEHIND:
+    cart_journal.get_journal()
 
-def get_store_name(cur, store_id: int) -> str:
-    try:
-        cur.execute("SELECT title FROM service_details WHERE id = %s AND status = 1;", (store_id,))
-        row = cur.fetchone()
-        return row["title"] if row and row.get("title") else "Store"
-    except Error as e:
-        print(f"Error fetching store name: {e}")
-        return "Store"
+def json_body(body: bytes, status: int = 200):
+    """A response for an already serialized JSON body."""
+    return app.response_class(body, status=status, mimetype="application/json")
 
 def get_db():
+    """The request's connection to the primary, for writes and reads that must see them."""
     if 'db' not in g:
-        g.db = mysql.connector.connect(
-            host=os.getenv('DB_HOST'), user=os.getenv('DB_USER'),
-            password=os.getenv('DB_PASSWORD'), database=os.getenv('DB_NAME'),
-            autocommit=True
-        )
+        g.db = db.get_connection()
     return g.db
 
-@app.teardown_appcontext
-def close_db(e=None):
-    db = g.pop('db', None)
-    if db is not None:
-        db.close()
+def get_read_db():
+    """The request's connection for plain reads; a replica when DB_REPLICA_HOSTS are set."""
+    if 'read_db' not in g:
+        g.read_db = db.get_read_connection()
+    return g.read_db
+
+@app.before_request
+def reset_turn_stats():
+    db.reset_query_count()
+    catalog.reset_stale()
+    fanout.begin_turn()
+    tracing.begin()
+
+@app.after_request
+def add_turn_stats_headers(response):
+    if EXPOSE_TURN_STATS:
+        response.headers["X-Chat-Branch"] = g.get("chat_branch", "")
+        response.headers["X-DB-Queries"] = str(db.query_count())
+    if g.get("profile_id"):
+        response.headers["X-Profile-Id"] = g.profile_id
+    return response
+
+@app.after_request
+def flag_stale_data(response):
+    """Marks responses built from last-known-good menu or product data (see catalog degraded reads)."""
+    if not catalog.served_stale():
+        return response
+    response.headers["X-Data-Stale"] = "1"
+    body = response.get_data() if response.is_json else b""
+    if body.startswith(b"{") and body.endswith(b"}"):
+        response.set_data(fastjson.with_fields(body, stale=True))
+    return response
+
+@app.after_request
+def trace_slow_turn(response):
+    trace = tracing.end()
+    if trace is None or not tracing.is_slow(trace):
+        return response
+    session_id = g.get("session_id")
+    state = session_cache.peek(session_id) if session_id else None
+    tracing.write({
+        "ts": time.time(),
+        "endpoint": request.path,
+        "status_code": response.status_code,
+        "branch": g.get("chat_branch"),
+        "session_id": session_id,
+        "store_id": g.get("store_id"),
+        "elapsed_ms": round(trace.elapsed_ms(), 2),
+        "stages": trace.stages_ms(),
+        "db_queries": db.query_count(),
+        "state_bytes": len(fastjson.dumps(state)) if state else 0,
+        "response_bytes": response.calculate_content_length(),
+    })
+    return response
 
-# def parse_boolean_answer(sentence: str) -> bool:
-#     positive_phrases = ["yes", "yeah", "yup", "i want", "sure", "of course", "absolutely", "okay", "add", "include"]
-#     return any(p in sentence.lower() for p in positive_phrases)
+def describe_turn() -> dict:
+    """Tags stored with a request profile."""
+    store_id = g.get("store_id")
+    index = catalog.menu_indexes.get(store_id) if store_id is not None else None
+    return {
+        "session_id": g.get("session_id"),
+        "store_id": store_id,
+        "branch": g.get("chat_branch"),
+        "menu_size": len(index.names) if index else None,
+    }
 
-def parse_boolean_answer(sentence: str) -> bool:
+@app.errorhandler(admission.Rejected)
+def reject_turn(err):
+    g.chat_branch = "rejected"
+    response = jsonify({
+        "status": "busy",
+        "assistant_response": "We're a little busy right now. Please try again in a moment.",
+        "error": str(err),
+        "retry_after": err.retry_after,
+    })
+    response.headers["Retry-After"] = str(err.retry_after)
+    return response, err.status
+
+@app.errorhandler(fanout.DeadlineExceeded)
+def turn_deadline_exceeded(err):
+    response = jsonify({
+        "status": "busy",
+        "assistant_response": "Sorry, that took too long. Please try again.",
+        "error": str(err),
+        "retry_after": 1,
+    })
+    response.headers["Retry-After"] = "1"
+    return response, 503
 
-    s = sentence.lower()
-    positive_phrases = ["yes", "yeah", "yup", "i want", "sure", "of course", "absolutely", "okay", "add", "include", "do", "confirm"]
-    negative_phrases = ["no", "nope", "don't", "not", "skip", "without", "exclude", "remove", "cancel"]
-    
-    # It's positive if a positive word is present AND no negative word is present.
-    is_positive = any(p in s for p in positive_phrases)
-    is_negative = any(n in s for n in negative_phrases)
-    
-    return is_positive and not is_negative
-
-def calculate_item_price(conn, item: dict) -> tuple:
-    total_price, total_quantity = 0.0, 0
-    if item.get("selected_options"):
-        for opt in item["selected_options"]:
-            total_price += float(opt.get('price', 0)) * int(opt.get('quantity', 1))
-            total_quantity += int(opt.get('quantity', 1))
-    else:
-        price = item.get('price', 0) or fetch_product_details(conn, item['item_id']).get('normal_price', 0)
-        quantity = item.get('quantity', 1)
-        total_price = float(price) * int(quantity)
-        total_quantity = int(quantity)
+@app.errorhandler(session_store.SessionBusy)
+def session_busy(err):
+    return reject_turn(admission.Rejected("session", str(err), 409))
 
-    addon_price = sum(float(addon.get('addon_price', 0)) for addon in item.get("selected_addons", []))
-    total_price += addon_price * total_quantity
+@app.errorhandler(session_store.KeyReused)
+def idempotency_key_reused(err):
+    return jsonify({"error": str(err)}), 422
 
-    with conn.cursor(dictionary=True) as cur:
-        cur.execute("SELECT discount FROM tbl_product_attribute WHERE product_id = %s", (item["item_id"],))
-        result = cur.fetchone()
-        discount_rate = float(result['discount']) if result and result.get('discount') else 0.0
+@app.teardown_request
+def release_admission(e=None):
+    admission.release_all()
 
-    final_price = total_price * (1 - discount_rate / 100)
-    return final_price, total_quantity
+def is_admin() -> bool:
+    token = request.headers.get("X-Admin-Token")
+    return bool(token and ADMIN_TOKEN and hmac.compare_digest(token, ADMIN_TOKEN))
 
-def create_order_summary_for_api(conn, completed_items: list) -> dict:
+@app.teardown_appcontext
+def close_db(e=None):
+    for name in ('db', 'read_db'):
+        conn = g.pop(name, None)
+        if conn is not None:
+            conn.close()
+
+@tracing.timed("calculate_item_price")
+def calculate_item_price(conn, item: dict, bundle: dict = None) -> tuple:
+    if bundle is None:
+        bundle = fetch_product_details(conn, item['item_id'], item.get('store_id'))
+    return conversation.price_item(item, bundle)
+
+def create_order_summary_for_api(connect, completed_items: list, store_id=None) -> dict:
     """
     Calculates prices and generates a summary object for the API.
+    Product prices come from the details cache; misses are loaded in parallel and
+    ``connect`` is only used when there is a single one.
     """
-    summary_items = []
-    total_price_final = 0.0
-
-    for item in completed_items:
-        total_quantity = 0
-        options_summary = []
-        if item.get("selected_options"):
-            for option in item["selected_options"]:
-                options_summary.append(f"{option.get('quantity', 1)} {option.get('name', '')}")
-                total_quantity += int(option.get('quantity', 1))
-        else:
-            total_quantity = int(item.get('quantity', 1))
-
-        addon_summary = []
-        if item.get("selected_addons"):
-            for addon in item["selected_addons"]:
-                addon_summary.append(addon.get('addon_name', ''))
-
-        final_price, _ = calculate_item_price(conn, item)
-        total_price_final += final_price
-
-        # Create a summary line for this specific item
-        line = f"{total_quantity} {item['item_name']}"
-        if options_summary:
-            line += f" ({', '.join(options_summary)})"
-        if addon_summary:
-            line += f" with {', '.join(addon_summary)}"
-        
-        summary_items.append({
-            "line_item": line,
-            "price": f"{final_price:.2f}"
-        })
+    bundles = {}
+    for item_id in {item['item_id'] for item in completed_items}:
+        cached = catalog.product_details.get((store_id, item_id))
+        if cached is not None:
+            bundles[item_id] = cached
+    bundles.update(fanout.gather({
+        item_id: (lambda c, item_id=item_id: catalog.get_product_details(c, item_id, store_id))
+        for item_id in {item['item_id'] for item in completed_items} if item_id not in bundles
+    }, connect, checkout=db.get_read_connection))
+    with tracing.stage("summarize_order"):
+        return conversation.summarize_order(completed_items, bundles)
 
-    return {
-        "summary_items": summary_items,
-        "total_price": total_price_final
-    }
+
+def start_item(session_id: str, state: dict, item: dict, questions: list):
+    return jsonify(conversation.start_item(session_id, state, item, questions))
 
 
 @app.route('/api/v1/start-conversation', methods=['POST'])
+@profiling.profiled(describe_turn)
 def start_conversation():
     """
     Starts a new conversation, creates a session, and returns the session ID.
@@ -140,13 +239,14 @@ def start_conversation():
     store_id = data.get('store_id')
 
     if not user_id or not store_id:
-        return jsonify({"error": "user_id and store_id are required."}), 400
+        return json_body(START_FIELDS_MISSING, 400)
 
-    conn = get_db()
-    cur = conn.cursor(dictionary=True)
+    admission.admit(store_id)
 
     # Generate a unique session ID
     session_id = str(uuid.uuid4())
+    g.chat_branch = "start"
+    g.session_id, g.store_id = session_id, store_id
 
     # Create the initial state and store it in the cache
     initial_state = {
@@ -156,412 +256,318 @@ def start_conversation():
         "item_in_progress": None,
         "completed_items": []
     }
-    session_cache[session_id] = initial_state
+    session_cache.create(session_id, initial_state)
+
+    # Load the menu, match index and popular products while the greeting is being delivered.
+    catalog.warm_store(store_id)
 
-    user_name = get_user_name(cur, user_id)
-    store_name = get_store_name(cur, store_id)
-    cur.close()
+    names = fanout.gather({
+        "user": lambda connect: catalog.get_user_name(connect, user_id),
+        "store": lambda connect: catalog.get_store_name(connect, store_id),
+    }, checkout=db.get_read_connection)
+    user_name, store_name = names["user"], names["store"]
 
-    message = f"Hello {user_name}! You're chatting with {store_name}'s assistant. What would you like to eat today?"
     return jsonify({
         "status": "success",
         "session_id": session_id,
-        "assistant_response": message
+        "assistant_response": conversation.greeting(user_name, store_name)
     })
     
 
-# @app.route('/api/v1/chat', methods=['POST'])
-# def chat_step():
-#     """
-#     Handles a single turn, now with ambiguity resolution.
-#     """
-#     data = request.get_json()
-#     session_id = data.get('session_id')
-#     user_input = data.get('user_input')
-
-#     if not session_id or user_input is None:
-#         return jsonify({"error": "session_id and user_input are required."}), 400
-
-#     state = session_cache.get(session_id)
-#     if not state:
-#         return jsonify({"error": "Invalid or expired session_id."}), 404
-
-#     conn = get_db()
-
-#     # ---- LOGIC FOR DIFFERENT CONVERSATION STATES ----
-
-#     # A. If the API is waiting for the user to clarify an ambiguous item
-#     if state.get('status') == 'clarification_needed':
-#         clarification_options = state.get('clarification_options', [])
-#         chosen_item = None
-
-#         # Try to match by number (e.g., "1", "2")
-#         if user_input.strip().isdigit():
-#             choice_index = int(user_input.strip()) - 1
-#             if 0 <= choice_index < len(clarification_options):
-#                 chosen_item = clarification_options[choice_index]
-        
-#         # If not a valid number, try to match by name again from the small list
-#         if not chosen_item:
-#             item_names = [item['item_name'] for item in clarification_options]
-#             match = fuzz_process.extractOne(user_input, item_names, score_cutoff=80)
-#             if match:
-#                 # Find the full item object that corresponds to the matched name
-#                 chosen_item = next((item for item in clarification_options if item['item_name'] == match[0]), None)
-
-#         if chosen_item:
-#             # Item has been chosen, now proceed to ask questions for it
-#             state['status'] = 'item_selected'
-#             state['item_in_progress'] = chosen_item
-#             state.pop('clarification_options', None) # Clean up
-#             # Fall through to the 'else' block to start asking questions
-#         else:
-#             # Could not understand the choice, ask again
-#             options_text = "\n".join([f"{i+1}. {item['item_name']}" for i, item in enumerate(clarification_options)])
-#             return jsonify({
-#                 "status": "clarification_needed",
-#                 "assistant_response": f"Sorry, I didn't get that. Please choose a number or name from the list:\n{options_text}",
-#                 "options": clarification_options,
-#                 "session_id": session_id
-#             })
-
-#     # B. If the API is waiting for final order confirmation
-#     if state.get('status') == 'pending_confirmation':
-#         # ... (This logic remains the same)
-#         if parse_boolean_answer(user_input):
-#             try:
-#                 for item in state['completed_items']:
-#                     final_price, total_quantity = calculate_item_price(conn, item)
-#                     add_to_cart(user_id=state['user_id'], store_id=state['store_id'], item=item, total_qty=total_quantity, price=final_price, variation=item, visible=1)
-#                 del session_cache[session_id]
-#                 return jsonify({"status": "order_confirmed", "assistant_response": "Thank you! Your order has been placed in your cart."})
-#             except Error as err:
-#                 return jsonify({"status": "error", "message": f"Database error: {err}"}), 500
-#         else:
-#             del session_cache[session_id]
-#             return jsonify({"status": "order_cancelled", "assistant_response": "Okay, I've cancelled your order."})
-
-#     item_in_progress = state.get('item_in_progress')
-
-#     # C. If we are asking questions for an item
-#     if item_in_progress and state.get('pending_questions'):
-#         # ... (This logic remains the same)
-#         current_question = state['pending_questions'].pop(0)
-#         question_type = current_question['type']
-        
-#         if question_type == 'options':
-#             allowed = current_question.get('data', {}).get('option_values', [])
-#             parsed = _parse_multi_sizes(user_input, [opt.get('name') for opt in allowed])
-#             for p in parsed:
-#                 for a in allowed:
-#                     if p['name'].lower() == a['name'].lower():
-#                         p['price'] = a['price']; break
-#             item_in_progress.setdefault('selected_options', []).extend(parsed)
-#         elif question_type == 'boolean':
-#              if parse_boolean_answer(user_input):
-#                 item_in_progress.setdefault('selected_addons', []).append(current_question.get('data', {}))
-
-#         state['item_in_progress'] = item_in_progress
-#         if state['pending_questions']:
-#             next_question = state['pending_questions'][0]
-#             session_cache[session_id] = state
-#             return jsonify({"status": "question", "assistant_response": next_question['question_text'], "session_id": session_id})
-#         else:
-#             state['completed_items'].append(item_in_progress)
-#             state['item_in_progress'] = None
-#             session_cache[session_id] = state
-#             return jsonify({"status": "item_complete", "assistant_response": "Got it. Anything else?", "session_id": session_id})
-
-#     # D. If the user wants to end the order
-#     elif user_input.lower() in ["no", "that's all", "thats all"]:
-#         # ... (This logic remains the same)
-#         if not state['completed_items']:
-#             return jsonify({"status": "complete", "assistant_response": "Your cart is empty. What would you like to order?"})
-#         summary = create_order_summary_for_api(conn, state['completed_items'])
-#         state['status'] = 'pending_confirmation'
-#         session_cache[session_id] = state
-#         summary_lines = [item['line_item'] for item in summary['summary_items']]
-#         response_text = "Here is your order summary:\n- " + "\n- ".join(summary_lines)
-#         response_text += f"\n\nYour total is ₹{summary['total_price']:.2f}. Should I confirm this order?"
-#         return jsonify({"status": "pending_confirmation", "assistant_response": response_text, "summary": summary, "session_id": session_id})
-
-#     # E. If we are waiting for a new item from the user
-#     else:
-#         # <<< MODIFIED LOGIC START >>>
-#         # Handle empty input by showing the menu
-#         if not user_input.strip():
-#             # ... (This logic remains the same)
-#             menu = fetch_store_menu(conn, state['store_id'])
-#             if not menu: return jsonify({"status": "error", "assistant_response": "Sorry, the menu is currently unavailable."})
-#             unique_item_names = sorted(list(set(item['item_name'] for item in menu)))
-#             menu_text = "\n".join(f"{i}. {name}" for i, name in enumerate(unique_item_names, 1))
-#             response_message = "I didn't catch that. Here is what we have on the menu:\n" + menu_text
-#             return jsonify({"status": "awaiting_item_selection", "assistant_response": response_message, "menu_items": unique_item_names, "session_id": session_id})
-
-#         # Find items using fuzzy search
-#         menu = fetch_store_menu(conn, state['store_id'])
-#         all_items_map = {item['item_name']: item for item in menu} # Assumes unique names
-#         all_item_names = list(all_items_map.keys())
-        
-#         # Use extract to get multiple matches, not just one
-#         matches = fuzz_process.extract(user_input, all_item_names, score_cutoff=75, limit=5)
-
-#         if not matches:
-#             return jsonify({"status": "not_found", "assistant_response": f"Sorry, I couldn't find anything like '{user_input}'."})
-
-#         # Check if the top matches are too similar in score (ambiguous)
-#         best_score = matches[0][1]
-#         ambiguous_matches = [m for m in matches if m[1] >= best_score - 5] # Get all matches with scores close to the best one
-
-#         if len(ambiguous_matches) > 1:
-#             # AMBIGUITY DETECTED
-#             clarification_options = [all_items_map[name] for name, score, idx in ambiguous_matches]
-#             state['status'] = 'clarification_needed'
-#             state['clarification_options'] = clarification_options
-#             session_cache[session_id] = state
-
-#             options_text = "\n".join([f"{i+1}. {item['item_name']}" for i, item in enumerate(clarification_options)])
-#             return jsonify({
-#                 "status": "clarification_needed",
-#                 "assistant_response": f"I found a few options, which one did you mean?\n{options_text}",
-#                 "options": clarification_options, # Send structured data to the client
-#                 "session_id": session_id
-#             })
-        
-#         # NO AMBIGUITY, PROCEED WITH THE BEST MATCH
-#         best_match_name = matches[0][0]
-#         matched_item = all_items_map[best_match_name]
-#         state['item_in_progress'] = matched_item
-        
-#         # This logic is now inside the main endpoint
-#         details = fetch_product_details(get_db(), matched_item['item_id'])
-#         questions = []
-#         if details.get("options"):
-#             for opt_group in details["options"]:
-#                 choices = ", ".join([f"{val['name']} (₹{val['price']})" for val in opt_group['option_values']])
-#                 questions.append({"type": "options", "question_text": f"Please select your {opt_group['option_name']}. Options are: {choices}", "data": opt_group})
-#         if details.get("addons"):
-#             for addon in details["addons"]:
-#                 questions.append({"type": "boolean", "question_text": f"Would you like to add {addon['addon_name']} (₹{addon['addon_price']})?", "data": addon})
-
-#         if not questions: # No questions, item is complete
-#             state['completed_items'].append(matched_item)
-#             state['item_in_progress'] = None
-#             session_cache[session_id] = state
-#             return jsonify({"status": "item_complete", "assistant_response": f"Added {matched_item['item_name']}. Anything else?"})
-
-#         # Ask the first question
-#         state['pending_questions'] = questions
-#         session_cache[session_id] = state
-#         return jsonify({"status": "question", "assistant_response": questions[0]['question_text'], "session_id": session_id})
-#     # <<< MODIFIED LOGIC END >>>
+def _superseded(session_id: str, seq: int) -> bool:
+    with _suggest_seqs_lock:
+        latest = _suggest_seqs.get(session_id)
+        if latest is not None and seq < latest:
+            return True
+        _suggest_seqs.put(session_id, seq)
+        return False
+
+
+@app.route('/api/v1/stores/<int:store_id>/suggest', methods=['GET'])
+def suggest(store_id):
+    """
+    Type-ahead menu matches for a partial utterance (?q=), for clients with streaming
+    speech recognition. Only an already loaded menu is searched: a cold store answers
+    with no suggestions and "pending": true while its menu loads. A client that sends
+    ?session_id=&seq= with every keystroke gets "superseded": true, with no matching
+    done, for a request that arrives after a later keystroke's.
+    """
+    g.chat_branch = "suggest"
+    g.store_id = store_id
+    query = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', SUGGEST_LIMIT, type=int), 1), SUGGEST_MAX_LIMIT)
+    reply = {"store_id": store_id, "query": query, "suggestions": []}
+
+    session_id = request.args.get('session_id')
+    if session_id:
+        state = session_cache.peek(session_id)
+        if state and str(state['store_id']) != str(store_id):
+            return jsonify({"error": "session_id belongs to another store."}), 400
+        seq = request.args.get('seq', type=int)
+        if seq is not None and _superseded(session_id, seq):
+            reply["superseded"] = True
+            return jsonify(reply)
+
+    index = catalog.menu_indexes.get(store_id)
+    if index is None:
+        index = catalog.last_good_menu(store_id)
+        if index is None:
+            catalog.warm_store(store_id)
+            reply["pending"] = True
+            return jsonify(reply)
+        catalog.mark_stale()
+
+    reply["suggestions"] = [
+        {"item_id": index.items_by_name[name]["item_id"], "item_name": name, "score": round(score, 1), "match": kind}
+        for name, score, _, kind in index.suggest(query, limit)
+    ]
+    return jsonify(reply)
+
+
+@app.route('/api/v1/admin/admission', methods=['GET'])
+def admission_stats():
+    """In-flight, queue depth and rejection counters of this worker's limiters."""
+    if not is_admin():
+        return jsonify({"error": "Not found."}), 404
+    return jsonify(admission.stats())
+
+
+@app.route('/api/v1/admin/db', methods=['GET'])
+def db_stats():
+    """Read breaker, per-replica health, read coalescing and popularity refresh counters of this worker."""
+    if not is_admin():
+        return jsonify({"error": "Not found."}), 404
+    return jsonify({"read_breaker": db.read_breaker.stats(), "replicas": db.replica_stats(),
+                    "single_flight": catalog.reads.stats(), "popularity": popularity.table.stats()})
+
+
+def _top_param() -> int:
+    return max(1, min(request.args.get("top", memory_debug.MEMORY_TOP_SITES, type=int), 500))
+
+
+@app.route('/debug/memory', methods=['GET'])
+def memory_report():
+    """Sessions, per-store cache sizes and allocation tracing state of this worker."""
+    if not is_admin():
+        return jsonify({"error": "Not found."}), 404
+    caches = {name: memory_debug.cache_report(cache, store_of) for name, (cache, store_of) in catalog.caches().items()}
+    caches["match_results"] = memory_debug.cache_report(matching.match_cache, lambda key: key[0])
+    caches["suggest_seqs"] = memory_debug.cache_report(_suggest_seqs)
+    caches["decoded_columns"] = memory_debug.cache_report(db._decoded_columns)
+    return jsonify({
+        "pid": os.getpid(),
+        "sessions": memory_debug.session_report(session_cache),
+        "menus": memory_debug.menu_index_report(catalog.menu_indexes.snapshot()),
+        "caches": caches,
+        "allocations": memory_debug.tracing_status(),
+    })
+
 
+@app.route('/debug/memory/snapshots', methods=['POST'])
+def memory_snapshot():
+    """Takes a tracemalloc snapshot (starting tracing if needed) and returns its top allocation sites."""
+    if not is_admin():
+        return jsonify({"error": "Not found."}), 404
+    return jsonify(memory_debug.take_snapshot(_top_param()))
+
+
+@app.route('/debug/memory/diff', methods=['GET'])
+def memory_diff():
+    """Allocation growth between snapshots ?from= and ?to= (default: a new snapshot)."""
+    if not is_admin():
+        return jsonify({"error": "Not found."}), 404
+    old_id = request.args.get("from", type=int)
+    new_id = request.args.get("to", type=int)
+    if old_id is None:
+        return jsonify({"error": "from is required."}), 400
+    if new_id is None:
+        new_id = memory_debug.take_snapshot(0)["snapshot"]
+    result = memory_debug.diff(old_id, new_id, _top_param())
+    if result is None:
+        return jsonify({"error": "Unknown snapshot."}), 404
+    return jsonify(result)
+
+
+@app.route('/debug/memory/snapshots', methods=['DELETE'])
+def memory_stop_tracing():
+    """Stops allocation tracing and drops the snapshots."""
+    if not is_admin():
+        return jsonify({"error": "Not found."}), 404
+    memory_debug.stop()
+    return jsonify(memory_debug.tracing_status())
 
 
 @app.route('/api/v1/chat', methods=['POST'])
+@profiling.profiled(describe_turn)
 def chat_step():
-
+    """
+    Handles a single turn. Turns of one session run one at a time, on a copy of the
+    state that is committed only when the turn completes. A turn sent again with the
+    same Idempotency-Key header gets the first reply back instead of running twice.
+    """
     data = request.get_json()
     session_id = data.get('session_id')
     user_input = data.get('user_input')
 
     if not session_id or user_input is None:
-        return jsonify({"error": "session_id and user_input are required."}), 400
-
-    state = session_cache.get(session_id)
-    if not state:
-        return jsonify({"error": "Invalid or expired session_id."}), 404
-
-    conn = get_db()
-  
+        return json_body(CHAT_FIELDS_MISSING, 400)
+
+    idempotency_key = request.headers.get("Idempotency-Key")
+    replayed = _replayed(session_id, idempotency_key, user_input)
+    if replayed is not None:
+        return replayed
+    committed_state = session_cache.peek(session_id)
+    if committed_state is None:
+        return json_body(INVALID_SESSION, 404)
+    # Admission may queue; it is taken before the session lock so nothing waits while holding it.
+    g.session_id, g.store_id = session_id, committed_state['store_id']
+    admission.admit(committed_state['store_id'])
+
+    with session_cache.lock(session_id):
+        # A retry may have waited for the turn it repeats.
+        replayed = _replayed(session_id, idempotency_key, user_input)
+        if replayed is not None:
+            return replayed
+        checked_out = session_cache.checkout(session_id)
+        if checked_out is None:
+            return json_body(INVALID_SESSION, 404)
+        version, state = checked_out
+
+        response = app.make_response(chat_turn(session_id, state, user_input))
+        committed = (session_cache.delete(session_id, version) if g.get("session_ended")
+                     else session_cache.commit(session_id, version, state))
+        if not committed:
+            raise admission.Rejected("session", "changed by another turn", 409)
+        # Rejections and server errors are not remembered; retrying them should run the turn.
+        if idempotency_key and response.status_code < 500:
+            session_cache.remember(session_id, idempotency_key, user_input,
+                                   response.status_code, response.get_data())
+        return response
+
+
+def _replayed(session_id: str, idempotency_key, user_input):
+    """The remembered response to a repeated turn, or None."""
+    if not idempotency_key:
+        return None
+    replayed = session_cache.replay(session_id, idempotency_key, user_input)
+    if replayed is None:
+        return None
+    g.chat_branch = "replay"
+    response = json_body(replayed[1], replayed[0])
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+def end_session() -> None:
+    """Deletes the session once the current turn is done."""
+    g.session_ended = True
+
+
+def chat_turn(session_id: str, state: dict, user_input: str):
+    """The conversation state machine; mutates ``state``, which chat_step commits."""
     if state.get('status') == 'clarification_needed':
+        g.chat_branch = "clarification"
         clarification_options = state.get('clarification_options', [])
-        chosen_item = None
-
-        if user_input.strip().isdigit():
-            choice_index = int(user_input.strip()) - 1
-            if 0 <= choice_index < len(clarification_options):
-                chosen_item = clarification_options[choice_index]
-        
-        if not chosen_item:
-            item_names = [item['item_name'] for item in clarification_options]
-            match = fuzz_process.extractOne(user_input, item_names, score_cutoff=80)
-            if match:
-                chosen_item = next((item for item in clarification_options if item['item_name'] == match[0]), None)
+        chosen_item = conversation.pick_clarification(user_input, clarification_options)
 
         if chosen_item:
             state['status'] = 'item_selected'
-            state['item_in_progress'] = chosen_item
             state.pop('clarification_options', None)
+            # Details and questions were fetched while the user was choosing.
+            prefetched = catalog.take_prefetched(session_id, chosen_item['item_id'])
+            if prefetched:
+                _, questions = prefetched
+            else:
+                questions = build_item_questions(catalog.get_product_details(get_read_db, chosen_item['item_id'], state['store_id']))
+            return start_item(session_id, state, chosen_item, questions)
         else:
-            options_text = "\n".join([f"{i+1}. {item['item_name']}" for i, item in enumerate(clarification_options)])
-            
-            formatted_options = [{
-                "item_id": item.get("item_id"),
-                "item_name": item.get("item_name", "").strip()
-            } for item in clarification_options]
-            
-            return jsonify({
-                "status": "clarification_needed",
-                "assistant_response": f"Sorry, I didn't get that. Please choose a number or name from the list:\n{options_text}",
-                "options": formatted_options,
-                "session_id": session_id
-            })
+            return jsonify(conversation.clarification_reply(session_id, clarification_options, retry=True))
 
     # B. If the API is waiting for final order confirmation
     if state.get('status') == 'pending_confirmation':
+        g.chat_branch = "confirmation"
         if parse_boolean_answer(user_input):
+            # Rejected before anything is written, so the client can simply repeat the confirmation.
+            admission.spend("confirmation")
+            # Prices are re-read below, never taken from cached or stale data, so don't
+            # confirm while the database is known to be failing.
+            if db.read_breaker.is_open():
+                raise admission.Rejected("database", "circuit open", 503,
+                                         retry_after=math.ceil(db.read_breaker.retry_after()) or 1)
             try:
+                # Fresh bundles from the primary, the database the cart lines are written to;
+                # nothing is written until all of them have arrived.
+                conn = get_db()
+                bundles = fanout.gather({
+                    item_id: (lambda c, item_id=item_id: db.fetch_product_bundle(c(), item_id, state['store_id']))
+                    for item_id in {item['item_id'] for item in state['completed_items']}
+                }, get_db)
+                rows = []
                 for item in state['completed_items']:
-                    final_price, total_quantity = calculate_item_price(conn, item)
-                    add_to_cart(user_id=state['user_id'], store_id=state['store_id'], item=item, total_qty=total_quantity, price=final_price, variation=item, visible=1)
-                del session_cache[session_id]
-                return jsonify({"status": "order_confirmed", "assistant_response": "Thank you! Your order has been placed in your cart."})
+                    bundle = bundles[item['item_id']]
+                    final_price, total_quantity = calculate_item_price(conn, item, bundle)
+                    if cart_journal.CART_WRITE_BEHIND:
+                        rows.append(cart_row(state['user_id'], state['store_id'], item, total_quantity, final_price, item, 1,
+                                             bundle['attribute_id']))
+                    else:
+                        add_to_cart(user_id=state['user_id'], store_id=state['store_id'], item=item, total_qty=total_quantity, price=final_price, variation=item, visible=1,
+                                    conn=conn, attribute_id=bundle['attribute_id'])
+                if rows:
+                    # Durable once append returns; the journal writes it to tbl_cart_data in the background.
+                    cart_journal.append(session_id, rows)
+                end_session()
+                return json_body(ORDER_CONFIRMED)
             except Error as err:
                 return jsonify({"status": "error", "message": f"Database error: {err}"}), 500
         else:
-            del session_cache[session_id]
-            return jsonify({"status": "order_cancelled", "assistant_response": "Okay, I've cancelled your order."})
+            end_session()
+            return json_body(ORDER_CANCELLED)
 
     item_in_progress = state.get('item_in_progress')
 
     # C. If we are asking questions for an item
     if item_in_progress and state.get('pending_questions'):
-        current_question = state['pending_questions'].pop(0)
-        question_type = current_question['type']
-        
-        if question_type == 'options':
-            allowed = current_question.get('data', {}).get('option_values', [])
-            parsed = _parse_multi_sizes(user_input, [opt.get('name') for opt in allowed])
-            for p in parsed:
-                for a in allowed:
-                    if p['name'].lower() == a['name'].lower():
-                        p['price'] = a['price']; break
-            item_in_progress.setdefault('selected_options', []).extend(parsed)
-        elif question_type == 'boolean':
-             if parse_boolean_answer(user_input):
-                item_in_progress.setdefault('selected_addons', []).append(current_question.get('data', {}))
-
-        state['item_in_progress'] = item_in_progress
-        if state['pending_questions']:
-            next_question = state['pending_questions'][0]
-            session_cache[session_id] = state
-            return jsonify({"status": "question", "assistant_response": next_question['question_text'], "session_id": session_id})
-        # else:
-        #     state['completed_items'].append(item_in_progress)
-        #     state['item_in_progress'] = None
-        #     session_cache[session_id] = state
-        #     return jsonify({"status": "item_complete", "assistant_response": "Got it. Anything else?", "session_id": session_id})
-
-        
-        else:
-            # All questions for this item are done, add it to the list
-            state['completed_items'].append(item_in_progress)
-            state['item_in_progress'] = None
-            
-            # --- NEW LOGIC: Immediately show the summary ---
-            summary = create_order_summary_for_api(conn, state['completed_items'])
-            state['status'] = 'pending_confirmation'
-            session_cache[session_id] = state
-            
-            summary_lines = [item['line_item'] for item in summary['summary_items']]
-            response_text = "Here is your order summary:\n- " + "\n- ".join(summary_lines)
-            response_text += f"\n\nYour total is ₹{summary['total_price']:.2f}. Should I confirm this order?"
-            
-            return jsonify({
-                "status": "pending_confirmation",
-                "assistant_response": response_text,
-                "summary": summary,
-                "session_id": session_id
-            })
-        
-
-        
+        g.chat_branch = "question"
+        next_question = conversation.answer_question(session_id, state, user_input)
+        if next_question:
+            return jsonify(next_question)
+
+        # --- NEW LOGIC: Immediately show the summary ---
+        summary = create_order_summary_for_api(get_read_db, state['completed_items'], state['store_id'])
+        return jsonify(conversation.summary_reply(session_id, state, summary))
+
     # D. If the user wants to end the order
-    elif user_input.lower() in ["no", "that's all", "thats all"]:
+    elif user_input.lower() in conversation.END_OF_ORDER:
+        g.chat_branch = "summary"
         if not state['completed_items']:
-            return jsonify({"status": "complete", "assistant_response": "Your cart is empty. What would you like to order?"})
-        summary = create_order_summary_for_api(conn, state['completed_items'])
-        state['status'] = 'pending_confirmation'
-        session_cache[session_id] = state
-        summary_lines = [item['line_item'] for item in summary['summary_items']]
-        response_text = "Here is your order summary:\n- " + "\n- ".join(summary_lines)
-        response_text += f"\n\nYour total is ₹{summary['total_price']:.2f}. Should I confirm this order?"
-        return jsonify({"status": "pending_confirmation", "assistant_response": response_text, "summary": summary, "session_id": session_id})
+            return json_body(EMPTY_CART)
+        summary = create_order_summary_for_api(get_read_db, state['completed_items'], state['store_id'])
+        return jsonify(conversation.summary_reply(session_id, state, summary))
 
     # E. If we are waiting for a new item from the user
     else:
+        g.chat_branch = "new_item"
+        index = catalog.get_menu_index(admission.budgeted("menu_load", get_read_db), state['store_id'])
+
         if not user_input.strip():
-            menu = fetch_store_menu(conn, state['store_id'])
-            if not menu: return jsonify({"status": "error", "assistant_response": "Sorry, the menu is currently unavailable."})
-            unique_item_names = sorted(list(set(item['item_name'] for item in menu)))
-            menu_text = "\n".join(f"{i}. {name}" for i, name in enumerate(unique_item_names, 1))
-            response_message = "I didn't catch that. Here is what we have on the menu:\n" + menu_text
-            return jsonify({"status": "awaiting_item_selection", "assistant_response": response_message, "menu_items": unique_item_names, "session_id": session_id})
-
-        # Find items using fuzzy search
-        menu = fetch_store_menu(conn, state['store_id'])
-        # A small change here to handle potential duplicate item names in the menu list
-        unique_item_objects = {item['item_name'].strip(): item for item in menu}.values()
-        all_items_map = {item['item_name'].strip(): item for item in unique_item_objects}
-        all_item_names = list(all_items_map.keys())
-        
-        matches = fuzz_process.extract(user_input, all_item_names, score_cutoff=75, limit=5)
-
-        if not matches:
-            return jsonify({"status": "not_found", "assistant_response": f"Sorry, I couldn't find anything like '{user_input}'."})
-
-        best_score = matches[0][1]
-        ambiguous_matches = [m for m in matches if m[1] >= best_score - 5]
-
-        if len(ambiguous_matches) > 1:
+            return json_body(conversation.menu_reply_body(session_id, index))
+
+        candidates = conversation.match_new_item(index, user_input)
+        if not candidates:
+            return jsonify(conversation.not_found_reply(user_input))
+
+        if len(candidates) > 1:
             # AMBIGUITY DETECTED
-            clarification_options = [all_items_map[name] for name, score, idx in ambiguous_matches]
             state['status'] = 'clarification_needed'
             # Store the full objects in the session for our internal use
-            state['clarification_options'] = clarification_options
-            session_cache[session_id] = state
-
-            # Create a clean, formatted list to send to the client
-            formatted_options = []
-            for item in clarification_options:
-                formatted_options.append({
-                    "item_id": item.get("item_id"),
-                    "item_name": item.get("item_name", "").strip(),
-                    
-                })
-
-            options_text = "\n".join([f"{i+1}. {item['item_name']}" for i, item in enumerate(formatted_options)])
-            return jsonify({
-                "status": "clarification_needed",
-                "assistant_response": f"I found a few options, which one did you mean?\n{options_text}",
-                "options": formatted_options, 
-                "session_id": session_id
-            })
-        
-        best_match_name = matches[0][0]
-        matched_item = all_items_map[best_match_name]
-        state['item_in_progress'] = matched_item
-        
-        details = fetch_product_details(get_db(), matched_item['item_id'])
-        questions = []
-        if details.get("options"):
-            for opt_group in details["options"]:
-                choices = ", ".join([f"{val['name']} (₹{val['price']})" for val in opt_group['option_values']])
-                questions.append({"type": "options", "question_text": f"Please select your {opt_group['option_name']}. Options are: {choices}", "data": opt_group})
-        if details.get("addons"):
-            for addon in details["addons"]:
-                questions.append({"type": "boolean", "question_text": f"Would you like to add {addon['addon_name']} (₹{addon['addon_price']})?", "data": addon})
-
-        if not questions:
-            state['completed_items'].append(matched_item)
-            state['item_in_progress'] = None
-            session_cache[session_id] = state
-            return jsonify({"status": "item_complete", "assistant_response": f"Added {matched_item['item_name']}. Anything else?"})
-
-        state['pending_questions'] = questions
-        session_cache[session_id] = state
-        return jsonify({"status": "question", "assistant_response": questions[0]['question_text'], "session_id": session_id})
+            state['clarification_options'] = candidates
+            catalog.prefetch_candidates(session_id, state['store_id'],
+                                        [item['item_id'] for item in candidates], build_item_questions)
+            return jsonify(conversation.clarification_reply(session_id, candidates))
+
+        matched_item = candidates[0]
+        details = catalog.get_product_details(get_read_db, matched_item['item_id'], state['store_id'])
+        return start_item(session_id, state, matched_item, build_item_questions(details))
 
 
 if __name__ == "__main__":
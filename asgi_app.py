@@ -0,0 +1,433 @@
+"""
+asyncio serving mode of the chat API: the same /api/v1/start-conversation and
+/api/v1/chat contracts as app.py, as a plain ASGI application.
+
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5000 --workers 4
+
+A turn never blocks its worker while waiting on the database: reads and cart
+writes go through db_async's pool, and a turn's independent lookups are awaited
+together. Matching, pricing and replies come from conversation.py, and the menu,
+product and name caches are catalog.py's, so both modes behave the same. Sessions
+live in each worker's memory, exactly as with gunicorn.
+"""
+import os
+import time
+import uuid
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+import db
+import db_async
+import catalog
+import cart_journal
+import conversation
+import fastjson
+import session_store
+from conversation import parse_boolean_answer, build_item_questions
+from fanout import TURN_DEADLINE
+from matching import MenuIndex
+from ordering import cart_row
+
+# ─────────────────────────── CONFIG ───────────────────────────
+# Adds X-Chat-Branch headers to every response (used by bench/loadtest.py)
+EXPOSE_TURN_STATS = os.getenv("EXPOSE_TURN_STATS", "0") == "1"
+MAX_BODY_BYTES = int(os.getenv("ASGI_MAX_BODY_BYTES", str(64 * 1024)))
+
+# --- In-Memory Session Cache ---
+session_cache = session_store.SessionStore()
+
+# (kind, key) -> task of an in-flight load, shared by every turn that needs it
+_inflight: Dict[Any, "asyncio.Future"] = {}
+
+
+class Turn:
+    """Per-request bookkeeping (what app.py keeps in Flask's ``g``)."""
+    __slots__ = ("branch", "stale", "ended", "idempotency_key")
+
+    def __init__(self, idempotency_key: Optional[str] = None):
+        self.branch = ""
+        self.stale = False
+        self.ended = False
+        self.idempotency_key = idempotency_key
+
+
+# (status, payload); a bytes payload is already serialized
+Reply = Tuple[int, Union[Dict[str, Any], bytes]]
+
+
+# ─────────────────────── CACHED LOOKUPS ───────────────────────
+def _forget(key: Any, future: "asyncio.Future") -> None:
+    _inflight.pop(key, None)
+    if not future.cancelled():
+        future.exception()  # retrieved, so a failure nobody waited for is not logged twice
+
+
+async def _recorded(load: Callable[[], Awaitable[Any]], what: str) -> Any:
+    started = time.monotonic()
+    try:
+        value = await load()
+    except Exception as err:
+        db.read_breaker.record(time.monotonic() - started, ok=False)
+        print(f"Database error in {what}: {err}")
+        raise
+    except BaseException:  # cancelled
+        db.read_breaker.release()
+        raise
+    db.read_breaker.record(time.monotonic() - started)
+    return value
+
+
+async def _cached_read(turn: Turn, key: Any, load: Callable[[], Awaitable[Any]], stale: Any, what: str) -> Any:
+    """
+    One load per key at a time, guarded by db.read_breaker like catalog's reads. With
+    last-known-good data at hand the turn waits at most DB_READ_BUDGET and is then
+    served ``stale`` while the load finishes in the background; without, a failed
+    load returns None.
+    """
+    future = _inflight.get(key)
+    if future is None:
+        if not db.read_breaker.allow():
+            turn.stale = stale is not None
+            return stale
+        future = asyncio.ensure_future(_recorded(load, what))
+        _inflight[key] = future
+        future.add_done_callback(lambda f: _forget(key, f))
+    try:
+        if stale is None:
+            return await asyncio.shield(future)
+        return await asyncio.wait_for(asyncio.shield(future), db.DB_READ_BUDGET)
+    except Exception:  # failed, or over budget with stale data to serve
+        turn.stale = stale is not None
+        return stale
+
+
+async def get_menu_index(turn: Turn, store_id: int) -> Optional[MenuIndex]:
+    index = catalog.menu_indexes.get(store_id)
+    if index is not None:
+        return index
+
+    async def load():
+        menu = await db_async.load_store_menu(store_id)
+        if not menu:
+            return None
+        # Building the index of a large menu takes a while; keep the loop free meanwhile.
+        return catalog.remember_menu_index(store_id, await asyncio.to_thread(MenuIndex, store_id, menu))
+
+    return await _cached_read(turn, ("menu", store_id), load, catalog.last_good_menu(store_id), "fetch_store_menu")
+
+
+async def get_product_details(turn: Turn, item_id: int, store_id: Optional[int]) -> Dict[str, Any]:
+    details = catalog.product_details.get((store_id, item_id))
+    if details is not None:
+        return details
+
+    async def load():
+        return catalog.remember_details(item_id, store_id, await db_async.fetch_product_bundle(item_id, store_id))
+
+    details = await _cached_read(turn, ("details", (store_id, item_id)), load,
+                                 catalog.last_good_details(item_id, store_id), "get_product_details")
+    return details if details is not None else dict(catalog.EMPTY_DETAILS)
+
+
+async def get_user_name(user_id: int) -> str:
+    name = catalog.user_names.get(user_id)
+    if name is None:
+        name = await db_async.fetch_user_name(user_id)
+        catalog.user_names.put(user_id, name)
+    return name
+
+
+async def get_store_name(store_id: int) -> str:
+    name = catalog.store_names.get(store_id)
+    if name is None:
+        try:
+            name = await db_async.fetch_store_name(store_id)
+        except Exception as e:
+            print(f"Error fetching store name: {e}")
+            return "Store"
+        catalog.store_names.put(store_id, name)
+    return name
+
+
+def _background(awaitable: Awaitable[Any]) -> None:
+    """Starts a cache warm-up the turn does not wait for."""
+    asyncio.ensure_future(awaitable).add_done_callback(lambda f: f.cancelled() or f.exception())
+
+
+async def create_order_summary(turn: Turn, completed_items: list, store_id: int) -> dict:
+    item_ids = list({item['item_id'] for item in completed_items})
+    bundles = await asyncio.gather(*(get_product_details(turn, item_id, store_id) for item_id in item_ids))
+    return conversation.summarize_order(completed_items, dict(zip(item_ids, bundles)))
+
+
+# ─────────────────────────── ENDPOINTS ───────────────────────────
+async def start_conversation(turn: Turn, data: dict) -> Reply:
+    user_id = data.get('user_id')
+    store_id = data.get('store_id')
+
+    if not user_id or not store_id:
+        return 400, {"error": "user_id and store_id are required."}
+
+    session_id = str(uuid.uuid4())
+    turn.branch = "start"
+    session_cache.create(session_id, {
+        "user_id": user_id,
+        "store_id": store_id,
+        "status": "started",
+        "item_in_progress": None,
+        "completed_items": []
+    })
+
+    # Load the menu and match index while the greeting is being delivered.
+    _background(get_menu_index(Turn(), store_id))
+
+    user_name, store_name = await asyncio.gather(get_user_name(user_id), get_store_name(store_id))
+    return 200, {
+        "status": "success",
+        "session_id": session_id,
+        "assistant_response": conversation.greeting(user_name, store_name)
+    }
+
+
+async def start_item(turn: Turn, session_id: str, state: dict, item: dict) -> Reply:
+    details = await get_product_details(turn, item['item_id'], state['store_id'])
+    return 200, conversation.start_item(session_id, state, item, build_item_questions(details))
+
+
+async def confirm_order(turn: Turn, session_id: str, state: dict) -> Reply:
+    # Prices are re-read from the primary, never taken from cached or stale data.
+    if db.read_breaker.is_open():
+        return _busy("database: circuit open", retry_after=int(db.read_breaker.retry_after()) + 1)
+    try:
+        item_ids = list({item['item_id'] for item in state['completed_items']})
+        bundles = dict(zip(item_ids, await asyncio.gather(
+            *(db_async.fetch_product_bundle(item_id, state['store_id'], primary=True) for item_id in item_ids))))
+        rows = []
+        for item in state['completed_items']:
+            bundle = bundles[item['item_id']]
+            final_price, total_quantity = conversation.price_item(item, bundle)
+            rows.append(cart_row(state['user_id'], state['store_id'], item, total_quantity, final_price, item, 1,
+                                 bundle['attribute_id']))
+        if cart_journal.CART_WRITE_BEHIND:
+            await asyncio.to_thread(cart_journal.append, session_id, rows)
+        else:
+            await db_async.insert_cart_rows(rows)
+    except Exception as err:
+        print(f"Database error while confirming order: {err}")
+        return 500, {"status": "error", "message": f"Database error: {err}"}
+    turn.ended = True
+    return 200, conversation.confirmed_reply()
+
+
+def _busy(error: str, status: int = 503, retry_after: int = 1) -> Reply:
+    return status, {
+        "status": "busy",
+        "assistant_response": "We're a little busy right now. Please try again in a moment.",
+        "error": error,
+        "retry_after": retry_after,
+    }
+
+
+async def chat_step(turn: Turn, data: dict) -> Reply:
+    """Runs chat_turn on a copy of the session, committed with a version check (see session_store)."""
+    session_id = data.get('session_id')
+    user_input = data.get('user_input')
+
+    if not session_id or user_input is None:
+        return 400, {"error": "session_id and user_input are required."}
+
+    key = turn.idempotency_key
+    try:
+        # Turns of one session interleave at every await; they run one at a time.
+        async with session_cache.async_lock(session_id):
+            if key:
+                replayed = session_cache.replay(session_id, key, user_input)
+                if replayed is not None:
+                    turn.branch = "replay"
+                    return replayed[0], replayed[1]
+
+            checked_out = session_cache.checkout(session_id)
+            if checked_out is None:
+                return 404, {"error": "Invalid or expired session_id."}
+            version, state = checked_out
+
+            status, payload = await chat_turn(turn, session_id, state, user_input)
+            committed = (session_cache.delete(session_id, version) if turn.ended
+                         else session_cache.commit(session_id, version, state))
+            if not committed:
+                return _busy("session: changed by another turn", status=409)
+            if key and status < 500:
+                payload = payload if isinstance(payload, bytes) else fastjson.dumps(payload)
+                session_cache.remember(session_id, key, user_input, status, payload)
+            return status, payload
+    except session_store.KeyReused as err:
+        return 422, {"error": str(err)}
+    except session_store.SessionBusy as err:
+        return _busy(f"session: {err}", status=409)
+
+
+async def chat_turn(turn: Turn, session_id: str, state: dict, user_input: str) -> Reply:
+    """The conversation state machine of app.chat_turn; mutates ``state``."""
+    # A. If the API is waiting for the user to clarify an ambiguous item
+    if state.get('status') == 'clarification_needed':
+        turn.branch = "clarification"
+        clarification_options = state.get('clarification_options', [])
+        chosen_item = conversation.pick_clarification(user_input, clarification_options)
+        if not chosen_item:
+            return 200, conversation.clarification_reply(session_id, clarification_options, retry=True)
+        state['status'] = 'item_selected'
+        state.pop('clarification_options', None)
+        return await start_item(turn, session_id, state, chosen_item)
+
+    # B. If the API is waiting for final order confirmation
+    if state.get('status') == 'pending_confirmation':
+        turn.branch = "confirmation"
+        if parse_boolean_answer(user_input):
+            return await confirm_order(turn, session_id, state)
+        turn.ended = True
+        return 200, conversation.cancelled_reply()
+
+    # C. If we are asking questions for an item
+    if state.get('item_in_progress') and state.get('pending_questions'):
+        turn.branch = "question"
+        next_question = conversation.answer_question(session_id, state, user_input)
+        if next_question:
+            return 200, next_question
+        summary = await create_order_summary(turn, state['completed_items'], state['store_id'])
+        return 200, conversation.summary_reply(session_id, state, summary)
+
+    # D. If the user wants to end the order
+    if user_input.lower() in conversation.END_OF_ORDER:
+        turn.branch = "summary"
+        if not state['completed_items']:
+            return 200, conversation.empty_cart_reply()
+        summary = await create_order_summary(turn, state['completed_items'], state['store_id'])
+        return 200, conversation.summary_reply(session_id, state, summary)
+
+    # E. If we are waiting for a new item from the user
+    turn.branch = "new_item"
+    index = await get_menu_index(turn, state['store_id'])
+    if not user_input.strip():
+        return 200, conversation.menu_reply_body(session_id, index)
+
+    candidates = conversation.match_new_item(index, user_input)
+    if not candidates:
+        return 200, conversation.not_found_reply(user_input)
+    if len(candidates) == 1:
+        return await start_item(turn, session_id, state, candidates[0])
+
+    state['status'] = 'clarification_needed'
+    state['clarification_options'] = candidates
+    # Fetch the candidates' details while the user is choosing.
+    for item in candidates:
+        _background(get_product_details(Turn(), item['item_id'], state['store_id']))
+    return 200, conversation.clarification_reply(session_id, candidates)
+
+
+ROUTES: Dict[str, Callable[[Turn, dict], Awaitable[Reply]]] = {
+    "/api/v1/start-conversation": start_conversation,
+    "/api/v1/chat": chat_step,
+}
+
+
+# ─────────────────────────── ASGI ───────────────────────────
+async def _read_body(receive) -> Optional[bytes]:
+    """The request body, or None when it exceeds MAX_BODY_BYTES."""
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            return None
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def _send_json(send, status: int, payload: Union[Dict[str, Any], bytes],
+                     headers: List[Tuple[bytes, bytes]] = ()) -> None:
+    body = payload if isinstance(payload, bytes) else fastjson.dumps(payload)
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())] + list(headers),
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _handle(handler: Callable[[Turn, dict], Awaitable[Reply]], turn: Turn, body: bytes) -> Reply:
+    try:
+        data = fastjson.loads(body) if body else None
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return 400, {"error": "A JSON object body is required."}
+    try:
+        return await asyncio.wait_for(handler(turn, data), TURN_DEADLINE)
+    except asyncio.TimeoutError:
+        return 503, {
+            "status": "busy",
+            "assistant_response": "Sorry, that took too long. Please try again.",
+            "error": "turn deadline exceeded",
+            "retry_after": 1,
+        }
+    except Exception as err:
+        print(f"Unhandled error in {handler.__name__}: {err!r}")
+        return 500, {"error": "Internal server error."}
+
+
+def _header(scope, name: bytes) -> Optional[str]:
+    for key, value in scope.get("headers", []):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+async def _lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # Replays cart lines a previous run journaled but did not write.
+            if cart_journal.CART_WRITE_BEHIND:
+                cart_journal.get_journal()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await db_async.close_pool()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send) -> None:
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    handler = ROUTES.get(scope["path"])
+    if handler is None:
+        return await _send_json(send, 404, {"error": "Not found."})
+    if scope["method"] != "POST":
+        return await _send_json(send, 405, {"error": "Method not allowed."}, [(b"allow", b"POST")])
+
+    body = await _read_body(receive)
+    if body is None:
+        return await _send_json(send, 413, {"error": "Request body too large."})
+
+    turn = Turn(idempotency_key=_header(scope, b"idempotency-key"))
+    status, payload = await _handle(handler, turn, body)
+    headers = []
+    if turn.branch == "replay":
+        headers.append((b"idempotent-replayed", b"true"))
+    if status in (409, 503) and isinstance(payload, dict):
+        headers.append((b"retry-after", str(payload.get("retry_after", 1)).encode()))
+    if turn.stale:
+        # Built from last-known-good menu or product data, as in app.py.
+        headers.append((b"x-data-stale", b"1"))
+        if isinstance(payload, bytes):
+            payload = fastjson.with_fields(payload, stale=True)
+        else:
+            payload["stale"] = True
+    if EXPOSE_TURN_STATS:
+        headers.append((b"x-chat-branch", turn.branch.encode()))
+    await _send_json(send, status, payload, headers)
@@ -0,0 +1,406 @@
+"""
+End-to-end load test for the chat API.
+
+    # 1. seed a local SQLite stand-in with synthetic stores, products, options and add-ons
+    python bench/loadtest.py seed --db /tmp/sb_voice.sqlite3 --stores 20 --products 150
+
+    # 2. replay conversations against gunicorn started on that database with 4 workers
+    python bench/loadtest.py run --db /tmp/sb_voice.sqlite3 --spawn-workers 4 \
+        --conversations 500 --concurrency 32
+
+    # the same conversations against the asyncio mode (asgi_app.py under uvicorn)
+    python bench/loadtest.py run --db /tmp/sb_voice.sqlite3 --spawn-workers 4 --server uvicorn \
+        --conversations 500 --concurrency 32
+
+    # or against an already running server, replaying recorded conversations
+    python bench/loadtest.py run --base-url http://127.0.0.1:5000 --script recorded.jsonl
+
+A script is a JSON-lines file with one conversation per line, either
+{"user_id": 1, "store_id": 3, "turns": ["one chicken biryani", "2 half", "yes", ...]}
+replayed verbatim, or {"user_id": 1, "store_id": 3, "items": ["chicken biryani", "coke"]}
+where follow-up questions are answered automatically.
+
+Sessions live in each worker's memory, so multi-worker runs rely on HTTP keep-alive
+(gthread workers, --threads > 1, or uvicorn) to keep a conversation on the worker
+that started it.
+
+Per-turn branch and DB query counts come from the X-Chat-Branch / X-DB-Queries
+headers the app adds when EXPOSE_TURN_STATS=1 (set automatically with --spawn-workers);
+the asyncio mode reports branches only.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import subprocess
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db_sqlite  # noqa: E402
+
+DISHES = [
+    "Chicken Biryani", "Mutton Biryani", "Veg Biryani", "Egg Biryani", "Paneer Tikka", "Paneer Butter Masala",
+    "Butter Chicken", "Chicken Tikka", "Dal Makhani", "Dal Tadka", "Masala Dosa", "Plain Dosa", "Idli Sambar",
+    "Vada Pav", "Pav Bhaji", "Chole Bhature", "Aloo Paratha", "Gobi Manchurian", "Veg Fried Rice",
+    "Chicken Fried Rice", "Hakka Noodles", "Margherita Pizza", "Farmhouse Pizza", "Veg Burger",
+    "Chicken Burger", "French Fries", "Gulab Jamun", "Rasmalai", "Mango Lassi", "Masala Chai", "Cold Coffee",
+    "Coke", "Lime Soda", "Tandoori Roti", "Butter Naan", "Garlic Naan", "Jeera Rice", "Fish Curry",
+    "Prawn Masala", "Chicken Shawarma",
+]
+STYLES = ["", "Special", "Spicy", "Classic", "Jumbo", "Hyderabadi", "Kolkata", "Mini", "Family"]
+SIZES = [["Half", "Full"], ["Small", "Medium", "Large"], ["Regular", "Large"]]
+ADDONS = [("Raita", 20), ("Extra Cheese", 30), ("Salan", 15), ("Papad", 10), ("Gravy", 25)]
+NUMBER_WORDS = ["one", "two", "three"]
+
+
+# ──────────────────────────── SEED ────────────────────────────
+def seed(path: str, stores: int, products: int, users: int, carts: int, seed_value: int) -> None:
+    rng = random.Random(seed_value)
+    if os.path.exists(path):
+        os.remove(path)
+    db_sqlite.create_schema(path)
+    conn = db_sqlite.connect(path)
+    cur = conn.cursor()
+    conn.start_transaction()
+
+    cur.executemany("INSERT INTO tbl_user (id, name, ustatus) VALUES (%s, %s, 1)",
+                    [(uid, f"User {uid}") for uid in range(1, users + 1)])
+    cur.executemany("INSERT INTO tbl_mcat (id, title) VALUES (%s, %s)", [(1, "Food"), (2, "Drinks")])
+    cur.executemany("INSERT INTO tbl_mcat_sub (sub_id, sub_name, mcat_id) VALUES (%s, %s, %s)",
+                    [(1, "Mains", 1), (2, "Beverages", 2)])
+
+    product_id = option_id = addon_id = attribute_id = 0
+    store_products: Dict[int, List[int]] = {}
+    for store_id in range(1, stores + 1):
+        cur.execute("INSERT INTO service_details (id, title, status) VALUES (%s, %s, 1)", (store_id, f"Store {store_id}"))
+        names = set()
+        while len(names) < min(products, len(DISHES) * len(STYLES)):
+            names.add(f"{rng.choice(STYLES)} {rng.choice(DISHES)}".strip())
+        store_products[store_id] = []
+        for name in sorted(names):
+            product_id += 1
+            store_products[store_id].append(product_id)
+            cur.execute("INSERT INTO tbl_product (id, title, description, status, store_id, cat_id) VALUES (%s, %s, %s, 1, %s, %s)",
+                        (product_id, name, f"Freshly made {name.lower()}.", store_id, rng.choice([1, 2])))
+            base = rng.randrange(40, 400, 10)
+            for title in rng.sample(["Half", "Full", "Regular"], rng.choice([1, 1, 2])):
+                attribute_id += 1
+                cur.execute("INSERT INTO tbl_product_attribute (id, product_id, store_id, title, normal_price, discount) VALUES (%s, %s, %s, %s, %s, %s)",
+                            (attribute_id, product_id, store_id, json.dumps([title]), base, rng.choice([0, 0, 5, 10])))
+            if rng.random() < 0.6:
+                option_id += 1
+                values = [{"name": size, "price": base + 40 * i} for i, size in enumerate(rng.choice(SIZES))]
+                cur.execute("INSERT INTO tbl_product_options (id, product_id, option_name, option_values, is_required, max_selections, status) VALUES (%s, %s, %s, %s, 1, 1, 1)",
+                            (option_id, product_id, "size", json.dumps(values)))
+            for addon_name, addon_price in rng.sample(ADDONS, rng.choice([0, 0, 1, 2])):
+                addon_id += 1
+                cur.execute("INSERT INTO tbl_product_addons (id, product_id, addon_name, addon_price, addon_category, is_required, status) VALUES (%s, %s, %s, %s, 'extra', 0, 1)",
+                            (addon_id, product_id, addon_name, addon_price))
+                # The voice CLI asks add-on questions from menu_questions.
+                cur.execute("INSERT INTO menu_questions (item_id, question_text, question_type, required, sort_order) VALUES (%s, %s, 'boolean', 0, %s)",
+                            (product_id, f"Would you like to add {addon_name}?", addon_id))
+
+    # Order history so popularity-based warm-ups have something to rank.
+    rows = []
+    for _ in range(carts):
+        store_id = rng.randint(1, stores)
+        pid = rng.choice(store_products[store_id][: max(3, len(store_products[store_id]) // 5)])
+        rows.append((rng.randint(1, users), store_id, pid, 0, 1, 100, "", "", "normal", None, 1, None))
+    cur.executemany("""
+        INSERT INTO tbl_cart_data (uid, store_id, product_id, attribute_id, quantity, price, product_title,
+                                   product_img, cart_type, variation, visible, subscription_data)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """, rows)
+    conn.commit()
+    conn.close()
+    print(f"Seeded {path}: {stores} stores, {product_id} products, {option_id} option groups, "
+          f"{addon_id} add-ons, {users} users, {carts} cart rows")
+
+
+def generate_script(path: str, conversations: int, seed_value: int) -> List[Dict[str, Any]]:
+    """Adaptive conversations over products that exist in the seeded database."""
+    rng = random.Random(seed_value)
+    conn = db_sqlite.connect(path)
+    cur = conn.cursor(dictionary=True)
+    cur.execute("SELECT id, title, store_id FROM tbl_product WHERE status = 1")
+    by_store: Dict[int, List[str]] = defaultdict(list)
+    for row in cur.fetchall():
+        by_store[row["store_id"]].append(row["title"])
+    cur.execute("SELECT MAX(id) AS n FROM tbl_user")
+    users = cur.fetchone()["n"] or 1
+    conn.close()
+
+    stores = sorted(by_store)
+    # A few popular stores get most of the traffic, as during lunch hour.
+    weights = [1.0 / (rank + 1) for rank in range(len(stores))]
+    script = []
+    for _ in range(conversations):
+        store_id = rng.choices(stores, weights)[0]
+        names = by_store[store_id]
+        items = []
+        for name in rng.sample(names, min(len(names), rng.choice([1, 1, 2]))):
+            spoken = name.lower()
+            if rng.random() < 0.3:
+                spoken = spoken.split()[-1]  # a vaguer request, likely to need clarification
+            items.append(f"{rng.choice(NUMBER_WORDS)} {spoken}")
+        script.append({"user_id": rng.randint(1, users), "store_id": store_id, "items": items})
+    return script
+
+
+# ──────────────────────── CONVERSATIONS ────────────────────────
+def _answer(reply: Dict[str, Any], rng: random.Random) -> Optional[str]:
+    """A plausible user reply to a follow-up question, or None when the assistant wants a new item."""
+    status = reply.get("status")
+    text = reply.get("assistant_response", "")
+    if status == "question":
+        if text.startswith("Please select"):
+            choices = re.findall(r"([A-Za-z][\w ]*?) \(₹", text.split("Options are:", 1)[-1])
+            return f"{rng.choice(NUMBER_WORDS)} {rng.choice(choices)}" if choices else "one"
+        return rng.choice(["yes", "no"])
+    if status == "clarification_needed":
+        return str(rng.randint(1, max(1, len(reply.get("options", [])))))
+    if status == "pending_confirmation":
+        return "yes"
+    return None
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.queries: Dict[str, List[int]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.turns = 0
+
+    def record(self, response: Optional[requests.Response], elapsed: float, fallback_branch: str) -> None:
+        with self.lock:
+            self.turns += 1
+            if response is None:
+                self.errors["connection"] += 1
+                return
+            branch = response.headers.get("X-Chat-Branch") or fallback_branch
+            self.latencies[branch].append(elapsed)
+            if "X-DB-Queries" in response.headers:
+                self.queries[branch].append(int(response.headers["X-DB-Queries"]))
+            if response.status_code >= 400:
+                self.errors[str(response.status_code)] += 1
+
+
+def _post(session: requests.Session, url: str, body: Dict[str, Any], recorder: Recorder, branch: str) -> Optional[Dict[str, Any]]:
+    started = time.perf_counter()
+    try:
+        response = session.post(url, json=body, timeout=30)
+    except requests.RequestException:
+        recorder.record(None, time.perf_counter() - started, branch)
+        return None
+    recorder.record(response, time.perf_counter() - started, branch)
+    try:
+        return response.json()
+    except ValueError:
+        return None
+
+
+_sessions = threading.local()
+
+
+def run_conversation(base_url: str, convo: Dict[str, Any], recorder: Recorder, rng_seed: int) -> None:
+    session = getattr(_sessions, "session", None)
+    if session is None:
+        session = _sessions.session = requests.Session()
+    rng = random.Random(rng_seed)
+
+    start = _post(session, f"{base_url}/api/v1/start-conversation",
+                  {"user_id": convo["user_id"], "store_id": convo["store_id"]}, recorder, "start")
+    if not start or "session_id" not in start:
+        return
+    sid = start["session_id"]
+    chat_url = f"{base_url}/api/v1/chat"
+
+    if "turns" in convo:
+        for text in convo["turns"]:
+            if _post(session, chat_url, {"session_id": sid, "user_input": text}, recorder, "chat") is None:
+                return
+        return
+
+    for item in convo["items"]:
+        reply = _post(session, chat_url, {"session_id": sid, "user_input": item}, recorder, "chat")
+        # Follow-ups (options, add-ons, clarification) until the item is done; bounded in case of loops.
+        for _ in range(8):
+            answer = _answer(reply or {}, rng)
+            if answer is None or reply.get("status") == "pending_confirmation":
+                break
+            reply = _post(session, chat_url, {"session_id": sid, "user_input": answer}, recorder, "chat")
+        if reply and reply.get("status") == "pending_confirmation":
+            break
+    else:
+        reply = _post(session, chat_url, {"session_id": sid, "user_input": "that's all"}, recorder, "chat")
+    if reply and reply.get("status") == "pending_confirmation":
+        _post(session, chat_url, {"session_id": sid, "user_input": "yes"}, recorder, "chat")
+
+
+# ─────────────────────────── REPORT ───────────────────────────
+def _percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def report(recorder: Recorder, wall: float, conversations: int) -> Dict[str, Any]:
+    branches = {}
+    for branch, values in sorted(recorder.latencies.items()):
+        queries = recorder.queries.get(branch, [])
+        branches[branch] = {
+            "count": len(values),
+            "p50_ms": round(_percentile(values, 50) * 1000, 2),
+            "p95_ms": round(_percentile(values, 95) * 1000, 2),
+            "p99_ms": round(_percentile(values, 99) * 1000, 2),
+            "max_ms": round(max(values) * 1000, 2),
+            "db_queries_mean": round(sum(queries) / len(queries), 2) if queries else None,
+            "db_queries_max": max(queries) if queries else None,
+        }
+    return {
+        "conversations": conversations,
+        "turns": recorder.turns,
+        "wall_s": round(wall, 3),
+        "turns_per_s": round(recorder.turns / wall, 1) if wall else 0.0,
+        "conversations_per_s": round(conversations / wall, 1) if wall else 0.0,
+        "errors": dict(recorder.errors),
+        "branches": branches,
+    }
+
+
+def print_report(result: Dict[str, Any]) -> None:
+    print(f"\n{result['conversations']} conversations, {result['turns']} turns in {result['wall_s']}s "
+          f"→ {result['turns_per_s']} turns/s, {result['conversations_per_s']} conversations/s")
+    if result["errors"]:
+        print(f"errors: {result['errors']}")
+    print(f"\n{'branch':<14}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'q/turn':>9}{'q max':>7}")
+    for branch, row in result["branches"].items():
+        mean_q = "-" if row["db_queries_mean"] is None else row["db_queries_mean"]
+        max_q = "-" if row["db_queries_max"] is None else row["db_queries_max"]
+        print(f"{branch:<14}{row['count']:>8}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}"
+              f"{row['max_ms']:>10}{mean_q:>9}{max_q:>7}")
+
+
+# ─────────────────────────── SERVER ───────────────────────────
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def spawn_server(server: str, db_path: str, workers: int, threads: int,
+                 extra_env: Dict[str, str]) -> Tuple[subprocess.Popen, str]:
+    """Starts app.py under gunicorn or asgi_app.py under uvicorn on the seeded database."""
+    port = _free_port()
+    env = dict(os.environ, DB_BACKEND="sqlite", DB_SQLITE_PATH=os.path.abspath(db_path), EXPOSE_TURN_STATS="1", **extra_env)
+    if server == "uvicorn":
+        command = [sys.executable, "-m", "uvicorn", "--workers", str(workers), "--host", "127.0.0.1",
+                   "--port", str(port), "--log-level", "warning", "--no-access-log", "asgi_app:app"]
+    else:
+        command = [sys.executable, "-m", "gunicorn", "-w", str(workers), "--threads", str(threads),
+                   "-b", f"127.0.0.1:{port}", "--log-level", "warning", "app:app"]
+    proc = subprocess.Popen(command, cwd=ROOT, env=env)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{server} exited during start-up")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return proc, base_url
+        except OSError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError(f"{server} did not start listening within 30s")
+
+
+def load_script(path: str) -> List[Dict[str, Any]]:
+    with open(path, encoding="utf-8") as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_seed = sub.add_parser("seed", help="create a synthetic SQLite database")
+    p_seed.add_argument("--db", required=True)
+    p_seed.add_argument("--stores", type=int, default=20)
+    p_seed.add_argument("--products", type=int, default=120, help="products per store")
+    p_seed.add_argument("--users", type=int, default=1000)
+    p_seed.add_argument("--carts", type=int, default=20000, help="historical cart rows")
+    p_seed.add_argument("--seed", type=int, default=7)
+
+    p_run = sub.add_parser("run", help="replay conversations against the chat API")
+    target = p_run.add_mutually_exclusive_group(required=True)
+    target.add_argument("--base-url", help="an already running server")
+    target.add_argument("--spawn-workers", type=int, help="start the server with N workers on --db")
+    p_run.add_argument("--server", choices=["gunicorn", "uvicorn"], default="gunicorn",
+                       help="spawned server: the Flask app under gunicorn or the asyncio app under uvicorn")
+    p_run.add_argument("--threads", type=int, default=2,
+                       help="gunicorn threads per worker; >1 selects the gthread worker, whose keep-alive "
+                            "keeps each client on one worker (sessions live in worker memory)")
+    p_run.add_argument("--db", help="seeded SQLite database (for --spawn-workers and generated scripts)")
+    p_run.add_argument("--script", help="JSON-lines conversations to replay instead of generated ones")
+    p_run.add_argument("--conversations", type=int, default=200)
+    p_run.add_argument("--concurrency", type=int, default=16)
+    p_run.add_argument("--seed", type=int, default=11)
+    p_run.add_argument("--json", help="also write the report to this file")
+    p_run.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                       help="extra environment for the spawned server (repeatable)")
+
+    args = parser.parse_args()
+    if args.command == "seed":
+        seed(args.db, args.stores, args.products, args.users, args.carts, args.seed)
+        return
+
+    if args.script:
+        script = load_script(args.script)
+    elif args.db:
+        script = generate_script(args.db, args.conversations, args.seed)
+    else:
+        parser.error("run needs --script or --db")
+    if args.spawn_workers and not args.db:
+        parser.error("--spawn-workers needs --db")
+
+    proc = None
+    base_url = args.base_url
+    if args.spawn_workers:
+        extra_env = dict(item.split("=", 1) for item in args.env)
+        proc, base_url = spawn_server(args.server, args.db, args.spawn_workers, args.threads, extra_env)
+    base_url = base_url.rstrip("/")
+
+    recorder = Recorder()
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(lambda pair: run_conversation(base_url, pair[1], recorder, args.seed + pair[0]),
+                          enumerate(script)))
+        wall = time.perf_counter() - started
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait(timeout=10)
+
+    result = report(recorder, wall, len(script))
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump(result, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
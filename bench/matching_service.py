@@ -0,0 +1,160 @@
+"""
+Measures fuzzy-matching throughput on a huge synthetic menu, in-process versus
+through the match service at increasing worker counts.
+
+Client threads send misspelled item names (or, with --batch, multi-item orders)
+through matching.extract / extract_batch the way MenuIndex does; the result cache
+is disabled so every query is scored. For each mode it prints queries per second,
+latency, and how late a 5 ms heartbeat thread wakes up, a stand-in for how
+responsive the web worker's other requests stay while matching runs.
+
+    python bench/matching_service.py --items 20000 --queries 2000
+    python bench/matching_service.py --workers 0,1,2,4,8 --clients 16 --batch 3 --json
+
+Throughput only scales up to the number of physical cores; worker counts above it
+are still run, to show where it flattens.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from loadtest import DISHES, STYLES, _percentile  # noqa: E402
+from rapidfuzz.utils import default_process  # noqa: E402
+
+from cache import LRUCache  # noqa: E402
+import matching  # noqa: E402
+import match_service  # noqa: E402
+
+VARIANTS = ["", "Combo", "Thali", "Platter", "Bowl", "Roll", "Wrap", "Box", "Meal", "Half", "Full",
+            "Regular", "Large", "Party Pack", "with Raita", "with Salad", "Extra Cheese", "No Onion"]
+
+
+def build_menu(items: int, rng: random.Random) -> List[str]:
+    names = set()
+    while len(names) < items:
+        name = f"{rng.choice(STYLES)} {rng.choice(DISHES)} {rng.choice(VARIANTS)}"
+        if rng.random() < 0.5:
+            name += f" {rng.randint(1, 999)}"
+        names.add(" ".join(name.split()))
+    return sorted(names)
+
+
+def misspell(name: str, rng: random.Random) -> str:
+    """The name as speech recognition might return it: lower case, one word with a dropped or swapped letter."""
+    words = name.lower().split()
+    pos = rng.randrange(len(words))
+    word = words[pos]
+    if len(word) > 3:
+        cut = rng.randrange(1, len(word) - 1)
+        word = word[:cut] + word[cut + 1:] if rng.random() < 0.5 else word[:cut - 1] + word[cut] + word[cut - 1] + word[cut + 1:]
+    words[pos] = word
+    return " ".join(words)
+
+
+def run(mode: str, calls: List[List[str]], processed: List[str], clients: int) -> Dict[str, Any]:
+    latencies: List[float] = []
+    lags: List[float] = []
+    stop = threading.Event()
+
+    def heartbeat() -> None:
+        while not stop.is_set():
+            started = time.perf_counter()
+            time.sleep(0.005)
+            lags.append(time.perf_counter() - started - 0.005)
+
+    def one(queries: List[str]) -> None:
+        started = time.perf_counter()
+        if len(queries) == 1:
+            matching.extract("bench", "v1", "menu_unique", queries[0], processed, limit=5, preprocessed=True)
+        else:
+            matching.extract_batch("bench", "v1", "menu_unique", queries, processed, limit=5, preprocessed=True)
+        latencies.append(time.perf_counter() - started)
+
+    beat = threading.Thread(target=heartbeat, daemon=True)
+    beat.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(one, calls))
+    wall = time.perf_counter() - started
+    stop.set()
+    beat.join()
+
+    queries = sum(len(c) for c in calls)
+    return {"mode": mode, "queries": queries, "seconds": round(wall, 3), "qps": round(queries / wall, 1),
+            "p50_ms": round(_percentile(latencies, 50) * 1000, 2), "p95_ms": round(_percentile(latencies, 95) * 1000, 2),
+            "lag_p95_ms": round(_percentile(lags, 95) * 1000, 2), "lag_max_ms": round(max(lags, default=0) * 1000, 2)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=20000, help="menu size")
+    parser.add_argument("--queries", type=int, default=2000, help="utterances scored per mode")
+    parser.add_argument("--batch", type=int, default=1, help="utterances per call (a multi-item order)")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent request threads")
+    parser.add_argument("--workers", default=None,
+                        help="comma-separated service sizes, 0 = in-process (default: 0,1,2,4.. up to the core count)")
+    parser.add_argument("--seed", type=int, default=11)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    if args.workers:
+        sizes = [int(w) for w in args.workers.split(",")]
+    else:
+        sizes = [0] + sorted({min(2 ** i, cores) for i in range(cores.bit_length() + 1)})
+
+    rng = random.Random(args.seed)
+    names = build_menu(args.items, rng)
+    processed = [default_process(name) for name in names]
+    utterances = [misspell(rng.choice(names), rng) for _ in range(args.queries)]
+    calls = [utterances[i:i + args.batch] for i in range(0, len(utterances), args.batch)]
+
+    # Every query is scored, not answered from the result cache.
+    matching.match_cache = LRUCache(1)
+    match_service.MATCH_SERVICE_MIN_CHOICES = 0
+
+    results = []
+    for workers in sizes:
+        if workers == 0:
+            match_service.stop()
+            results.append(run("in-process", calls, processed, args.clients))
+            continue
+        service = match_service.start(workers)
+        # Ship the menu to every worker before timing; one load each.
+        started = time.perf_counter()
+        run("warm-up", calls[:workers * 4], processed, workers * 4)
+        result = run(f"service x{workers}", calls, processed, args.clients)
+        result["warm_up_s"] = round(time.perf_counter() - started - result["seconds"], 3)
+        result["service"] = service.stats()
+        results.append(result)
+    match_service.stop()
+
+    base = next((r["qps"] for r in results if r["mode"] == "in-process"), results[0]["qps"])
+    for result in results:
+        result["speedup"] = round(result["qps"] / base, 2)
+
+    if args.json:
+        print(json.dumps({"items": args.items, "batch": args.batch, "clients": args.clients, "cores": cores,
+                          "results": results}, indent=2))
+        return
+    print(f"\n{args.items} names, {args.queries} utterances in calls of {args.batch}, "
+          f"{args.clients} clients, {cores} cores")
+    print(f"\n{'mode':<14}{'q/s':>9}{'speedup':>9}{'p50 ms':>9}{'p95 ms':>9}{'lag p95':>9}{'lag max':>9}")
+    for r in results:
+        print(f"{r['mode']:<14}{r['qps']:>9}{r['speedup']:>9}{r['p50_ms']:>9}{r['p95_ms']:>9}"
+              f"{r['lag_p95_ms']:>9}{r['lag_max_ms']:>9}")
+    if cores == 1:
+        print("\nOne core: the service can only add IPC overhead here; run on a multi-core host to see scaling.")
+
+
+if __name__ == "__main__":
+    main()
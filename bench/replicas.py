@@ -0,0 +1,113 @@
+"""
+Checks read routing across the primary and its replicas.
+
+Fires product, menu and popularity reads through db.get_read_connection from a few
+threads, then prints where they went and how each replica's health evolved.
+
+    # two local MySQL-compatible servers holding the same data, e.g.
+    #   docker run -d -p 3306:3306 -e MYSQL_ROOT_PASSWORD=pw -e MYSQL_DATABASE=sb mariadb:11
+    #   docker run -d -p 3307:3306 -e MYSQL_ROOT_PASSWORD=pw -e MYSQL_DATABASE=sb mariadb:11
+    # loaded from one dump (replication is not needed to check routing)
+    DB_HOST=127.0.0.1 DB_USER=root DB_PASSWORD=pw DB_NAME=sb DB_REPLICA_HOSTS=127.0.0.1:3307 \
+        python bench/replicas.py --reads 5000
+
+    # SQLite stand-in: copies of a seeded database act as replicas
+    python bench/loadtest.py seed --db /tmp/sb_voice.sqlite3
+    python bench/replicas.py --db /tmp/sb_voice.sqlite3 --copies 2
+
+Stop or slow down a replica while it runs: its breaker opens after
+DB_BREAKER_FAILURES bad reads and the others (or the primary) take its share until
+a trial read succeeds again.
+"""
+import os
+import sys
+import time
+import shutil
+import random
+import argparse
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", help="seeded SQLite database to use as the primary")
+    parser.add_argument("--copies", type=int, default=2, help="with --db: replicas made by copying it")
+    parser.add_argument("--reads", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.db:
+        copies = []
+        for i in range(args.copies):
+            copy = f"{args.db}.replica{i}"
+            shutil.copyfile(args.db, copy)
+            copies.append(os.path.abspath(copy))
+        # Read by db.py at import.
+        os.environ.update(DB_BACKEND="sqlite", DB_SQLITE_PATH=os.path.abspath(args.db),
+                          DB_REPLICA_HOSTS=",".join(copies))
+
+    import db
+    import catalog
+    from ordering import load_store_menu
+
+    if not db.replicas:
+        parser.error("no replicas: set DB_REPLICA_HOSTS, or use --db")
+
+    conn = db.get_connection()
+    with conn.cursor(dictionary=True) as cur:
+        cur.execute("SELECT id, store_id FROM tbl_product WHERE status = 1")
+        products = [(row["id"], row["store_id"]) for row in cur.fetchall()]
+    conn.close()
+    rng = random.Random(args.seed)
+    work = [rng.choice(products) for _ in range(args.reads)]
+
+    routed: Counter = Counter()
+    errors: Counter = Counter()
+    lock = threading.Lock()
+
+    def read(product: tuple) -> None:
+        item_id, store_id = product
+        conn = db.get_read_connection()
+        host = conn.replica.name if conn.replica else "primary"
+        try:
+            kind = rng.random()
+            if kind < 0.7:
+                db.fetch_product_bundle(conn, item_id, store_id)
+            elif kind < 0.9:
+                catalog.fetch_top_product_ids(conn, store_id, 10)
+            else:
+                load_store_menu(conn, store_id)
+        except Exception as err:
+            with lock:
+                errors[(host, type(err).__name__)] += 1
+        finally:
+            conn.close()
+        with lock:
+            routed[host] += 1
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(read, work))
+    wall = time.monotonic() - started
+
+    print(f"\n{args.reads} reads in {wall:.2f}s ({args.reads / wall:.0f}/s)")
+    print(f"\n{'host':<40}{'reads':>8}{'share':>8}")
+    for host, count in routed.most_common():
+        print(f"{host:<40}{count:>8}{count / args.reads:>8.0%}")
+    print(f"\n{'replica':<40}{'latency ms':>12}{'weight':>9}{'breaker':>11}{'opened':>8}")
+    for row in db.replica_stats():
+        print(f"{row['replica']:<40}{row['latency_ms']:>12}{row['weight']:>9}{row['state']:>11}{row['times_opened']:>8}")
+    if errors:
+        print("\nerrors:")
+        for (host, kind), count in errors.most_common():
+            print(f"  {host}: {count} x {kind}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Import time and memory of the modules a process loads at startup.
+
+    # what each gunicorn worker pays for `app`, next to the voice CLI
+    python bench/startup.py
+
+    # before/after a change: check the old revision out next to this one
+    git worktree add /tmp/sb_voice_before <rev>
+    python bench/startup.py --tree /tmp/sb_voice_before --tree . --module app
+
+Every measurement runs in a fresh interpreter. RSS is read after the import, and
+the interpreter's own RSS before it is reported separately, so "import MB" is
+what the module graph adds to every worker.
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+from typing import List, Dict, Any
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+AUDIO_MODULES = ["speech_recognition", "gtts", "playsound"]
+
+PROBE = r"""
+import sys, time, json
+def rss_mb():
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+base = rss_mb()
+started = time.perf_counter()
+__import__(sys.argv[1])
+elapsed = time.perf_counter() - started
+print(json.dumps({
+    "import_ms": elapsed * 1000,
+    "base_mb": base,
+    "rss_mb": rss_mb(),
+    "modules": len(sys.modules),
+    "audio": sorted(m for m in json.loads(sys.argv[2]) if m in sys.modules),
+}))
+"""
+
+
+def measure(tree: str, module: str) -> Dict[str, Any]:
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    out = subprocess.run([sys.executable, "-c", PROBE, module, json.dumps(AUDIO_MODULES)],
+                         cwd=tree, env=env, capture_output=True, text=True)
+    if out.returncode != 0:
+        raise RuntimeError(f"importing {module} in {tree} failed:\n{out.stderr.strip()}")
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def run(trees: List[str], modules: List[str], repeat: int) -> List[Dict[str, Any]]:
+    rows = []
+    for tree in trees:
+        for module in modules:
+            # The first run warms the bytecode and OS file caches and is not counted.
+            measure(tree, module)
+            samples = [measure(tree, module) for _ in range(repeat)]
+            rss = statistics.median(s["rss_mb"] for s in samples)
+            base = statistics.median(s["base_mb"] for s in samples)
+            rows.append({
+                "tree": tree,
+                "module": module,
+                "import_ms": round(statistics.median(s["import_ms"] for s in samples), 1),
+                "rss_mb": round(rss, 1),
+                "import_mb": round(rss - base, 1),
+                "modules": samples[-1]["modules"],
+                "audio": samples[-1]["audio"],
+            })
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tree", action="append", help="checkout to measure (repeatable, default: this one)")
+    parser.add_argument("--module", action="append", help="module to import (repeatable, default: app and Final)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="print rows as JSON")
+    args = parser.parse_args()
+
+    trees = [os.path.abspath(t) for t in (args.tree or [ROOT])]
+    rows = run(trees, args.module or ["app", "Final"], args.repeat)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+
+    print(f"{'tree':<32} {'module':<10} {'import ms':>10} {'RSS MB':>8} {'import MB':>10} {'modules':>8}  audio")
+    for r in rows:
+        print(f"{r['tree'][-32:]:<32} {r['module']:<10} {r['import_ms']:>10} {r['rss_mb']:>8} "
+              f"{r['import_mb']:>10} {r['modules']:>8}  {', '.join(r['audio']) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+"""
+Offline benchmark of the voice ordering path in Final.py.
+
+    # 1. a SQLite stand-in to order from (see bench/loadtest.py)
+    python bench/loadtest.py seed --db /tmp/sb_voice.sqlite3 --stores 5
+
+    # 2. every order in the manifest, five times, with per-stage latency
+    python bench/voice_pipeline.py --db /tmp/sb_voice.sqlite3 --repeat 5
+
+    # against MySQL (DB_* from .env), with per-order rows and a JSON report
+    python bench/voice_pipeline.py --per-order --json voice.json
+
+Each order runs handle_store_assistant end to end: listen -> parsing ->
+ask_dynamic_questions -> summary and confirmation -> cart. The microphone is
+replaced by WAV fixtures read through speech_recognition.AudioFile, Google by a
+local recognizer, and gTTS/playsound by a null sink. Calibration and capture run
+the real speech_recognition code over the recorded audio.
+
+Fixtures are listed in bench/fixtures/voice/manifest.json by kind. Each prompt the
+assistant speaks is answered with the next fixture of the matching kind: an
+order, an option ("Please select your size", answered with a fixture naming one of
+the listed options), a quantity, a choice from a numbered list, a yes/no add-on
+answer or the order confirmation. A fixture marked "recognized": false is one the
+recognizer fails on, so the typed fallback is taken, as with a bad microphone.
+Fixtures whose WAV file is missing are synthesized as speech-like placeholders
+(tone bursts with the given noise_db signal-to-noise ratio); drop recordings in
+next to the manifest, named <fixture>.wav, to measure real audio.
+
+--recognizer sphinx transcribes the audio with CMU Sphinx (pip install
+pocketsphinx) instead of returning the manifest's text, for recorded fixtures.
+
+Audio is read from files faster than real time, so "audio s" is reported next to
+the wall time: a microphone adds roughly that much per order on top.
+"""
+import io
+import os
+import sys
+import json
+import math
+import time
+import wave
+import zlib
+import random
+import tempfile
+import argparse
+import threading
+from array import array
+from collections import defaultdict
+from contextlib import redirect_stdout
+from typing import Any, Callable, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from loadtest import _percentile  # noqa: E402
+
+MANIFEST = os.path.join(ROOT, "bench", "fixtures", "voice", "manifest.json")
+STAGES = ["calibration", "capture", "recognition", "parsing", "db", "synthesis"]
+SAMPLE_RATE = 16000
+
+# What the assistant asks -> the kind of fixture that answers it, first match wins.
+PROMPT_KINDS = [
+    ("say the number", "choice"),
+    ("select your", "option"),
+    ("what quantity", "quantity"),
+    ("(yes or no)", "yes_no"),
+    ("confirm this order", "confirm"),
+    ("what would you like to eat", "order"),
+    ("what we have on the menu", "order"),
+]
+
+# Final.py names wrapped into the parsing and db stages.
+PARSING_CALLS = ["_parse_free_form_order", "_parse_multi_sizes", "extract_quantity", "normalize_choice",
+                 "fuzzy_match_item"]
+DB_CALLS = ["get_db_connection", "get_user_name", "fetch_store_menu", "fetch_product_details",
+            "fetch_menu_questions", "add_to_cart", "_take_item_plan"]
+
+
+# ─────────────────────────── FIXTURES ───────────────────────────
+def synthesize(path: str, text: str, noise_db: Optional[float], seed: str) -> None:
+    """
+    A speech-like placeholder: 1.5 s of room tone (calibration listens to the first second),
+    a harmonic burst about as long as saying ``text``, then 1 s of silence to end
+    the phrase. ``noise_db`` adds white noise at that signal-to-noise ratio.
+    """
+    rng = random.Random(seed)
+    lead, tail = 1.5, 1.0
+    spoken = 0.4 + 0.06 * len(text)
+    amplitude, floor = 6000.0, 40.0
+    # The burst's RMS is about 0.28 of its peak amplitude.
+    noise = 0.28 * amplitude / (10 ** (noise_db / 20)) if noise_db is not None else 0.0
+    total = int((lead + spoken + tail) * SAMPLE_RATE)
+    samples = array("h")
+    for i in range(total):
+        t = i / SAMPLE_RATE
+        x = rng.gauss(0.0, floor)
+        if lead <= t < lead + spoken:
+            envelope = 0.55 + 0.45 * math.sin(2 * math.pi * 4 * t)
+            f0 = 140 + 20 * math.sin(2 * math.pi * 0.7 * t)
+            x += amplitude * envelope * (math.sin(2 * math.pi * f0 * t) + 0.5 * math.sin(4 * math.pi * f0 * t)
+                                         + 0.25 * math.sin(6 * math.pi * f0 * t)) / 1.75
+        if noise:
+            x += rng.gauss(0.0, noise)
+        samples.append(max(-32768, min(32767, int(x))))
+    with wave.open(path, "wb") as out:
+        out.setnchannels(1)
+        out.setsampwidth(2)
+        out.setframerate(SAMPLE_RATE)
+        out.writeframes(samples.tobytes())
+
+
+def wav_seconds(path: str) -> float:
+    with wave.open(path, "rb") as w:
+        return w.getnframes() / w.getframerate()
+
+
+def load_manifest(path: str) -> Dict[str, Any]:
+    """The manifest with every fixture's ``wav`` resolved; missing recordings are synthesized."""
+    with open(path, encoding="utf-8") as fh:
+        manifest = json.load(fh)
+    base = os.path.dirname(os.path.abspath(path))
+    synth_dir = os.path.join(tempfile.gettempdir(), "sb_voice_fixtures")
+    synthesized = 0
+    for name, fixture in manifest["fixtures"].items():
+        fixture["name"] = name
+        fixture.setdefault("recognized", True)
+        wav = os.path.join(base, fixture.get("wav", f"{name}.wav"))
+        if not os.path.exists(wav):
+            os.makedirs(synth_dir, exist_ok=True)
+            noise_db = fixture.get("noise_db")
+            wav = os.path.join(synth_dir, f"{name}-{zlib.crc32(json.dumps([fixture['text'], noise_db]).encode()):08x}.wav")
+            if not os.path.exists(wav):
+                synthesize(wav, fixture["text"], noise_db, name)
+            synthesized += 1
+        fixture["wav"] = wav
+        fixture["seconds"] = wav_seconds(wav)
+    if synthesized:
+        print(f"{synthesized} of {len(manifest['fixtures'])} fixtures have no recording; "
+              f"using synthesized placeholders from {synth_dir}")
+    return manifest
+
+
+# ─────────────────────────── PIPELINE ───────────────────────────
+class ScriptedVoice:
+    """Plays the user's side of a conversation: answers each spoken prompt with a fixture."""
+
+    def __init__(self, fixtures: Dict[str, Dict[str, Any]], recognizer: str):
+        self.by_kind: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        for fixture in fixtures.values():
+            self.by_kind[fixture["kind"]].append(fixture)
+        self.fixtures = fixtures
+        self.use_sphinx = recognizer == "sphinx"
+        self.turn = 0
+        self.start_order(None)
+
+    def start_order(self, say: Optional[str]) -> None:
+        self.opening = say
+        self.kind = "order"
+        self.last_prompt = ""
+        self.current: Optional[Dict[str, Any]] = None
+        self.turns = 0
+        self.audio_s = 0.0
+
+    def _next(self) -> Dict[str, Any]:
+        if self.kind == "order" and self.opening:
+            fixture, self.opening = self.fixtures[self.opening], None
+            return fixture
+        pool = self.by_kind.get(self.kind)
+        if not pool:
+            raise RuntimeError(f"no fixture of kind {self.kind!r} to answer: {self.last_prompt!r}")
+        if self.kind == "option":
+            # Answer with a size the prompt actually offers, if a fixture names one.
+            prompt = self.last_prompt.lower()
+            offered = [f for f in pool if f["text"].split()[-1].lower() in prompt]
+            pool = offered or pool
+        self.turn += 1
+        return pool[self.turn % len(pool)]
+
+    # The three Final.py hooks, plus its typed fallback.
+    def tts_sink(self, text: str) -> None:
+        lowered = text.lower()
+        for phrase, kind in PROMPT_KINDS:
+            if phrase in lowered:
+                self.kind = kind
+                self.last_prompt = text
+                break
+
+    def audio_source(self):
+        import speech_recognition as sr
+        self.current = self._next()
+        self.turns += 1
+        self.audio_s += self.current["seconds"]
+        return sr.AudioFile(self.current["wav"])
+
+    def recognize(self, recognizer, audio) -> str:
+        import speech_recognition as sr
+        if not self.current["recognized"]:
+            raise sr.UnknownValueError()
+        if self.use_sphinx:
+            return recognizer.recognize_sphinx(audio)
+        return self.current["text"]
+
+    def typed(self, prompt: str = "") -> str:
+        return self.current["text"] if self.current else ""
+
+
+_depth = threading.local()
+
+
+def _staged(name: str, func: Callable) -> Callable:
+    """tracing.timed, except that calls nested inside the same stage are not counted twice."""
+    import tracing
+
+    def wrapper(*args, **kwargs):
+        if getattr(_depth, name, 0):
+            return func(*args, **kwargs)
+        setattr(_depth, name, 1)
+        try:
+            with tracing.stage(name):
+                return func(*args, **kwargs)
+        finally:
+            setattr(_depth, name, 0)
+    return wrapper
+
+
+def install(voice: ScriptedVoice, carted: List[int]):
+    """Points Final.py at the scripted voice and wraps its parsing and DB calls; returns the module."""
+    import Final
+
+    Final.tts_sink = voice.tts_sink
+    Final.audio_source = voice.audio_source
+    Final.recognize = voice.recognize
+    Final.input = voice.typed
+    for name in PARSING_CALLS:
+        setattr(Final, name, _staged("parsing", getattr(Final, name)))
+    for name in DB_CALLS:
+        setattr(Final, name, _staged("db", getattr(Final, name)))
+
+    add_to_cart = Final.add_to_cart
+
+    def counting_add_to_cart(*args, **kwargs):
+        carted.append(kwargs.get("visible", 1))
+        return add_to_cart(*args, **kwargs)
+    Final.add_to_cart = counting_add_to_cart
+    return Final
+
+
+def run_order(final, voice: ScriptedVoice, order: Dict[str, Any], carted: List[int], verbose: bool) -> Dict[str, Any]:
+    import tracing
+
+    voice.start_order(order["say"])
+    del carted[:]
+    out = sys.stdout if verbose else io.StringIO()
+    tracing.begin()
+    started = time.perf_counter()
+    with redirect_stdout(out):
+        final.handle_store_assistant(order["user_id"], order["store_id"])
+    total = time.perf_counter() - started
+    trace = tracing.end()
+
+    stages = {name: 0.0 for name in STAGES}
+    if trace:
+        for name, (elapsed, _) in trace.stages.items():
+            if name in stages:
+                stages[name] = elapsed * 1000
+    return {
+        "order": order["say"],
+        "store_id": order["store_id"],
+        "total_ms": total * 1000,
+        "stages_ms": stages,
+        "other_ms": max(0.0, total * 1000 - sum(stages.values())),
+        "audio_s": voice.audio_s,
+        "turns": voice.turns,
+        "carted": len(carted),
+        "confirmed": bool(carted) and all(v == 1 for v in carted),
+    }
+
+
+# ─────────────────────────── REPORT ───────────────────────────
+def report(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    def summary(values: List[float]) -> Dict[str, float]:
+        return {
+            "mean": round(sum(values) / len(values), 2),
+            "p50": round(_percentile(values, 50), 2),
+            "p95": round(_percentile(values, 95), 2),
+            "max": round(max(values), 2),
+        }
+
+    columns = {name: [r["stages_ms"][name] for r in records] for name in STAGES}
+    columns["other"] = [r["other_ms"] for r in records]
+    columns["total"] = [r["total_ms"] for r in records]
+    return {
+        "orders": len(records),
+        "confirmed": sum(1 for r in records if r["confirmed"]),
+        "turns_per_order": round(sum(r["turns"] for r in records) / len(records), 2),
+        "audio_s_per_order": round(sum(r["audio_s"] for r in records) / len(records), 2),
+        "ms_per_order": {name: summary(values) for name, values in columns.items()},
+    }
+
+
+def print_report(result: Dict[str, Any], records: List[Dict[str, Any]], per_order: bool) -> None:
+    print(f"\n{result['orders']} orders, {result['confirmed']} confirmed, {result['turns_per_order']} turns "
+          f"and {result['audio_s_per_order']} s of audio per order")
+    print(f"\n{'stage':<14}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for name, row in result["ms_per_order"].items():
+        print(f"{name:<14}{row['mean']:>10}{row['p50']:>10}{row['p95']:>10}{row['max']:>10}")
+    if per_order:
+        print(f"\n{'order':<22}{'store':>6}{'turns':>6}{'audio s':>9}{'total ms':>10}"
+              + "".join(f"{name[:10]:>12}" for name in STAGES))
+        for r in records:
+            print(f"{r['order']:<22}{r['store_id']:>6}{r['turns']:>6}{r['audio_s']:>9.2f}{r['total_ms']:>10.1f}"
+                  + "".join(f"{r['stages_ms'][name]:>12.1f}" for name in STAGES))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--manifest", default=MANIFEST)
+    parser.add_argument("--db", help="seeded SQLite database; MySQL from the DB_* environment otherwise")
+    parser.add_argument("--repeat", type=int, default=3, help="times every order is run")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed runs of every order first (menus, bundles, indexes)")
+    parser.add_argument("--recognizer", choices=["transcript", "sphinx"], default="transcript",
+                        help="transcript: the manifest's text; sphinx: CMU Sphinx on the audio")
+    parser.add_argument("--per-order", action="store_true", help="also print one row per order run")
+    parser.add_argument("--verbose", action="store_true", help="show the conversation as it runs")
+    parser.add_argument("--json", help="also write the report and per-order rows to this file")
+    args = parser.parse_args()
+
+    if args.db:
+        # Read by db.py at import, so set before Final is imported.
+        os.environ["DB_BACKEND"] = "sqlite"
+        os.environ["DB_SQLITE_PATH"] = os.path.abspath(args.db)
+
+    manifest = load_manifest(args.manifest)
+    voice = ScriptedVoice(manifest["fixtures"], args.recognizer)
+    carted: List[int] = []
+    final = install(voice, carted)
+
+    for _ in range(args.warmup):
+        for order in manifest["orders"]:
+            run_order(final, voice, order, carted, args.verbose)
+    records = [run_order(final, voice, order, carted, args.verbose)
+               for _ in range(args.repeat) for order in manifest["orders"]]
+
+    result = report(records)
+    print_report(result, records, args.per_order)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump({"report": result, "orders": records}, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
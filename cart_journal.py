@@ -0,0 +1,222 @@
+"""
+Write-behind journal for confirmed cart lines (enabled with CART_WRITE_BEHIND=1).
+
+A confirmation appends its cart lines to this process's journal file and fsyncs
+before the user is answered; a background thread then inserts them into
+tbl_cart_data in batched transactions. Each line is keyed "<session_id>:<line>"
+and the key is recorded in tbl_cart_journal in the same transaction, so a batch
+that is retried after a crash or a lost commit is never inserted twice.
+
+Every process writes its own file and holds an exclusive flock on it while it
+runs. On start a process adopts the files nobody holds (left by a stopped or
+crashed worker) and flushes their unfinished lines.
+"""
+import os
+import time
+import fcntl
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import db
+import fastjson
+
+# ─────────────────────────── CONFIG ───────────────────────────
+CART_WRITE_BEHIND = os.getenv("CART_WRITE_BEHIND", "0") == "1"
+CART_JOURNAL_DIR = os.getenv("CART_JOURNAL_DIR", "cart_journal")
+# Seconds between flushes when idle; a new entry wakes the flusher immediately.
+CART_FLUSH_INTERVAL = float(os.getenv("CART_FLUSH_INTERVAL", "0.5"))
+CART_FLUSH_BATCH = int(os.getenv("CART_FLUSH_BATCH", "200"))
+# Delay before retrying after a failed flush.
+CART_FLUSH_RETRY = float(os.getenv("CART_FLUSH_RETRY", "2"))
+
+JOURNAL_TABLE_DDL = """
+    CREATE TABLE IF NOT EXISTS tbl_cart_journal (
+        journal_key VARCHAR(96) NOT NULL PRIMARY KEY,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+
+def _read_entries(fh) -> "OrderedDict[str, list]":
+    """Lines of a journal file that have no matching "done" record, in append order."""
+    fh.seek(0)
+    pending: "OrderedDict[str, list]" = OrderedDict()
+    for raw in fh:
+        try:
+            record = fastjson.loads(raw)
+        except ValueError:
+            # A torn last line from a crash mid-append; it was never acknowledged.
+            continue
+        if record.get("op") == "line":
+            pending[record["key"]] = record["row"]
+        elif record.get("op") == "done":
+            for key in record["keys"]:
+                pending.pop(key, None)
+    return pending
+
+
+class CartJournal:
+    def __init__(self, directory: str = CART_JOURNAL_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.pid = os.getpid()
+        self.path = os.path.join(directory, f"cart-{self.pid}-{time.time_ns()}.jsonl")
+        # Locked under a name adopt_orphans() skips, then moved into place, so no other
+        # process can ever see this file unlocked and take it for an orphan.
+        staging = self.path + ".new"
+        self._fh = open(staging, "a+b")
+        fcntl.flock(self._fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.rename(staging, self.path)
+        self._pending: "OrderedDict[str, list]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._table_ready = False
+        self.flushed = 0
+        self.failures = 0
+        self._thread = threading.Thread(target=self._run, name="cart-journal", daemon=True)
+
+    # ── durable append ──
+    def _write(self, records: List[Dict[str, Any]]) -> None:
+        """Appends records and fsyncs; the caller holds self._lock."""
+        self._fh.write(b"".join(fastjson.dumps(r) + b"\n" for r in records))
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+
+    def append(self, session_id: str, rows: Sequence[Sequence[Any]]) -> None:
+        """Durably records a confirmed order's cart lines ("cart_insert" parameters)."""
+        records = [{"op": "line", "key": f"{session_id}:{n}", "row": list(row)} for n, row in enumerate(rows)]
+        with self._lock:
+            self._write(records)
+            for record in records:
+                self._pending[record["key"]] = record["row"]
+        self._wake.set()
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    # ── recovery ──
+    def adopt_orphans(self) -> int:
+        """Moves unfinished lines of journal files no running process holds into this one."""
+        adopted = 0
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if path == self.path or not name.endswith(".jsonl"):
+                continue
+            try:
+                fh = open(path, "r+b")
+            except FileNotFoundError:
+                continue  # another process adopted it first
+            with fh:
+                try:
+                    fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # its owner is still running
+                try:
+                    if os.stat(path).st_ino != os.fstat(fh.fileno()).st_ino:
+                        continue
+                except FileNotFoundError:
+                    continue  # adopted and removed by another process between our open and our lock
+                entries = _read_entries(fh)
+                if entries:
+                    with self._lock:
+                        self._write([{"op": "line", "key": k, "row": r} for k, r in entries.items()])
+                        self._pending.update(entries)
+                    adopted += len(entries)
+                # Safe to drop now: its lines live in this journal.
+                os.remove(path)
+        if adopted:
+            print(f"[Cart Journal] Replaying {adopted} cart line(s) from a previous run")
+            self._wake.set()
+        return adopted
+
+    # ── flushing ──
+    def _insert_batch(self, conn, batch: List[Tuple[str, list]]) -> None:
+        if not self._table_ready:
+            with conn.cursor() as cur:
+                cur.execute(JOURNAL_TABLE_DDL)
+            self._table_ready = True
+
+        keys = [key for key, _ in batch]
+        conn.start_transaction()
+        try:
+            with conn.cursor() as cur:
+                placeholders = ", ".join(["%s"] * len(keys))
+                cur.execute(f"SELECT journal_key FROM tbl_cart_journal WHERE journal_key IN ({placeholders})", keys)
+                written = {row[0] for row in cur.fetchall()}
+                fresh = [(key, row) for key, row in batch if key not in written]
+                if fresh:
+                    cur.executemany("INSERT INTO tbl_cart_journal (journal_key) VALUES (%s)",
+                                    [(key,) for key, _ in fresh])
+                    cur.executemany(db.STATEMENTS["cart_insert"], [row for _, row in fresh])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def flush(self) -> int:
+        """Writes up to CART_FLUSH_BATCH pending lines to the database; returns how many."""
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._pending.items())[:CART_FLUSH_BATCH]
+            if not batch:
+                return 0
+            conn = db.get_connection()
+            try:
+                self._insert_batch(conn, batch)
+            finally:
+                conn.close()
+
+            with self._lock:
+                self._write([{"op": "done", "keys": [key for key, _ in batch]}])
+                for key, _ in batch:
+                    self._pending.pop(key, None)
+                if not self._pending:
+                    # Everything is in the database; start the file over.
+                    self._fh.truncate(0)
+                    os.fsync(self._fh.fileno())
+            self.flushed += len(batch)
+            return len(batch)
+
+    def _run(self) -> None:
+        try:
+            self.adopt_orphans()
+        except OSError as e:
+            print(f"[Cart Journal] Could not read old journal files: {e}")
+        while True:
+            self._wake.wait(CART_FLUSH_INTERVAL)
+            self._wake.clear()
+            try:
+                while self.flush() == CART_FLUSH_BATCH:
+                    pass
+            except Exception as e:
+                self.failures += 1
+                print(f"[Cart Journal] Flush failed, will retry: {e}")
+                time.sleep(CART_FLUSH_RETRY)
+
+    def start(self) -> "CartJournal":
+        self._thread.start()
+        return self
+
+    def stats(self) -> Dict[str, Any]:
+        return {"path": self.path, "pending": self.pending(), "flushed": self.flushed, "failures": self.failures}
+
+
+_journal: Optional[CartJournal] = None
+_journal_lock = threading.Lock()
+
+
+def get_journal() -> CartJournal:
+    """This process's journal, started on first use (a forked worker gets its own)."""
+    global _journal
+    if _journal is None or _journal.pid != os.getpid():
+        with _journal_lock:
+            if _journal is None or _journal.pid != os.getpid():
+                _journal = CartJournal().start()
+    return _journal
+
+
+def append(session_id: str, rows: Sequence[Sequence[Any]]) -> None:
+    get_journal().append(session_id, rows)
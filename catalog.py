@@ -0,0 +1,416 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Dict, Any, Callable, Optional, Tuple
+import mysql.connector
+
+import db
+import popularity
+import singleflight
+from cache import LRUCache, TTLCache
+from matching import MenuIndex
+from ordering import load_store_menu, get_user_name as fetch_user_name
+
+# ─────────────────────────── CONFIG ───────────────────────────
+MENU_CACHE_TTL = float(os.getenv("MENU_CACHE_TTL", "300"))
+DETAILS_CACHE_TTL = float(os.getenv("DETAILS_CACHE_TTL", "120"))
+NAME_CACHE_TTL = float(os.getenv("NAME_CACHE_TTL", "600"))
+WARMUP_TOP_PRODUCTS = int(os.getenv("WARMUP_TOP_PRODUCTS", "10"))
+WARMUP_WORKERS = int(os.getenv("WARMUP_WORKERS", "4"))
+WARMUP_WAIT_TIMEOUT = float(os.getenv("WARMUP_WAIT_TIMEOUT", "5"))
+PREFETCH_TTL = float(os.getenv("PREFETCH_TTL", "120"))
+PREFETCH_WAIT_TIMEOUT = float(os.getenv("PREFETCH_WAIT_TIMEOUT", "3"))
+
+# store_id -> MenuIndex
+menu_indexes = TTLCache(maxsize=512, ttl=MENU_CACHE_TTL)
+# (store_id, item_id) -> product bundle (see db.fetch_product_bundle)
+product_details = TTLCache(maxsize=8192, ttl=DETAILS_CACHE_TTL)
+user_names = TTLCache(maxsize=16384, ttl=NAME_CACHE_TTL)
+store_names = TTLCache(maxsize=1024, ttl=NAME_CACHE_TTL)
+# store_id -> True once its top products have been warmed
+_warm_stores = TTLCache(maxsize=1024, ttl=MENU_CACHE_TTL)
+# session_id -> {item_id: Future of (details, plan)} for a pending clarification
+_prefetched = TTLCache(maxsize=2048, ttl=PREFETCH_TTL)
+# Last successfully loaded menus and bundles, kept past their TTL so a failing or
+# slow database can be bridged with possibly stale data.
+_last_good_menus = LRUCache(maxsize=512)
+_last_good_details = LRUCache(maxsize=8192)
+# (kind, key) -> Future of a background refresh
+_refreshes: Dict[Any, Future] = {}
+_refreshes_lock = threading.Lock()
+# Cold misses of the same menu, product or name share one query.
+reads = singleflight.SingleFlight("catalog")
+
+EMPTY_DETAILS = {"options": [], "addons": [], "normal_price": None, "discount": 0.0, "attribute_id": 0}
+
+_executor: Optional[ThreadPoolExecutor] = None
+_warmups: Dict[Any, Future] = {}
+_warmups_lock = threading.Lock()
+
+
+# ─────────────────────── DEGRADED READS ───────────────────────
+_local = threading.local()
+
+
+def reset_stale() -> None:
+    _local.stale = False
+
+
+def served_stale() -> bool:
+    """Whether the current thread was handed last-known-good data since the last reset_stale()."""
+    return getattr(_local, "stale", False)
+
+
+def mark_stale() -> None:
+    _local.stale = True
+
+
+def _stale(value: Any) -> Any:
+    mark_stale()
+    return value
+
+
+def _guarded(load: Callable[[], Any], what: str) -> Tuple[Any, bool]:
+    """Runs a read through db.read_breaker; returns ``(value, ok)`` and reports failures."""
+    if not db.read_breaker.allow():
+        return None, False
+    started = time.monotonic()
+    try:
+        value = load()
+    except (mysql.connector.Error, json.JSONDecodeError) as err:
+        db.read_breaker.record(time.monotonic() - started, ok=False)
+        print(f"Database error in {what}: {err}")
+        return None, False
+    except BaseException:
+        # Not the database's doing (a rejected admission, say); a half-open trial goes to the next call.
+        db.read_breaker.release()
+        raise
+    db.read_breaker.record(time.monotonic() - started)
+    return value, True
+
+
+def _coalesced(key: Any, load: Callable[[], Any], what: str) -> Tuple[Any, bool]:
+    """_guarded, run once for all concurrent callers with the same ``key``."""
+    try:
+        return reads.do(key, lambda: _guarded(load, what))
+    except singleflight.Timeout as err:
+        print(f"Database error in {what}: {err}")
+        return None, False
+
+
+def _pooled(load: Callable[[Any], Any]) -> Callable[[], Any]:
+    """``load(conn)`` on a connection of its own, for reads that may outlive the request."""
+    def run():
+        conn = db.get_read_connection()
+        try:
+            return load(conn)
+        finally:
+            conn.close()
+    return run
+
+
+def _refresh(key: Any, load: Callable[[], Any], what: str) -> Optional[Future]:
+    """One background load per key (callers share it); None while the breaker refuses reads."""
+    with _refreshes_lock:
+        future = _refreshes.get(key)
+        if future is not None:
+            return future
+        if not db.read_breaker.allow():
+            return None
+        future = Future()
+        _refreshes[key] = future
+
+    def run():
+        started = time.monotonic()
+        try:
+            value = load()
+        except Exception as err:
+            db.read_breaker.record(time.monotonic() - started, ok=False)
+            print(f"Background refresh of {what} failed: {err}")
+            future.set_exception(err)
+        else:
+            db.read_breaker.record(time.monotonic() - started)
+            future.set_result(value)
+        finally:
+            with _refreshes_lock:
+                _refreshes.pop(key, None)
+
+    _get_executor().submit(run)
+    return future
+
+
+def _fresh_or_stale(key: Any, load: Callable[[], Any], stale: Any, what: str) -> Any:
+    """
+    A fresh value if the refresh finishes within DB_READ_BUDGET, otherwise ``stale``
+    (and the current turn is flagged). A refresh that overruns keeps going and
+    repopulates the cache when it lands.
+    """
+    future = _refresh(key, load, what)
+    if future is None:
+        return _stale(stale)
+    try:
+        return future.result(timeout=db.DB_READ_BUDGET)
+    except Exception:  # timed out or failed
+        return _stale(stale)
+
+
+# ─────────────────────── CACHED LOOKUPS ───────────────────────
+def get_menu_index(connect: Callable[[], Any], store_id: int) -> Optional[MenuIndex]:
+    """
+    The store's menu and match index, loaded at most once per TTL; None if the menu is empty or unavailable.
+    ``connect`` is only called on a cache miss.
+    """
+    index = menu_indexes.get(store_id)
+    if index is not None:
+        return index
+
+    # A warm-up for this store is already loading the menu; wait for it rather than load it twice.
+    with _warmups_lock:
+        pending = _warmups.get(store_id)
+    if pending is not None:
+        try:
+            pending.result(timeout=WARMUP_WAIT_TIMEOUT)
+        except Exception as err:
+            print(f"Warm-up for store {store_id} failed: {err}")
+        index = menu_indexes.get(store_id)
+        if index is not None:
+            return index
+
+    stale = _last_good_menus.get(store_id)
+    if stale is not None:
+        return _fresh_or_stale(("menu", store_id), _pooled(lambda conn: _load_menu_index(conn, store_id)),
+                               stale, "fetch_store_menu")
+    index, _ = _coalesced(("store_menu", store_id), lambda: _load_menu_index(connect(), store_id), "fetch_store_menu")
+    return index
+
+
+def _load_menu_index(conn, store_id: int) -> Optional[MenuIndex]:
+    """Loads and caches the store's index; raises on database errors."""
+    menu = load_store_menu(conn, store_id)
+    if not menu:
+        return None
+    return remember_menu_index(store_id, MenuIndex(store_id, menu))
+
+
+def last_good_menu(store_id: int) -> Optional[MenuIndex]:
+    return _last_good_menus.get(store_id)
+
+
+def remember_menu_index(store_id: int, index: MenuIndex) -> MenuIndex:
+    """Caches a freshly loaded index, also as the store's last-known-good one."""
+    index.popularity = popularity.table.for_store(store_id)
+    popularity.start(db.get_read_connection, _attach_popularity)
+    menu_indexes.put(store_id, index)
+    _last_good_menus.put(store_id, index)
+    return index
+
+
+def _attach_popularity() -> None:
+    """Hands freshly refreshed order counts to the cached indexes."""
+    for store_id, index in menu_indexes.snapshot():
+        index.popularity = popularity.table.for_store(store_id)
+
+
+def get_product_details(connect: Callable[[], Any], item_id: int, store_id: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Cached product bundle; ``connect`` is only called on a miss. When the database fails or is
+    slow, the last-known-good bundle is served if there is one, else empty details (not cached).
+    """
+    key = (store_id, item_id)
+    details = product_details.get(key)
+    if details is not None:
+        return details
+
+    stale = _last_good_details.get(key)
+    if stale is not None:
+        return _fresh_or_stale(("details", key), _pooled(lambda conn: _load_details(conn, item_id, store_id)),
+                               stale, "get_product_details")
+    details, ok = _coalesced(("product_bundle", store_id, item_id), lambda: _load_details(connect(), item_id, store_id),
+                             "get_product_details")
+    return details if ok else dict(EMPTY_DETAILS)
+
+
+def _load_details(conn, item_id: int, store_id: Optional[int]) -> Dict[str, Any]:
+    return remember_details(item_id, store_id, db.fetch_product_bundle(conn, item_id, store_id))
+
+
+def last_good_details(item_id: int, store_id: Optional[int]) -> Optional[Dict[str, Any]]:
+    return _last_good_details.get((store_id, item_id))
+
+
+def remember_details(item_id: int, store_id: Optional[int], details: Dict[str, Any]) -> Dict[str, Any]:
+    """Caches a freshly loaded bundle, also as the product's last-known-good one."""
+    product_details.put((store_id, item_id), details)
+    _last_good_details.put((store_id, item_id), details)
+    return details
+
+
+def get_user_name(connect: Callable[[], Any], user_id: int) -> str:
+    """TTL-cached customer name; ``connect`` is only called on a cache miss."""
+    def load():
+        with connect().cursor(dictionary=True) as cur:
+            return fetch_user_name(cur, user_id)
+    return user_names.get_or_load(user_id, lambda: reads.do(("user_name", user_id), load))
+
+
+STORE_NAME_SQL = "SELECT title FROM service_details WHERE id = %s AND status = 1;"
+
+
+def store_title(row: Optional[Dict[str, Any]]) -> str:
+    return row["title"] if row and row.get("title") else "Store"
+
+
+def get_store_name(connect: Callable[[], Any], store_id: int) -> str:
+    """TTL-cached store title; ``connect`` is only called on a cache miss. Lookup failures are not cached."""
+    def load():
+        with connect().cursor(dictionary=True) as cur:
+            cur.execute(STORE_NAME_SQL, (store_id,))
+            return store_title(cur.fetchone())
+
+    try:
+        return store_names.get_or_load(store_id, lambda: reads.do(("store_name", store_id), load))
+    except (mysql.connector.Error, singleflight.Timeout) as e:
+        print(f"Error fetching store name: {e}")
+        return "Store"
+
+
+def fetch_top_product_ids(conn, store_id: int, limit: int) -> List[int]:
+    """The store's most frequently carted products, most popular first."""
+    with conn.cursor(dictionary=True) as cur:
+        cur.execute("""
+            SELECT product_id, COUNT(*) AS orders
+            FROM tbl_cart_data
+            WHERE store_id = %s
+            GROUP BY product_id
+            ORDER BY orders DESC
+            LIMIT %s
+        """, (store_id, limit))
+        return [row["product_id"] for row in cur.fetchall()]
+
+
+# ─────────────────────────── WARM-UP ───────────────────────────
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _warmups_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=WARMUP_WORKERS, thread_name_prefix="warmup")
+    return _executor
+
+
+def _warm(store_id: int) -> None:
+    conn = db.get_read_connection()
+    try:
+        index = menu_indexes.get(store_id)
+        if index is None:
+            index, _ = _coalesced(("store_menu", store_id), lambda: _load_menu_index(conn, store_id), "fetch_store_menu")
+        if index is None:
+            return
+        known_ids = {item["item_id"] for item in index.menu}
+        for product_id in fetch_top_product_ids(conn, store_id, WARMUP_TOP_PRODUCTS):
+            if product_id in known_ids:
+                get_product_details(lambda: conn, product_id, store_id)
+        _warm_stores.put(store_id, True)
+    finally:
+        conn.close()
+
+
+def warm_store(store_id: int) -> Optional[Future]:
+    """
+    Starts loading the store's menu, match index and most-ordered product details in the background.
+    Concurrent callers for the same store share one warm-up; returns None when the store is already
+    warm or the read breaker is open.
+    """
+    if _warm_stores.get(store_id) and menu_indexes.get(store_id) is not None:
+        return None
+    # Don't add load to a database the read breaker is shielding.
+    if db.read_breaker.is_open():
+        return None
+    with _warmups_lock:
+        pending = _warmups.get(store_id)
+        if pending is not None:
+            return pending
+        future = Future()
+        _warmups[store_id] = future
+
+    def run():
+        try:
+            _warm(store_id)
+            future.set_result(None)
+        except Exception as err:
+            print(f"Warm-up for store {store_id} failed: {err}")
+            future.set_exception(err)
+        finally:
+            with _warmups_lock:
+                _warmups.pop(store_id, None)
+
+    _get_executor().submit(run)
+    return future
+
+
+# ──────────────────── CLARIFICATION PREFETCH ────────────────────
+def _load_details_pooled(item_id: int, store_id: Optional[int]) -> Dict[str, Any]:
+    """get_product_details for background threads; a pooled connection is only checked out on a miss."""
+    checked_out = []
+
+    def connect():
+        if not checked_out:
+            checked_out.append(db.get_read_connection())
+        return checked_out[0]
+
+    try:
+        return get_product_details(connect, item_id, store_id)
+    finally:
+        for conn in checked_out:
+            conn.close()
+
+
+def prefetch_candidates(session_id: str,
+                        store_id: int,
+                        item_ids: List[int],
+                        plan: Callable[[Dict[str, Any]], Any]) -> None:
+    """
+    Fetches every clarification candidate's details concurrently and parks ``(details, plan(details))``
+    for the session, so whichever option the user picks can be answered without a DB round trip.
+    """
+    discard_prefetched(session_id)
+
+    def load(item_id):
+        details = _load_details_pooled(item_id, store_id)
+        return details, plan(details)
+
+    executor = _get_executor()
+    _prefetched.put(session_id, {item_id: executor.submit(load, item_id) for item_id in item_ids})
+
+
+def take_prefetched(session_id: str, item_id: int, timeout: float = PREFETCH_WAIT_TIMEOUT) -> Optional[Tuple[Dict[str, Any], Any]]:
+    """The parked ``(details, plan)`` for the chosen candidate, or None; the session's other candidates are dropped."""
+    future = _prefetched.pop(session_id, {}).get(item_id)
+    if future is None:
+        return None
+    try:
+        return future.result(timeout=timeout)
+    except Exception as err:
+        print(f"Prefetch for product {item_id} failed: {err}")
+        return None
+
+
+def discard_prefetched(session_id: str) -> None:
+    _prefetched.pop(session_id)
+
+
+def caches() -> Dict[str, Tuple[Any, Optional[Callable[[Any], Any]]]]:
+    """Name -> (cache, key -> store id, or None when not per store) of every catalog cache."""
+    by_id = lambda key: key
+    by_first = lambda key: key[0]
+    return {
+        "menu_indexes": (menu_indexes, by_id),
+        "last_good_menus": (_last_good_menus, by_id),
+        "product_details": (product_details, by_first),
+        "last_good_details": (_last_good_details, by_first),
+        "store_names": (store_names, by_id),
+        "user_names": (user_names, None),
+        "prefetched": (_prefetched, None),
+    }
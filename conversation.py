@@ -0,0 +1,273 @@
+"""
+The chat turn logic shared by the Flask app (app.py) and the asyncio app (asgi_app.py).
+
+Everything here is pure: callers load menus and product bundles their own way
+(sync pool or async driver) and pass them in; functions return the JSON-ready
+payloads both servers send.
+"""
+import weakref
+from typing import Any, Dict, List, Optional, Tuple
+from rapidfuzz import process as fuzz_process
+
+import fastjson
+import popularity
+from matching import MenuIndex
+from ordering import _parse_multi_sizes
+
+# Utterances that end item selection and move on to the order summary.
+END_OF_ORDER = ["no", "that's all", "thats all"]
+
+# MenuIndex -> its serialized menu reply minus the session_id (dropped with the index)
+_menu_bodies: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def parse_boolean_answer(sentence: str) -> bool:
+
+    s = sentence.lower()
+    positive_phrases = ["yes", "yeah", "yup", "i want", "sure", "of course", "absolutely", "okay", "add", "include", "do", "confirm"]
+    negative_phrases = ["no", "nope", "don't", "not", "skip", "without", "exclude", "remove", "cancel"]
+
+    # It's positive if a positive word is present AND no negative word is present.
+    is_positive = any(p in s for p in positive_phrases)
+    is_negative = any(n in s for n in negative_phrases)
+
+    return is_positive and not is_negative
+
+
+# ─────────────────────────── PRICING ───────────────────────────
+def price_item(item: dict, bundle: dict) -> Tuple[float, int]:
+    """Discounted line price and total quantity of a configured item."""
+    total_price, total_quantity = 0.0, 0
+    if item.get("selected_options"):
+        for opt in item["selected_options"]:
+            total_price += float(opt.get('price', 0)) * int(opt.get('quantity', 1))
+            total_quantity += int(opt.get('quantity', 1))
+    else:
+        price = item.get('price', 0) or bundle.get('normal_price') or 0
+        quantity = item.get('quantity', 1)
+        total_price = float(price) * int(quantity)
+        total_quantity = int(quantity)
+
+    addon_price = sum(float(addon.get('addon_price', 0)) for addon in item.get("selected_addons", []))
+    total_price += addon_price * total_quantity
+
+    discount_rate = bundle.get('discount') or 0.0
+
+    final_price = total_price * (1 - discount_rate / 100)
+    return final_price, total_quantity
+
+
+def summarize_order(completed_items: list, bundles: Dict[Any, dict]) -> dict:
+    """Summary lines and total of the order; ``bundles`` maps item_id to product bundle."""
+    summary_items = []
+    total_price_final = 0.0
+
+    for item in completed_items:
+        total_quantity = 0
+        options_summary = []
+        if item.get("selected_options"):
+            for option in item["selected_options"]:
+                options_summary.append(f"{option.get('quantity', 1)} {option.get('name', '')}")
+                total_quantity += int(option.get('quantity', 1))
+        else:
+            total_quantity = int(item.get('quantity', 1))
+
+        addon_summary = []
+        if item.get("selected_addons"):
+            for addon in item["selected_addons"]:
+                addon_summary.append(addon.get('addon_name', ''))
+
+        final_price, _ = price_item(item, bundles[item['item_id']])
+        total_price_final += final_price
+
+        # Create a summary line for this specific item
+        line = f"{total_quantity} {item['item_name']}"
+        if options_summary:
+            line += f" ({', '.join(options_summary)})"
+        if addon_summary:
+            line += f" with {', '.join(addon_summary)}"
+
+        summary_items.append({
+            "line_item": line,
+            "price": f"{final_price:.2f}"
+        })
+
+    return {
+        "summary_items": summary_items,
+        "total_price": total_price_final
+    }
+
+
+# ─────────────────────────── TURN STEPS ───────────────────────────
+def greeting(user_name: str, store_name: str) -> str:
+    """The first assistant message of a conversation."""
+    return f"Hello {user_name}! You're chatting with {store_name}'s assistant. What would you like to eat today?"
+
+
+def build_item_questions(details: dict) -> list:
+    """The option and add-on questions to ask for an item, in order."""
+    questions = []
+    if details.get("options"):
+        for opt_group in details["options"]:
+            choices = ", ".join([f"{val['name']} (₹{val['price']})" for val in opt_group['option_values']])
+            questions.append({"type": "options", "question_text": f"Please select your {opt_group['option_name']}. Options are: {choices}", "data": opt_group})
+    if details.get("addons"):
+        for addon in details["addons"]:
+            questions.append({"type": "boolean", "question_text": f"Would you like to add {addon['addon_name']} (₹{addon['addon_price']})?", "data": addon})
+    return questions
+
+
+def start_item(session_id: str, state: dict, item: dict, questions: list) -> dict:
+    """Makes ``item`` the item in progress and asks its first question, or completes it when there is nothing to ask."""
+    state['item_in_progress'] = item
+    if not questions:
+        state['completed_items'].append(item)
+        state['item_in_progress'] = None
+        return {"status": "item_complete", "assistant_response": f"Added {item['item_name']}. Anything else?"}
+
+    state['pending_questions'] = questions
+    return {"status": "question", "assistant_response": questions[0]['question_text'], "session_id": session_id}
+
+
+def pick_clarification(user_input: str, clarification_options: List[dict]) -> Optional[dict]:
+    """The option the user chose, by number or by name."""
+    chosen_item = None
+
+    if user_input.strip().isdigit():
+        choice_index = int(user_input.strip()) - 1
+        if 0 <= choice_index < len(clarification_options):
+            chosen_item = clarification_options[choice_index]
+
+    if not chosen_item:
+        item_names = [item['item_name'] for item in clarification_options]
+        match = fuzz_process.extractOne(user_input, item_names, score_cutoff=80)
+        if match:
+            chosen_item = next((item for item in clarification_options if item['item_name'] == match[0]), None)
+    return chosen_item
+
+
+def clarification_reply(session_id: str, clarification_options: List[dict], retry: bool = False) -> dict:
+    """Asks the user to pick one of ``clarification_options``; ``retry`` after an answer that matched none."""
+    # Create a clean, formatted list to send to the client
+    formatted_options = [{
+        "item_id": item.get("item_id"),
+        "item_name": item.get("item_name", "").strip()
+    } for item in clarification_options]
+
+    options_text = "\n".join([f"{i+1}. {item['item_name']}" for i, item in enumerate(formatted_options)])
+    if retry:
+        response = f"Sorry, I didn't get that. Please choose a number or name from the list:\n{options_text}"
+    else:
+        response = f"I found a few options, which one did you mean?\n{options_text}"
+    return {
+        "status": "clarification_needed",
+        "assistant_response": response,
+        "options": formatted_options,
+        "session_id": session_id
+    }
+
+
+def answer_question(session_id: str, state: dict, user_input: str) -> Optional[dict]:
+    """
+    Applies the answer to the item's current question. Returns the next question's
+    payload, or None once the item is complete (it is then moved to completed_items).
+    """
+    item_in_progress = state['item_in_progress']
+    current_question = state['pending_questions'].pop(0)
+    question_type = current_question['type']
+
+    if question_type == 'options':
+        allowed = current_question.get('data', {}).get('option_values', [])
+        parsed = _parse_multi_sizes(user_input, [opt.get('name') for opt in allowed])
+        for p in parsed:
+            for a in allowed:
+                if p['name'].lower() == a['name'].lower():
+                    p['price'] = a['price']; break
+        item_in_progress.setdefault('selected_options', []).extend(parsed)
+    elif question_type == 'boolean':
+         if parse_boolean_answer(user_input):
+            item_in_progress.setdefault('selected_addons', []).append(current_question.get('data', {}))
+
+    state['item_in_progress'] = item_in_progress
+    if state['pending_questions']:
+        next_question = state['pending_questions'][0]
+        return {"status": "question", "assistant_response": next_question['question_text'], "session_id": session_id}
+
+    # All questions for this item are done, add it to the list
+    state['completed_items'].append(item_in_progress)
+    state['item_in_progress'] = None
+    return None
+
+
+def summary_reply(session_id: str, state: dict, summary: dict) -> dict:
+    """Moves the session to pending_confirmation and reads the order back."""
+    state['status'] = 'pending_confirmation'
+    summary_lines = [item['line_item'] for item in summary['summary_items']]
+    response_text = "Here is your order summary:\n- " + "\n- ".join(summary_lines)
+    response_text += f"\n\nYour total is ₹{summary['total_price']:.2f}. Should I confirm this order?"
+    return {
+        "status": "pending_confirmation",
+        "assistant_response": response_text,
+        "summary": summary,
+        "session_id": session_id
+    }
+
+
+def menu_reply(session_id: str, index: Optional[MenuIndex]) -> dict:
+    """The full menu, for an empty utterance."""
+    if not index:
+        return {"status": "error", "assistant_response": "Sorry, the menu is currently unavailable."}
+    unique_item_names = sorted(list(set(item['item_name'] for item in index.menu)))
+    menu_text = "\n".join(f"{i}. {name}" for i, name in enumerate(unique_item_names, 1))
+    response_message = "I didn't catch that. Here is what we have on the menu:\n" + menu_text
+    return {"status": "awaiting_item_selection", "assistant_response": response_message, "menu_items": unique_item_names, "session_id": session_id}
+
+
+def menu_reply_body(session_id: str, index: Optional[MenuIndex]) -> bytes:
+    """menu_reply, serialized; the menu part is encoded once per menu version."""
+    if not index:
+        return fastjson.dumps(menu_reply(session_id, None))
+    body = _menu_bodies.get(index)
+    if body is None:
+        reply = menu_reply(session_id, index)
+        del reply["session_id"]
+        body = _menu_bodies[index] = fastjson.dumps(reply)
+    return fastjson.with_fields(body, session_id=session_id)
+
+
+def match_new_item(index: Optional[MenuIndex], user_input: str) -> List[dict]:
+    """
+    Menu rows the utterance may mean: empty when nothing matches, one row for a clear
+    match, several when the top scores are too close to call. An exact tie that one row
+    dominates in the store's order history resolves to that row; otherwise the rows
+    come best match first, then most ordered first. Rows are copies, since the session mutates its items
+    and the index rows are shared across sessions.
+    """
+    # Find items using fuzzy search over the cached per-store index
+    matches = index.extract(user_input, score_cutoff=75, limit=5) if index else []
+    if not matches:
+        return []
+
+    best_score = matches[0][1]
+    ambiguous_matches = [m for m in matches if m[1] >= best_score - 5]
+    if len(ambiguous_matches) > 1:
+        candidates = [index.items_by_name[name] for name, score, idx in ambiguous_matches]
+        scores = [score for name, score, idx in ambiguous_matches]
+        return [dict(item) for item in popularity.prefer(candidates, scores, index.popularity)]
+    return [dict(index.items_by_name[matches[0][0]])]
+
+
+def confirmed_reply() -> dict:
+    return {"status": "order_confirmed", "assistant_response": "Thank you! Your order has been placed in your cart."}
+
+
+def cancelled_reply() -> dict:
+    return {"status": "order_cancelled", "assistant_response": "Okay, I've cancelled your order."}
+
+
+def empty_cart_reply() -> dict:
+    return {"status": "complete", "assistant_response": "Your cart is empty. What would you like to order?"}
+
+
+def not_found_reply(user_input: str) -> dict:
+    return {"status": "not_found", "assistant_response": f"Sorry, I couldn't find anything like '{user_input}'."}
@@ -0,0 +1,509 @@
+import os
+import json
+import time
+import random
+import threading
+import weakref
+from decimal import Decimal
+from typing import Callable, List, Dict, Any, Optional, Sequence
+import mysql.connector
+from mysql.connector import pooling
+from dotenv import load_dotenv
+
+import fastjson
+import tracing
+from cache import LRUCache
+
+# ─────────────────────────── CONFIG ───────────────────────────
+load_dotenv()
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+# "mysql" (default) or "sqlite" for the local stand-in used by load tests (see db_sqlite.py)
+DB_BACKEND = os.getenv("DB_BACKEND", "mysql").lower()
+DB_SQLITE_PATH = os.getenv("DB_SQLITE_PATH", "sb_voice.sqlite3")
+# Read circuit breaker: opens after this many consecutive failed or over-budget reads ...
+DB_BREAKER_FAILURES = int(os.getenv("DB_BREAKER_FAILURES", "5"))
+# ... and lets one trial read through after this many seconds.
+DB_BREAKER_RESET = float(os.getenv("DB_BREAKER_RESET", "10"))
+# Reads slower than this count as failures, and callers holding last-known-good data stop waiting.
+DB_READ_BUDGET = float(os.getenv("DB_READ_BUDGET", "0.5"))
+# Read replicas, as "host[:port]" separated by commas (database file paths with DB_BACKEND=sqlite).
+# Reads are spread over the healthy ones; writes and confirmation reads stay on DB_HOST.
+DB_REPLICA_HOSTS = [h.strip() for h in os.getenv("DB_REPLICA_HOSTS", "").split(",") if h.strip()]
+DB_REPLICA_USER = os.getenv("DB_REPLICA_USER") or os.getenv("DB_USER")
+DB_REPLICA_PASSWORD = os.getenv("DB_REPLICA_PASSWORD") or os.getenv("DB_PASSWORD")
+DB_REPLICA_POOL_SIZE = int(os.getenv("DB_REPLICA_POOL_SIZE", str(DB_POOL_SIZE)))
+
+# ─────────────────────── QUERY ACCOUNTING ───────────────────────
+_local = threading.local()
+
+
+def reset_query_count() -> None:
+    _local.queries = 0
+
+
+def query_count() -> int:
+    """Statements executed by the current thread since the last reset_query_count()."""
+    return getattr(_local, "queries", 0)
+
+
+def add_query_count(n: int) -> None:
+    """Credits statements run on another thread on behalf of the current one."""
+    _local.queries = getattr(_local, "queries", 0) + n
+
+
+def _count_query() -> None:
+    _local.queries = getattr(_local, "queries", 0) + 1
+
+
+class TrackedCursor:
+    """Forwards to a driver cursor and counts the statements it executes; on a replica, also times them."""
+
+    def __init__(self, cursor, replica: "Optional[Replica]" = None):
+        self._cursor = cursor
+        self._replica = replica
+
+    def execute(self, operation, params=None, *args, **kwargs):
+        _count_query()
+        if self._replica is None:
+            return self._cursor.execute(operation, params, *args, **kwargs)
+        return self._replica.timed(self._cursor.execute, operation, params, *args, **kwargs)
+
+    def executemany(self, operation, seq_params, *args, **kwargs):
+        _count_query()
+        return self._cursor.executemany(operation, seq_params, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._cursor.close()
+
+
+class TrackedConnection:
+    """Forwards to a pooled connection and hands out counting cursors."""
+
+    def __init__(self, conn, replica: "Optional[Replica]" = None):
+        self.raw = conn
+        self.replica = replica
+
+    def cursor(self, *args, **kwargs):
+        return TrackedCursor(self.raw.cursor(*args, **kwargs), self.replica)
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+# ─────────────────────── CONNECTION POOL ───────────────────────
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def connection_params() -> Dict[str, Any]:
+    """Server and credentials, shared by this pool and the async one (db_async.py)."""
+    return {
+        "host": os.getenv("DB_HOST"),
+        "user": os.getenv("DB_USER"),
+        "password": os.getenv("DB_PASSWORD"),
+        "database": os.getenv("DB_NAME"),
+        "charset": "utf8mb4",
+    }
+
+
+def get_pool() -> pooling.MySQLConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # pool_reset_session=False keeps server-side prepared statements
+                # alive while a connection sits in the pool.
+                _pool = pooling.MySQLConnectionPool(
+                    pool_name="sb_voice",
+                    pool_size=DB_POOL_SIZE,
+                    pool_reset_session=False,
+                    autocommit=True,
+                    **connection_params(),
+                )
+    return _pool
+
+
+def _checkout(pool: pooling.MySQLConnectionPool, timeout: float):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return pool.get_connection()
+        except pooling.PoolError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.01)
+
+
+def get_connection(timeout: float = DB_POOL_TIMEOUT) -> TrackedConnection:
+    """
+    Checks a connection to the primary out of the pool, waiting up to ``timeout``
+    seconds if it is exhausted. Use it for writes and for reads that must see them.
+    """
+    if DB_BACKEND == "sqlite":
+        import db_sqlite
+        return TrackedConnection(db_sqlite.connect(DB_SQLITE_PATH))
+    return TrackedConnection(_checkout(get_pool(), timeout))
+
+
+def get_read_connection(timeout: float = DB_POOL_TIMEOUT) -> TrackedConnection:
+    """
+    A connection for reads that may lag the primary slightly: to a healthy replica
+    when DB_REPLICA_HOSTS are configured, to the primary otherwise or when none can
+    be reached.
+    """
+    replica = pick_replica()
+    if replica is None:
+        return get_connection(timeout)
+    started = time.monotonic()
+    try:
+        conn = TrackedConnection(replica.connect(timeout), replica)
+    except Exception as err:
+        if isinstance(err, pooling.PoolError):
+            # Our side of the pool is busy, not the replica; free its trial for the next read.
+            replica.breaker.release()
+        else:
+            replica.record(time.monotonic() - started, ok=False)
+        print(f"[DB] Replica {replica.name} unavailable, reading from the primary: {err}")
+        return get_connection(timeout)
+    if replica.breaker.state != "closed":
+        # The breaker's trial read. The caller may find everything cached and never
+        # run a statement, so a probe decides it (the cursor records the outcome).
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+                cur.fetchall()
+        except Exception as err:
+            conn.close()
+            print(f"[DB] Replica {replica.name} still failing, reading from the primary: {err}")
+            return get_connection(timeout)
+    return conn
+
+
+# ─────────────────────────── REPLICAS ───────────────────────────
+class Replica:
+    """
+    One read replica: its own pool, a circuit breaker that takes it out of
+    rotation after repeated failed or over-budget statements, and a moving average
+    of its statement latency that weights how much of the read traffic it gets.
+    """
+
+    # Weight of the newest sample in the latency average.
+    ALPHA = 0.2
+
+    def __init__(self, address: str, index: int):
+        self.name = address
+        self.index = index
+        host, _, port = address.rpartition(":") if DB_BACKEND != "sqlite" else (address, "", "")
+        self.host, self.port = (host, int(port)) if host and port.isdigit() else (address, None)
+        self.breaker = CircuitBreaker(f"replica {address}")
+        self.latency = 0.0
+        self.reads = 0
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def params(self) -> Dict[str, Any]:
+        """connection_params() for this replica."""
+        params = dict(connection_params(), host=self.host, user=DB_REPLICA_USER, password=DB_REPLICA_PASSWORD)
+        if self.port:
+            params["port"] = self.port
+        return params
+
+    def connect(self, timeout: float):
+        if DB_BACKEND == "sqlite":
+            import db_sqlite
+            return db_sqlite.connect(self.host)
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = pooling.MySQLConnectionPool(
+                        pool_name=f"sb_voice_replica{self.index}",
+                        pool_size=DB_REPLICA_POOL_SIZE,
+                        pool_reset_session=False,
+                        autocommit=True,
+                        **self.params(),
+                    )
+        return _checkout(self._pool, timeout)
+
+    def weight(self) -> float:
+        # Inverse latency, floored so one idle-fast replica does not take everything.
+        return 1.0 / max(self.latency, 0.002)
+
+    def record(self, elapsed: float, ok: bool = True) -> None:
+        with self._lock:
+            self.reads += 1
+            if ok:
+                # Failures are the breaker's business; a fast error must not look like a fast replica.
+                self.latency = elapsed if not self.latency else self.latency + self.ALPHA * (elapsed - self.latency)
+        self.breaker.record(elapsed, ok)
+
+    def timed(self, execute: Callable[..., Any], *args, **kwargs) -> Any:
+        """Runs ``execute(*args, **kwargs)``, recording its latency and outcome."""
+        started = time.monotonic()
+        try:
+            result = execute(*args, **kwargs)
+        except Exception:
+            self.record(time.monotonic() - started, ok=False)
+            raise
+        self.record(time.monotonic() - started)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {"replica": self.name, "reads": self.reads, "latency_ms": round(self.latency * 1000, 2),
+                "weight": round(self.weight(), 1), **self.breaker.stats()}
+
+
+def pick_replica() -> Optional[Replica]:
+    """
+    A replica for the next read, chosen at random weighted by health; None when no
+    replica is configured or all of them are out of rotation. A replica whose
+    breaker is due for its trial read gets that read first.
+    """
+    candidates = [r for r in replicas if not r.breaker.is_open()]
+    for replica in candidates:
+        if replica.breaker.state != "closed" and replica.breaker.allow():
+            return replica
+    healthy = [r for r in candidates if r.breaker.state == "closed"]
+    if not healthy:
+        return None
+    return random.choices(healthy, weights=[r.weight() for r in healthy])[0]
+
+
+def replica_stats() -> List[Dict[str, Any]]:
+    return [r.stats() for r in replicas]
+
+
+# ─────────────────────── CIRCUIT BREAKER ───────────────────────
+class CircuitBreaker:
+    """
+    Closed: every call goes through. Open (after ``failures`` consecutive bad calls):
+    calls are refused for ``reset_timeout`` seconds. Half-open: one trial call goes
+    through; its outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, name: str, failures: int = DB_BREAKER_FAILURES,
+                 reset_timeout: float = DB_BREAKER_RESET, latency_budget: float = DB_READ_BUDGET):
+        self.name = name
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.latency_budget = latency_budget
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.refused = 0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Whether a call may go to the database now; a True in half-open state is the single trial."""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._trial_running:
+                self._trial_running = True
+                return True
+            self.refused += 1
+            return False
+
+    def is_open(self) -> bool:
+        with self._lock:
+            return self.state == "open" and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def retry_after(self) -> float:
+        with self._lock:
+            return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record(self, elapsed: float, ok: bool = True) -> None:
+        """Reports an allowed call's outcome; a call over the latency budget counts as a failure."""
+        ok = ok and elapsed <= self.latency_budget
+        with self._lock:
+            self._trial_running = False
+            if ok:
+                if self.state != "closed":
+                    print(f"[DB] {self.name} circuit closed")
+                self.state = "closed"
+                self.consecutive_failures = 0
+                return
+            self.consecutive_failures += 1
+            if self.state == "half_open" or self.consecutive_failures >= self.failures:
+                if self.state != "open":
+                    print(f"[DB] {self.name} circuit open after {self.consecutive_failures} bad call(s)")
+                    self.times_opened += 1
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def release(self) -> None:
+        """Gives back an allowed call that ended without an outcome for the database (rejected, cancelled)."""
+        with self._lock:
+            self._trial_running = False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self.consecutive_failures,
+                    "times_opened": self.times_opened, "refused": self.refused}
+
+
+# Guards the cached read paths in catalog.py.
+read_breaker = CircuitBreaker("read")
+replicas = [Replica(address, i) for i, address in enumerate(DB_REPLICA_HOSTS)]
+
+
+# ───────────────────── PREPARED STATEMENTS ─────────────────────
+STATEMENTS = {
+    # Options, add-ons, price, discount and cart attribute id of one product in a single round trip.
+    "product_bundle": """
+        SELECT
+            (SELECT JSON_ARRAYAGG(JSON_OBJECT(
+                        'option_name', o.option_name,
+                        'option_values', CAST(o.option_values AS CHAR),
+                        'is_required', o.is_required,
+                        'max_selections', o.max_selections))
+             FROM tbl_product_options AS o
+             WHERE o.product_id = p.id AND o.status = 1) AS options,
+            (SELECT JSON_ARRAYAGG(JSON_OBJECT(
+                        'addon_name', a.addon_name,
+                        'addon_price', a.addon_price,
+                        'addon_category', a.addon_category,
+                        'is_required', a.is_required))
+             FROM tbl_product_addons AS a
+             WHERE a.product_id = p.id AND a.status = 1) AS addons,
+            (SELECT pa.normal_price FROM tbl_product_attribute AS pa
+             WHERE pa.product_id = p.id ORDER BY pa.id LIMIT 1) AS normal_price,
+            (SELECT pa.discount FROM tbl_product_attribute AS pa
+             WHERE pa.product_id = p.id ORDER BY pa.id LIMIT 1) AS discount,
+            (SELECT pa.id FROM tbl_product_attribute AS pa
+             WHERE pa.product_id = p.id
+               AND pa.store_id = COALESCE(p.store_id, (SELECT store_id FROM tbl_product WHERE id = p.id))
+             ORDER BY pa.id LIMIT 1) AS attribute_id
+        FROM (SELECT %s AS id, %s AS store_id) AS p
+    """,
+    # Only the cart attribute id, for inserts whose caller has no bundle at hand.
+    "attribute_id": """
+        SELECT pa.id AS attribute_id FROM tbl_product_attribute AS pa
+        WHERE pa.product_id = %s
+          AND pa.store_id = COALESCE(%s, (SELECT store_id FROM tbl_product WHERE id = pa.product_id))
+        ORDER BY pa.id LIMIT 1
+    """,
+    "cart_insert": """
+        INSERT INTO tbl_cart_data (
+            uid, store_id, product_id, attribute_id, quantity, price,
+            product_title, product_img, cart_type, variation, visible, subscription_data
+        )
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """,
+}
+
+# underlying connection -> {statement name: prepared cursor}
+_prepared_cursors: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def execute_prepared(conn, name: str, params: Sequence[Any]) -> List[Dict[str, Any]]:
+    """
+    Runs one of ``STATEMENTS`` as a server-side prepared statement.
+    The prepared cursor is kept per physical connection, so pooled connections
+    prepare each statement once and only send parameters afterwards.
+    """
+    raw = conn.raw if isinstance(conn, TrackedConnection) else conn
+    raw = getattr(raw, "_cnx", None) or raw
+    cursors = _prepared_cursors.setdefault(raw, {})
+    cursor = cursors.get(name)
+    if cursor is None:
+        cursor = raw.cursor(prepared=True, dictionary=True)
+        cursors[name] = cursor
+    replica = conn.replica if isinstance(conn, TrackedConnection) else None
+    try:
+        _count_query()
+        if replica is None:
+            cursor.execute(STATEMENTS[name], tuple(params))
+        else:
+            replica.timed(cursor.execute, STATEMENTS[name], tuple(params))
+        return cursor.fetchall() if cursor.with_rows else []
+    except mysql.connector.Error:
+        # The statement handle may be gone (reconnect, server restart); prepare afresh next time.
+        cursors.pop(name, None)
+        raise
+
+
+# ─────────────────────── PRODUCT BUNDLE ───────────────────────
+# (column, raw JSON) -> decoded value. Bundles are re-read every DETAILS_CACHE_TTL
+# but their JSON rarely changes, and many products share one set of sizes, so
+# each distinct payload is decoded once. Decoded values are shared: read-only.
+_decoded_columns = LRUCache(maxsize=8192)
+
+
+def _json_column(value: Any) -> List[Dict[str, Any]]:
+    if value is None:
+        return []
+    if isinstance(value, (bytes, bytearray)):
+        value = value.decode("utf-8")
+    if isinstance(value, str):
+        value = json.loads(value, parse_float=Decimal)
+    return value or []
+
+
+def _decode_options(value: Any) -> List[Dict[str, Any]]:
+    options = _json_column(value)
+    for opt in options:
+        if isinstance(opt.get("option_values"), str):
+            opt["option_values"] = _cached_decode("option_values", opt["option_values"], fastjson.loads)
+    return options
+
+
+def _cached_decode(column: str, value: Any, decode) -> Any:
+    if isinstance(value, (bytes, bytearray)):
+        value = value.decode("utf-8")
+    if not isinstance(value, str):
+        return decode(value)
+    key = (column, value)
+    decoded = _decoded_columns.get(key)
+    if decoded is None:
+        decoded = decode(value)
+        _decoded_columns.put(key, decoded)
+    return decoded
+
+
+@tracing.timed("fetch_product_details")
+def fetch_product_bundle(conn, item_id: int, store_id: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Options, add-ons, normal price, discount and attribute id for a product in one round trip.
+    Raises ``mysql.connector.Error`` / ``json.JSONDecodeError`` for the caller to handle.
+    """
+    rows = execute_prepared(conn, "product_bundle", (item_id, store_id))
+    return bundle_from_row(rows[0] if rows else None)
+
+
+@tracing.timed("fetch_attribute_id")
+def fetch_attribute_id(conn, item_id: int, store_id: Optional[int] = None) -> Optional[int]:
+    """The product's cart attribute id (as in its bundle), or None when it has no attribute row."""
+    rows = execute_prepared(conn, "attribute_id", (item_id, store_id))
+    return rows[0]["attribute_id"] if rows else None
+
+
+def bundle_from_row(row: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Decodes a "product_bundle" row (None when the statement returned nothing)."""
+    bundle = {"options": [], "addons": [], "normal_price": None, "discount": 0.0, "attribute_id": 0}
+    if row is None:
+        return bundle
+
+    bundle["options"] = _cached_decode("options", row.get("options"), _decode_options)
+    bundle["addons"] = _cached_decode("addons", row.get("addons"), _json_column)
+
+    if row.get("normal_price") is not None:
+        bundle["normal_price"] = float(row["normal_price"])
+    if row.get("discount"):
+        bundle["discount"] = float(row["discount"])
+    if row.get("attribute_id"):
+        bundle["attribute_id"] = row["attribute_id"]
+    return bundle
@@ -0,0 +1,191 @@
+"""
+Async counterparts of the chat API's database reads and writes, for asgi_app.py.
+
+With DB_BACKEND=mysql they run on an aiomysql pool, using the same SQL and row
+decoding as the sync path (db.py, ordering.py, catalog.py). Reads go to the
+replica db.pick_replica() chooses, on a pool per replica, and report their
+latency and failures to it the way sync reads do. The SQLite stand-in
+has no async driver, so with DB_BACKEND=sqlite the sync functions run on worker
+threads instead.
+"""
+import os
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence
+
+import db
+import catalog
+from ordering import STORE_MENU_SQL, USER_NAME_SQL, load_store_menu as _load_store_menu, menu_from_rows
+
+# ─────────────────────────── CONFIG ───────────────────────────
+# Connections per event loop (one loop per uvicorn worker).
+ASYNC_DB_POOL_SIZE = int(os.getenv("ASYNC_DB_POOL_SIZE", "32"))
+ASYNC_DB_POOL_TIMEOUT = float(os.getenv("ASYNC_DB_POOL_TIMEOUT", str(db.DB_POOL_TIMEOUT)))
+
+_pool = None
+# db.Replica.index -> its pool
+_replica_pools: Dict[int, Any] = {}
+_pool_lock: Optional[asyncio.Lock] = None
+
+
+async def _create_pool(params: Dict[str, Any]):
+    import aiomysql
+    return await aiomysql.create_pool(
+        minsize=1,
+        maxsize=ASYNC_DB_POOL_SIZE,
+        autocommit=True,
+        host=params["host"] or "localhost",
+        port=params.get("port") or 3306,
+        user=params["user"],
+        password=params["password"] or "",
+        db=params["database"],
+        charset=params["charset"],
+    )
+
+
+async def get_pool(replica: Optional[db.Replica] = None):
+    """The primary's pool, or ``replica``'s."""
+    global _pool, _pool_lock
+    pool = _pool if replica is None else _replica_pools.get(replica.index)
+    if pool is None:
+        if _pool_lock is None:
+            _pool_lock = asyncio.Lock()
+        async with _pool_lock:
+            if replica is None:
+                if _pool is None:
+                    _pool = await _create_pool(db.connection_params())
+                pool = _pool
+            else:
+                if replica.index not in _replica_pools:
+                    _replica_pools[replica.index] = await _create_pool(replica.params())
+                pool = _replica_pools[replica.index]
+    return pool
+
+
+async def close_pool() -> None:
+    global _pool
+    pools = list(_replica_pools.values()) + ([_pool] if _pool is not None else [])
+    _pool = None
+    _replica_pools.clear()
+    for pool in pools:
+        pool.close()
+        await pool.wait_closed()
+
+
+@asynccontextmanager
+async def cursor(read: bool = False) -> AsyncIterator[Any]:
+    """
+    A dict cursor on a pooled connection; waits up to ASYNC_DB_POOL_TIMEOUT for one.
+    ``read`` cursors are on a replica when one is healthy.
+    """
+    import aiomysql
+    replica = db.pick_replica() if read else None
+    pool = conn = None
+    started = time.monotonic()
+    try:
+        pool = await get_pool(replica)
+        conn = await asyncio.wait_for(pool.acquire(), ASYNC_DB_POOL_TIMEOUT)
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            yield cur
+    except BaseException:
+        # Including cancellation by the turn deadline: a replica's trial read must always report back.
+        if replica is not None:
+            replica.record(time.monotonic() - started, ok=False)
+        raise
+    else:
+        if replica is not None:
+            replica.record(time.monotonic() - started)
+    finally:
+        if conn is not None:
+            pool.release(conn)
+
+
+async def _in_thread(load, *args, read: bool = False) -> Any:
+    """``load(conn, *args)`` on a sync connection of its own, off the event loop."""
+    def run():
+        conn = db.get_read_connection() if read else db.get_connection()
+        try:
+            return load(conn, *args)
+        finally:
+            conn.close()
+    return await asyncio.to_thread(run)
+
+
+def _sqlite() -> bool:
+    return db.DB_BACKEND == "sqlite"
+
+
+# ─────────────────────────── READS ───────────────────────────
+async def load_store_menu(store_id: int) -> List[Dict[str, Any]]:
+    """See ordering.load_store_menu; raises on database errors."""
+    if _sqlite():
+        return await _in_thread(_load_store_menu, store_id, read=True)
+    async with cursor(read=True) as cur:
+        await cur.execute(STORE_MENU_SQL, (store_id,))
+        return menu_from_rows(list(await cur.fetchall()))
+
+
+async def fetch_product_bundle(item_id: int, store_id: Optional[int] = None, primary: bool = False) -> Dict[str, Any]:
+    """See db.fetch_product_bundle; ``primary`` for prices that are about to be written. Raises on database errors."""
+    if _sqlite():
+        return await _in_thread(db.fetch_product_bundle, item_id, store_id, read=not primary)
+    async with cursor(read=not primary) as cur:
+        await cur.execute(db.STATEMENTS["product_bundle"], (item_id, store_id))
+        return db.bundle_from_row(await cur.fetchone())
+
+
+async def fetch_user_name(user_id: int) -> str:
+    if _sqlite():
+        return await _in_thread(lambda conn: _fetch_name(conn, USER_NAME_SQL, user_id, "name", "Customer"), read=True)
+    async with cursor(read=True) as cur:
+        await cur.execute(USER_NAME_SQL, (user_id,))
+        row = await cur.fetchone()
+    return row["name"] if row and row["name"] else "Customer"
+
+
+async def fetch_store_name(store_id: int) -> str:
+    if _sqlite():
+        return await _in_thread(lambda conn: _fetch_name(conn, catalog.STORE_NAME_SQL, store_id, "title", "Store"), read=True)
+    async with cursor(read=True) as cur:
+        await cur.execute(catalog.STORE_NAME_SQL, (store_id,))
+        return catalog.store_title(await cur.fetchone())
+
+
+def _fetch_name(conn, sql: str, key: Any, column: str, default: str) -> str:
+    with conn.cursor(dictionary=True) as cur:
+        cur.execute(sql, (key,))
+        row = cur.fetchone()
+    return row[column] if row and row.get(column) else default
+
+
+# ─────────────────────────── WRITES ───────────────────────────
+async def insert_cart_rows(rows: Sequence[Sequence[Any]]) -> None:
+    """Inserts ordering.cart_row tuples in one transaction."""
+    if not rows:
+        return
+    if _sqlite():
+        def insert(conn):
+            conn.start_transaction()
+            try:
+                with conn.cursor() as cur:
+                    cur.executemany(db.STATEMENTS["cart_insert"], [tuple(r) for r in rows])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return await _in_thread(insert)
+
+    pool = await get_pool()
+    conn = await asyncio.wait_for(pool.acquire(), ASYNC_DB_POOL_TIMEOUT)
+    try:
+        await conn.begin()
+        try:
+            async with conn.cursor() as cur:
+                await cur.executemany(db.STATEMENTS["cart_insert"], [tuple(r) for r in rows])
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+    finally:
+        pool.release(conn)
@@ -0,0 +1,173 @@
+"""
+A SQLite stand-in for the MySQL database, for load tests and offline runs.
+
+``connect()`` returns an object with the slice of the mysql.connector connection
+and cursor API this project uses (dictionary/buffered/prepared cursors, ``%s``
+placeholders, commit/close), and rewrites the few MySQL-only SQL functions the
+queries rely on. Enabled in db.get_connection with ``DB_BACKEND=sqlite``.
+"""
+import re
+import sqlite3
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Sequence
+
+sqlite3.register_adapter(Decimal, str)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS service_details (
+    id INTEGER PRIMARY KEY, title TEXT, status INTEGER DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS tbl_user (
+    id INTEGER PRIMARY KEY, name TEXT, ustatus INTEGER DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS tbl_mcat (
+    id INTEGER PRIMARY KEY, title TEXT
+);
+CREATE TABLE IF NOT EXISTS tbl_mcat_sub (
+    sub_id INTEGER PRIMARY KEY, sub_name TEXT, mcat_id INTEGER
+);
+CREATE TABLE IF NOT EXISTS tbl_product (
+    id INTEGER PRIMARY KEY, title TEXT, description TEXT, status INTEGER DEFAULT 1,
+    store_id INTEGER, cat_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_product_store ON tbl_product (store_id, status);
+CREATE TABLE IF NOT EXISTS tbl_product_attribute (
+    id INTEGER PRIMARY KEY, product_id INTEGER, store_id INTEGER, title TEXT,
+    normal_price REAL, discount REAL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_attribute_product ON tbl_product_attribute (product_id);
+CREATE TABLE IF NOT EXISTS tbl_product_options (
+    id INTEGER PRIMARY KEY, product_id INTEGER, option_name TEXT, option_values TEXT,
+    is_required INTEGER DEFAULT 0, max_selections INTEGER DEFAULT 1, status INTEGER DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS idx_options_product ON tbl_product_options (product_id);
+CREATE TABLE IF NOT EXISTS tbl_product_addons (
+    id INTEGER PRIMARY KEY, product_id INTEGER, addon_name TEXT, addon_price REAL,
+    addon_category TEXT, is_required INTEGER DEFAULT 0, status INTEGER DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS idx_addons_product ON tbl_product_addons (product_id);
+CREATE TABLE IF NOT EXISTS menu_questions (
+    id INTEGER PRIMARY KEY, item_id INTEGER, question_text TEXT, question_type TEXT,
+    required INTEGER DEFAULT 0, sort_order INTEGER DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS tbl_cart_data (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, uid INTEGER, store_id INTEGER, product_id INTEGER,
+    attribute_id INTEGER, quantity INTEGER, price REAL, product_title TEXT, product_img TEXT,
+    cart_type TEXT, variation TEXT, visible INTEGER, subscription_data TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_cart_store ON tbl_cart_data (store_id, product_id);
+"""
+
+# MySQL spelling -> SQLite spelling
+_REWRITES = [
+    (re.compile(r"\bJSON_ARRAYAGG\(", re.I), "json_group_array("),
+    (re.compile(r"\bJSON_OBJECT\(", re.I), "json_object("),
+    (re.compile(r"\bAS\s+CHAR\)", re.I), "AS TEXT)"),
+    (re.compile(r"%s"), "?"),
+]
+_translated: Dict[str, str] = {}
+
+
+def translate(operation: str) -> str:
+    sql = _translated.get(operation)
+    if sql is None:
+        sql = operation
+        for pattern, replacement in _REWRITES:
+            sql = pattern.sub(replacement, sql)
+        _translated[operation] = sql
+    return sql
+
+
+class SQLiteCursor:
+    def __init__(self, conn: sqlite3.Connection, dictionary: bool = False):
+        self._conn = conn
+        self._dictionary = dictionary
+        self._rows: List[Any] = []
+        self._pos = 0
+        self.description = None
+        self.rowcount = -1
+        self.lastrowid = None
+
+    def execute(self, operation: str, params: Optional[Sequence[Any]] = None) -> None:
+        cur = self._conn.execute(translate(operation), tuple(params or ()))
+        self.description = cur.description
+        self.rowcount = cur.rowcount
+        self.lastrowid = cur.lastrowid
+        rows = cur.fetchall() if cur.description else []
+        if self._dictionary and cur.description:
+            names = [col[0] for col in cur.description]
+            rows = [dict(zip(names, row)) for row in rows]
+        self._rows, self._pos = rows, 0
+
+    def executemany(self, operation: str, seq_params: Sequence[Sequence[Any]]) -> None:
+        cur = self._conn.executemany(translate(operation), [tuple(p) for p in seq_params])
+        self.rowcount = cur.rowcount
+        self._rows, self._pos, self.description = [], 0, None
+
+    @property
+    def with_rows(self) -> bool:
+        return self.description is not None
+
+    def fetchone(self) -> Any:
+        if self._pos >= len(self._rows):
+            return None
+        row = self._rows[self._pos]
+        self._pos += 1
+        return row
+
+    def fetchall(self) -> List[Any]:
+        rows = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return rows
+
+    def close(self) -> None:
+        self._rows = []
+
+    def __enter__(self) -> "SQLiteCursor":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class SQLiteConnection:
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA busy_timeout = 10000")
+
+    def cursor(self, dictionary: bool = False, buffered: bool = False, prepared: bool = False, **_: Any) -> SQLiteCursor:
+        return SQLiteCursor(self._conn, dictionary=dictionary)
+
+    def is_connected(self) -> bool:
+        return True
+
+    def ping(self, *_: Any, **__: Any) -> None:
+        pass
+
+    def start_transaction(self) -> None:
+        self._conn.execute("BEGIN")
+
+    def commit(self) -> None:
+        if self._conn.in_transaction:
+            self._conn.commit()
+
+    def rollback(self) -> None:
+        if self._conn.in_transaction:
+            self._conn.rollback()
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def connect(path: str) -> SQLiteConnection:
+    return SQLiteConnection(path)
+
+
+def create_schema(path: str) -> None:
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.executescript(SCHEMA)
+        conn.commit()
+    finally:
+        conn.close()
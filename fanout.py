@@ -0,0 +1,170 @@
+"""
+Runs the independent lookups of one turn at the same time.
+
+``gather`` hands every task a lazy ``connect`` callable that checks a connection
+out of the pool only if the task misses the caches, so a turn costs about as
+long as its slowest lookup instead of the sum. All tasks share the turn's
+deadline (begin_turn); tasks that have not started by then are cancelled, and
+ones already running finish in the background and return their connections.
+A caller that passes its own ``connect`` runs every task no worker has started
+on it, and workers that find the pool empty hand their task back instead of
+waiting, so a turn holding a connection never waits on connections other such
+turns hold.
+The per-thread bookkeeping of the worker (query count, stage timings, stale
+flag) is folded back into the calling turn.
+"""
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Hashable, Optional
+from mysql.connector import pooling
+
+import db
+import catalog
+import tracing
+
+# ─────────────────────────── CONFIG ───────────────────────────
+# Wall-clock budget of one turn's parallel lookups, in seconds.
+TURN_DEADLINE = float(os.getenv("TURN_DEADLINE", "5"))
+# Kept below the pool size so fanned-out lookups never take every connection.
+FANOUT_WORKERS = min(int(os.getenv("FANOUT_WORKERS", str(db.DB_POOL_SIZE - 1))), db.DB_POOL_SIZE - 1) or 1
+# How long a worker waits for a connection before handing its task back to a caller that has one.
+FANOUT_CHECKOUT_WAIT = float(os.getenv("FANOUT_CHECKOUT_WAIT", "0.05"))
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+_local = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    """The turn ran out of time waiting for its lookups."""
+
+
+class _PoolBusy(Exception):
+    """No connection for a worker; the task goes back to the caller (deliberately not a mysql Error)."""
+
+
+def begin_turn(budget: float = TURN_DEADLINE) -> None:
+    _local.deadline = time.monotonic() + budget
+
+
+def remaining() -> float:
+    """Seconds left of the current turn's deadline (the full budget outside a turn)."""
+    deadline = getattr(_local, "deadline", None)
+    return TURN_DEADLINE if deadline is None else max(0.0, deadline - time.monotonic())
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="fanout")
+    return _executor
+
+
+def _run(task: Callable[[Callable[[], Any]], Any], deadline: float, checkout: Callable[..., Any],
+         handback: bool):
+    """
+    Runs one task on a worker thread with its own connection, checked out with
+    ``checkout`` on first use. Returns ``(ok, result or error, (queries, trace, stale))``
+    for the caller to fold back; ``ok`` is None when ``handback`` is set and no
+    connection was free within FANOUT_CHECKOUT_WAIT.
+    """
+    _local.deadline = deadline
+    checked_out = []
+
+    def connect():
+        if not checked_out:
+            if not handback:
+                checked_out.append(checkout(timeout=max(remaining(), 0.01)))
+            else:
+                try:
+                    checked_out.append(checkout(timeout=FANOUT_CHECKOUT_WAIT))
+                except pooling.PoolError as err:
+                    raise _PoolBusy() from err
+        return checked_out[0]
+
+    db.reset_query_count()
+    catalog.reset_stale()
+    tracing.begin()
+    try:
+        ok, value = True, task(connect)
+    except _PoolBusy:
+        ok, value = None, None
+    except Exception as err:
+        ok, value = False, err
+    finally:
+        for conn in checked_out:
+            conn.close()
+    return ok, value, (db.query_count(), tracing.end(), catalog.served_stale())
+
+
+def _inline(task: Callable[[Callable[[], Any]], Any], connect: Callable[[], Any]) -> Any:
+    try:
+        return task(connect)
+    except _PoolBusy:
+        # Shared from a coalesced read whose worker found the pool empty; this thread has a connection.
+        return task(connect)
+
+
+def gather(tasks: Dict[Hashable, Callable[[Callable[[], Any]], Any]],
+           connect: Optional[Callable[[], Any]] = None,
+           checkout: Optional[Callable[..., Any]] = None) -> Dict[Hashable, Any]:
+    """
+    Runs ``task(connect)`` for every entry concurrently and returns their results by key.
+    The first task error is re-raised once all tasks are done; ``DeadlineExceeded`` is
+    raised when the turn's deadline passes first. Worker threads get their connections
+    from ``checkout``: db.get_connection (the primary) by default, db.get_read_connection
+    for plain reads. With the caller's ``connect``, the caller also runs tasks on it:
+    those no worker has picked up yet and those whose worker found the pool empty.
+    """
+    if not tasks:
+        return {}
+    if len(tasks) == 1 and connect is not None:
+        key, task = next(iter(tasks.items()))
+        return {key: task(connect)}
+
+    checkout = checkout or db.get_connection
+    deadline = getattr(_local, "deadline", None) or time.monotonic() + TURN_DEADLINE
+    handback = connect is not None
+    executor = _get_executor()
+    futures = {key: executor.submit(_run, task, deadline, checkout, handback) for key, task in tasks.items()}
+
+    results, error = {}, None
+    if handback:
+        for key, future in futures.items():
+            if future.cancel():
+                try:
+                    results[key] = _inline(tasks[key], connect)
+                except Exception as err:
+                    error = error or err
+    done, pending = wait([f for f in futures.values() if not f.cancelled()],
+                         timeout=max(0.0, deadline - time.monotonic()))
+    for future in pending:
+        future.cancel()
+
+    for key, future in futures.items():
+        if future not in done:
+            continue
+        ok, value, (queries, trace, stale) = future.result()
+        db.add_query_count(queries)
+        if trace is not None:
+            tracing.merge(trace)
+        if stale:
+            catalog.mark_stale()
+        if ok is None:
+            try:
+                value, ok = _inline(tasks[key], connect), True
+            except Exception as err:
+                value, ok = err, False
+        if ok:
+            results[key] = value
+        elif error is None:
+            error = value
+    if pending:
+        raise DeadlineExceeded(f"{len(pending)} of {len(futures)} lookups unfinished after the turn deadline")
+    if error is not None:
+        raise error
+    return results
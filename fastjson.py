@@ -0,0 +1,75 @@
+"""
+JSON encoding for API responses, cart variations and stored payloads.
+
+orjson is used when it is installed and the stdlib encoder otherwise;
+JSON_BACKEND=stdlib forces the stdlib. Both produce compact UTF-8 bytes and
+encode Decimal, UUID, dates and dataclasses the way Flask's default provider
+does, so the backend can be switched without changing any payload.
+"""
+import os
+import json
+import uuid
+import datetime
+import dataclasses
+from decimal import Decimal
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # optional speed-up, see requirements.txt
+    orjson = None
+
+# ─────────────────────────── CONFIG ───────────────────────────
+# "auto" (orjson if installed), "orjson" or "stdlib"
+JSON_BACKEND = os.getenv("JSON_BACKEND", "auto").lower()
+
+if JSON_BACKEND == "orjson" and orjson is None:
+    print("[JSON] JSON_BACKEND=orjson but orjson is not installed; using the stdlib encoder")
+BACKEND = "orjson" if orjson is not None and JSON_BACKEND != "stdlib" else "stdlib"
+
+
+def _default(o: Any) -> Any:
+    if isinstance(o, (Decimal, uuid.UUID)):
+        return str(o)
+    if isinstance(o, (datetime.date, datetime.datetime)):
+        return o.isoformat()
+    if dataclasses.is_dataclass(o) and not isinstance(o, type):
+        return dataclasses.asdict(o)
+    if hasattr(o, "__html__"):
+        return str(o.__html__())
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+if BACKEND == "orjson":
+    _OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj, default=_default, option=_OPTIONS)
+
+    loads = orjson.loads
+else:
+    _encoder = json.JSONEncoder(default=_default, ensure_ascii=False, separators=(",", ":"))
+
+    def dumps(obj: Any) -> bytes:
+        return _encoder.encode(obj).encode("utf-8")
+
+    def loads(data: Any) -> Any:
+        return json.loads(data)
+
+# What either backend raises on malformed input (orjson's error subclasses it).
+DecodeError = json.JSONDecodeError
+
+
+def dumps_str(obj: Any) -> str:
+    return dumps(obj).decode("utf-8")
+
+
+def with_fields(body: bytes, **fields: Any) -> bytes:
+    """
+    Adds ``fields`` to a pre-serialized JSON object, so a cached response body
+    only has its per-request parts encoded.
+    """
+    extra = dumps(fields)
+    if body == b"{}":
+        return extra
+    return body[:-1] + b"," + extra[1:]
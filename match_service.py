@@ -0,0 +1,211 @@
+"""
+Optional process pool for fuzzy matching against large menus.
+
+With MATCH_SERVICE_WORKERS > 0, matching.extract and extract_batch hand the scoring
+of name lists with at least MATCH_SERVICE_MIN_CHOICES entries to worker processes
+instead of running it on the request thread. Each worker keeps the pre-processed
+name arrays it has been sent, one per (store, menu version, corpus), so a menu
+crosses the process boundary once per worker and version; a query then carries
+only its utterances over a pipe and gets ``(index, score)`` pairs back. The
+request thread waits on the pipe with the GIL released, so other requests on the
+same worker keep running, and matching spreads over as many cores as there are
+processes. A failed or overdue worker is replaced and the query is scored
+in-process instead.
+"""
+import os
+import queue
+import threading
+import multiprocessing
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple
+
+# ─────────────────────────── CONFIG ───────────────────────────
+MATCH_SERVICE_WORKERS = int(os.getenv("MATCH_SERVICE_WORKERS", "0"))
+MATCH_SERVICE_MIN_CHOICES = int(os.getenv("MATCH_SERVICE_MIN_CHOICES", "2000"))
+# Longest a query waits for a free worker, and then for its answer.
+MATCH_SERVICE_TIMEOUT = float(os.getenv("MATCH_SERVICE_TIMEOUT", "2"))
+# Name arrays each worker keeps; the least recently used is dropped first.
+MATCH_SERVICE_CORPORA = int(os.getenv("MATCH_SERVICE_CORPORA", "256"))
+
+
+class Unavailable(Exception):
+    """No worker answered in time; the caller scores in-process."""
+
+
+# ─────────────────────── WORKER PROCESS ───────────────────────
+def _serve(conn) -> None:
+    """
+    A worker's loop. Messages, in pipe order:
+    ("load", key, choices, preprocessed) stores a name array (no reply);
+    ("match", key, queries, limit, score_cutoff) answers ("ok", rows of (index, score))
+    or ("missing",) when the array was dropped and must be sent again.
+    """
+    from rapidfuzz import process as fuzz_process
+    from rapidfuzz.utils import default_process
+    from cache import LRUCache
+    import matching
+
+    # The pool is the parallelism; one scoring thread per process.
+    matching.MATCH_WORKERS = 1
+    corpora = LRUCache(MATCH_SERVICE_CORPORA)
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return
+        if message[0] == "load":
+            _, key, choices, preprocessed = message
+            corpora.put(key, (choices if preprocessed else [default_process(c) for c in choices], preprocessed))
+            continue
+
+        _, key, queries, limit, score_cutoff = message
+        entry = corpora.get(key)
+        if entry is None:
+            conn.send(("missing",))
+            continue
+        choices, preprocessed = entry
+        if not preprocessed:
+            queries = [default_process(q) for q in queries]
+        if len(queries) == 1:
+            rows = [fuzz_process.extract(queries[0], choices, processor=None, limit=limit, score_cutoff=score_cutoff)]
+        else:
+            rows = matching._score_matrix(queries, choices, None, limit, score_cutoff)
+        conn.send(("ok", [[(idx, score) for _, score, idx in row] for row in rows]))
+
+
+# ──────────────────────────── POOL ────────────────────────────
+class _Worker:
+    def __init__(self, ctx):
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=_serve, args=(child,), name="match-service", daemon=True)
+        self.process.start()
+        child.close()
+        # Keys of the name arrays this process holds (or is about to).
+        self.loaded: set = set()
+
+    def close(self) -> None:
+        self.conn.close()
+        self.process.terminate()
+
+
+class MatchService:
+    def __init__(self, workers: int):
+        # spawn, not fork: the web worker's threads and locks must not be copied into the children.
+        self._ctx = multiprocessing.get_context("spawn")
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        self._workers = [_Worker(self._ctx) for _ in range(workers)]
+        for worker in self._workers:
+            self._idle.put(worker)
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.loads = 0
+        self.failures = 0
+        self.restarts = 0
+
+    def match(self, key: Hashable, choices: Sequence[str], queries: Sequence[str], preprocessed: bool,
+              limit: Optional[int], score_cutoff: Optional[float],
+              timeout: float = MATCH_SERVICE_TIMEOUT) -> List[List[Tuple[int, float]]]:
+        """``(index, score)`` rows, one per query, ranked like rapidfuzz's extract; raises ``Unavailable``."""
+        try:
+            worker = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            self._count("failures")
+            raise Unavailable("all match workers are busy")
+        try:
+            if not worker.process.is_alive():
+                worker = self._replace(worker)
+            for _ in range(2):
+                if key not in worker.loaded:
+                    worker.conn.send(("load", key, list(choices), preprocessed))
+                    worker.loaded.add(key)
+                    self._count("loads")
+                worker.conn.send(("match", key, list(queries), limit, score_cutoff))
+                if not worker.conn.poll(timeout):
+                    raise Unavailable(f"no answer within {timeout}s")
+                reply = worker.conn.recv()
+                if reply[0] == "ok":
+                    self._count("queries")
+                    return reply[1]
+                # The worker dropped this array to make room; send it again.
+                worker.loaded.discard(key)
+            raise Unavailable("name array dropped twice")
+        except (Unavailable, OSError, EOFError) as err:
+            self._count("failures")
+            # A late reply would put the pipe out of step; start over with a fresh process.
+            worker = self._replace(worker)
+            raise Unavailable(str(err)) from err
+        finally:
+            self._idle.put(worker)
+
+    def _replace(self, worker: _Worker) -> _Worker:
+        worker.close()
+        fresh = _Worker(self._ctx)
+        with self._lock:
+            self._workers[self._workers.index(worker)] = fresh
+            self.restarts += 1
+        return fresh
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def close(self) -> None:
+        for worker in self._workers:
+            worker.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"workers": len(self._workers), "queries": self.queries, "loads": self.loads,
+                    "failures": self.failures, "restarts": self.restarts}
+
+
+_service: Optional[MatchService] = None
+_service_lock = threading.Lock()
+
+
+def start(workers: int = MATCH_SERVICE_WORKERS) -> MatchService:
+    """Starts (or restarts with ``workers`` processes) the service used by offload()."""
+    global _service
+    with _service_lock:
+        if _service is not None:
+            _service.close()
+        _service = MatchService(workers)
+        return _service
+
+
+def stop() -> None:
+    global _service
+    with _service_lock:
+        if _service is not None:
+            _service.close()
+            _service = None
+
+
+def get_service() -> Optional[MatchService]:
+    """The running service; started on first use when MATCH_SERVICE_WORKERS is set."""
+    global _service
+    if _service is None and MATCH_SERVICE_WORKERS > 0:
+        with _service_lock:
+            if _service is None:
+                _service = MatchService(MATCH_SERVICE_WORKERS)
+    return _service
+
+
+def offload(store_id: Any, version: str, corpus: str, queries: Sequence[str], choices: Sequence[str],
+            preprocessed: bool, limit: Optional[int],
+            score_cutoff: Optional[float]) -> Optional[List[List[Tuple[str, float, int]]]]:
+    """
+    ``(name, score, idx)`` rows for ``queries`` from the service, or None when it is
+    off, the list is too short to be worth the round trip, or no worker answered.
+    """
+    if len(choices) < MATCH_SERVICE_MIN_CHOICES:
+        return None
+    service = get_service()
+    if service is None:
+        return None
+    try:
+        rows = service.match((store_id, version, corpus, preprocessed), choices, queries, preprocessed,
+                             limit, score_cutoff)
+    except Unavailable as err:
+        print(f"[Matching] Service unavailable, scoring in-process: {err}")
+        return None
+    return [[(choices[idx], score, idx) for idx, score in row] for row in rows]
@@ -0,0 +1,421 @@
+import os
+import re
+import hashlib
+import threading
+from bisect import bisect_left
+from typing import List, Dict, Any, Optional, Sequence, Tuple
+from rapidfuzz import fuzz, process as fuzz_process
+from rapidfuzz.utils import default_process
+
+try:
+    import numpy as np
+except ImportError:  # batch scoring falls back to one query at a time
+    np = None
+
+from cache import LRUCache
+import match_service
+import tracing
+
+# ─────────────────────────── CONFIG ───────────────────────────
+MATCH_CACHE_SIZE = int(os.getenv("MATCH_CACHE_SIZE", "4096"))
+# Added to a fuzzy score when every spoken word sounds like a word of the item name.
+PHONETIC_BONUS = float(os.getenv("PHONETIC_BONUS", "6"))
+# Minimum score for the fallback that fuzzy-matches phonetic keys when plain matching finds nothing.
+PHONETIC_FALLBACK_CUTOFF = float(os.getenv("PHONETIC_FALLBACK_CUTOFF", "85"))
+# Utterances whose keys have fewer consonants than this ("naan" -> "n", "tea" -> "t") sound like
+# too many things; they get neither the exact-sound shortcut nor the phonetic fallback.
+PHONETIC_MIN_KEY_LENGTH = int(os.getenv("PHONETIC_MIN_KEY_LENGTH", "3"))
+# Minimum text score of a name matched on sound alone (the exact-sound shortcut and the fallback).
+PHONETIC_MIN_TEXT_SCORE = float(os.getenv("PHONETIC_MIN_TEXT_SCORE", "60"))
+# Threads for batch scoring (-1 = all cores), used once a batch has at least MATCH_PARALLEL_MIN_CELLS query/name pairs.
+MATCH_WORKERS = int(os.getenv("MATCH_WORKERS", "-1"))
+MATCH_PARALLEL_MIN_CELLS = int(os.getenv("MATCH_PARALLEL_MIN_CELLS", "20000"))
+# Minimum partial-match score of type-ahead suggestions that are neither a typed nor a spoken prefix.
+SUGGEST_SCORE_CUTOFF = float(os.getenv("SUGGEST_SCORE_CUTOFF", "75"))
+
+# (store_id, menu_version, corpus, normalized_query, limit, score_cutoff) -> [(name, score, idx), ...]
+match_cache = LRUCache(MATCH_CACHE_SIZE)
+
+# store_id -> menu version the cached results were computed against
+_store_versions: Dict[Any, str] = {}
+_versions_lock = threading.Lock()
+
+
+def normalize_utterance(text: str) -> str:
+    """Lower-cases, strips punctuation and collapses whitespace so repeated phrasings share a cache key."""
+    return " ".join(default_process(text or "").split())
+
+
+# ───────────────────────── PHONETIC KEYS ─────────────────────────
+# Rewrites applied in order, tuned for romanized Indian menu terms and how
+# speech recognition spells them: aspirates collapse (bh/dh/kh/gh -> b/d/k/g),
+# long vowels shorten (ee -> i, oo -> u), v/w and j/z merge, y acts as a vowel.
+_PHONETIC_RULES = [
+    ("chh", "c"), ("ch", "c"), ("sh", "s"), ("ph", "f"), ("bh", "b"), ("dh", "d"),
+    ("th", "t"), ("kh", "k"), ("gh", "g"), ("jh", "j"), ("ck", "k"), ("q", "k"),
+    ("x", "ks"), ("w", "v"), ("z", "j"), ("ee", "i"), ("oo", "u"), ("y", "i"),
+]
+_NON_ALPHA = re.compile(r"[^a-z]")
+_VOWELS = re.compile(r"[aeiouh]")
+_REPEATS = re.compile(r"(.)\1+")
+
+# Spoken words that never belong to an item name.
+FILLER_WORDS = {
+    "a", "an", "and", "the", "i", "want", "would", "like", "please", "give", "me", "get", "some", "of",
+    "one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten", "x",
+}
+
+
+def phonetic_key(word: str) -> str:
+    """A consonant skeleton of one word: "biriyani", "bryani" and "biryani" all give "brn"."""
+    word = _NON_ALPHA.sub("", word.lower())
+    if not word:
+        return ""
+    for old, new in _PHONETIC_RULES:
+        word = word.replace(old, new)
+    return _REPEATS.sub(r"\1", word[0] + _VOWELS.sub("", word[1:]))
+
+
+def phonetic_words(text: str) -> List[str]:
+    """Phonetic keys of the meaningful words of an utterance, in order."""
+    keys = []
+    for word in normalize_utterance(text).split():
+        if word in FILLER_WORDS or word.isdigit():
+            continue
+        key = phonetic_key(word)
+        if key:
+            keys.append(key)
+    return keys
+
+
+def _distinctive(keys: List[str]) -> bool:
+    """Whether an utterance's keys carry enough consonants to match on sound alone."""
+    return sum(len(key) for key in keys) >= PHONETIC_MIN_KEY_LENGTH
+
+
+def menu_version(menu: List[Dict[str, Any]]) -> str:
+    """A short fingerprint of the menu rows that matching depends on (ids, names and their order)."""
+    digest = hashlib.sha1()
+    for item in menu:
+        digest.update(f"{item.get('item_id')}\x1f{item.get('item_name')}\x1e".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def _observe_version(store_id: Any, version: str) -> None:
+    """Drops a store's cached results as soon as a new menu version is seen for it."""
+    with _versions_lock:
+        previous = _store_versions.get(store_id)
+        if previous == version:
+            return
+        _store_versions[store_id] = version
+    if previous is not None:
+        match_cache.discard_where(lambda key: key[0] == store_id and key[1] != version)
+
+
+@tracing.timed("fuzzy_match")
+def extract(store_id: Any,
+            version: Optional[str],
+            corpus: str,
+            query: str,
+            choices: Sequence[str],
+            limit: Optional[int] = 5,
+            score_cutoff: Optional[float] = None,
+            preprocessed: bool = False,
+            scorer=fuzz.WRatio) -> List[Tuple[str, float, int]]:
+    """
+    Memoized ``rapidfuzz.process.extract`` keyed by store, menu version and normalized utterance.
+    ``corpus`` names the list being searched so different choice lists of one menu don't collide;
+    a corpus must always be searched with the same ``scorer``.
+    Pass ``preprocessed=True`` when ``choices`` already went through ``default_process``.
+    Without a store_id/version the call is scored directly and not cached.
+    """
+    normalized = normalize_utterance(query)
+    processor = None if preprocessed else default_process
+    if store_id is None or version is None:
+        return fuzz_process.extract(normalized, choices, scorer=scorer, processor=processor,
+                                    limit=limit, score_cutoff=score_cutoff)
+
+    _observe_version(store_id, version)
+    key = (store_id, version, corpus, normalized, limit, score_cutoff)
+    results = match_cache.get(key)
+    if results is None:
+        # The service scores with WRatio only.
+        offloaded = None
+        if scorer is fuzz.WRatio:
+            offloaded = match_service.offload(store_id, version, corpus, [normalized], choices, preprocessed,
+                                              limit, score_cutoff)
+        if offloaded is not None:
+            results = offloaded[0]
+        else:
+            results = fuzz_process.extract(normalized, choices, scorer=scorer, processor=processor,
+                                           limit=limit, score_cutoff=score_cutoff)
+        match_cache.put(key, results)
+    return results
+
+
+def _score_matrix(queries: List[str],
+                  choices: Sequence[str],
+                  processor,
+                  limit: Optional[int],
+                  score_cutoff: Optional[float]) -> List[List[Tuple[str, float, int]]]:
+    """Scores every query against every choice in one ``cdist`` call and ranks each row like ``extract``."""
+    if np is None:
+        return [fuzz_process.extract(q, choices, processor=processor, limit=limit, score_cutoff=score_cutoff)
+                for q in queries]
+    workers = MATCH_WORKERS if len(queries) * len(choices) >= MATCH_PARALLEL_MIN_CELLS else 1
+    # cdist defaults to fuzz.ratio; extract uses WRatio.
+    matrix = fuzz_process.cdist(queries, choices, scorer=fuzz.WRatio, processor=processor,
+                                score_cutoff=score_cutoff, dtype=np.float64, workers=workers)
+    floor = score_cutoff or 0
+    rows = []
+    for scores in matrix:
+        # Stable sort keeps extract's tie order (lower index first).
+        order = np.argsort(-scores, kind="stable")
+        order = order[:np.count_nonzero(scores >= floor)]
+        if limit is not None:
+            order = order[:limit]
+        rows.append([(choices[idx], float(scores[idx]), int(idx)) for idx in order])
+    return rows
+
+
+@tracing.timed("fuzzy_match")
+def extract_batch(store_id: Any,
+                  version: Optional[str],
+                  corpus: str,
+                  queries: Sequence[str],
+                  choices: Sequence[str],
+                  limit: Optional[int] = 5,
+                  score_cutoff: Optional[float] = None,
+                  preprocessed: bool = False) -> List[List[Tuple[str, float, int]]]:
+    """
+    ``extract`` for several utterances at once, one result list per query. Queries missing from
+    the cache are scored together in a single matrix, split over MATCH_WORKERS threads when large
+    (or handed to the match service for big menus). Shares cache entries with ``extract``.
+    """
+    normalized = [normalize_utterance(q) for q in queries]
+    processor = None if preprocessed else default_process
+    cached = store_id is not None and version is not None
+    if cached:
+        _observe_version(store_id, version)
+
+    results: List[Optional[List[Tuple[str, float, int]]]] = [None] * len(normalized)
+    pending: Dict[str, List[int]] = {}
+    for pos, query in enumerate(normalized):
+        hit = match_cache.get((store_id, version, corpus, query, limit, score_cutoff)) if cached else None
+        if hit is not None:
+            results[pos] = hit
+        else:
+            pending.setdefault(query, []).append(pos)
+
+    if pending:
+        rows = None
+        if cached:
+            rows = match_service.offload(store_id, version, corpus, list(pending), choices, preprocessed,
+                                         limit, score_cutoff)
+        if rows is None:
+            rows = _score_matrix(list(pending), choices, processor, limit, score_cutoff)
+        for (query, positions), row in zip(pending.items(), rows):
+            if cached:
+                match_cache.put((store_id, version, corpus, query, limit, score_cutoff), row)
+            for pos in positions:
+                results[pos] = row
+    return results
+
+
+def extract_one(store_id: Any,
+                version: Optional[str],
+                corpus: str,
+                query: str,
+                choices: Sequence[str],
+                score_cutoff: Optional[float] = None) -> Optional[Tuple[str, float, int]]:
+    """Memoized ``rapidfuzz.process.extractOne``; returns None when nothing matches."""
+    results = extract(store_id, version, corpus, query, choices, limit=1, score_cutoff=score_cutoff)
+    return results[0] if results else None
+
+
+# ───────────────────────── PREFIX INDEX ─────────────────────────
+class PrefixIndex:
+    """
+    The word-start suffixes of a list of texts, sorted, so every text with a word that
+    begins a given prefix is found by bisection (a flattened trie over the words).
+    """
+
+    def __init__(self, texts: Sequence[str]):
+        entries = []
+        for idx, text in enumerate(texts):
+            start = 0
+            for word in text.split(" "):
+                if word:
+                    entries.append((text[start:], idx, start))
+                start += len(word) + 1
+        entries.sort()
+        self.keys = [key for key, _, _ in entries]
+        self.entries = entries
+
+    def lookup(self, prefix: str) -> Dict[int, int]:
+        """Text index -> the earliest word offset at which the text continues with ``prefix``."""
+        hits: Dict[int, int] = {}
+        pos = bisect_left(self.keys, prefix)
+        while pos < len(self.keys) and self.keys[pos].startswith(prefix):
+            _, idx, start = self.entries[pos]
+            if idx not in hits or start < hits[idx]:
+                hits[idx] = start
+            pos += 1
+        return hits
+
+
+class MenuIndex:
+    """The matching structures of one store's menu, built once per menu version."""
+
+    def __init__(self, store_id: Any, menu: List[Dict[str, Any]]):
+        self.store_id = store_id
+        self.menu = menu
+        self.version = menu_version(menu)
+        # Later products win when two share a display name.
+        self.items_by_name = {item['item_name'].strip(): item for item in menu}
+        self.names = list(self.items_by_name.keys())
+        self.processed_names = [default_process(name) for name in self.names]
+        # product_id -> recent-weighted orders, attached by catalog (see popularity.py)
+        self.popularity: Dict[Any, float] = {}
+
+        # Phonetic index: whole-name key -> name indexes, plus each name's set of word keys.
+        self.phonetic_phrases = []
+        self.phonetic_word_sets = []
+        self.by_phonetic: Dict[str, List[int]] = {}
+        for idx, name in enumerate(self.names):
+            words = phonetic_words(name)
+            phrase = " ".join(words)
+            self.phonetic_phrases.append(phrase)
+            self.phonetic_word_sets.append(frozenset(words))
+            self.by_phonetic.setdefault(phrase, []).append(idx)
+
+        # Type-ahead: prefixes of the normalized names and of their phonetic keys.
+        self.name_prefixes = PrefixIndex([" ".join(name.split()) for name in self.processed_names])
+        self.phonetic_prefixes = PrefixIndex(self.phonetic_phrases)
+
+    def phonetic_exact(self, query: str) -> List[int]:
+        """Indexes of names that sound exactly like the utterance (an O(1) lookup)."""
+        return self.by_phonetic.get(" ".join(phonetic_words(query)), [])
+
+    def _sole_sound_alike(self, query: str, limit: Optional[int]) -> Optional[List[Tuple[str, float, int]]]:
+        """
+        The one name that sounds exactly like the utterance and is spelled somewhat like it,
+        or None when none or several do, or the utterance's key is too short to tell.
+        """
+        if limit == 0 or not _distinctive(phonetic_words(query)):
+            return None
+        exact = self.phonetic_exact(query)
+        if len(exact) != 1:
+            return None
+        if not self._spelled_like(query, exact[0]):
+            return None
+        return [(self.names[exact[0]], 100.0, exact[0])]
+
+    def _spelled_like(self, query: str, idx: int) -> bool:
+        return fuzz.WRatio(normalize_utterance(query), self.processed_names[idx]) >= PHONETIC_MIN_TEXT_SCORE
+
+    def extract(self, query: str, limit: Optional[int] = 5,
+                score_cutoff: Optional[float] = None) -> List[Tuple[str, float, int]]:
+        """
+        Ranked ``(name, score, idx)`` matches. A name whose phonetic key is the utterance's and
+        no other name's, and whose text is close enough, short-circuits fuzzy scoring; otherwise
+        fuzzy results that contain every spoken word's sound are boosted, and phonetic keys are
+        fuzzy-matched when plain text finds nothing. Keys shorter than PHONETIC_MIN_KEY_LENGTH
+        only get the boost.
+        """
+        sole = self._sole_sound_alike(query, limit)
+        if sole:
+            return sole
+
+        spoken = frozenset(phonetic_words(query))
+        # Score with the cutoff lowered by the bonus, so a boost can lift a near miss over it.
+        fuzzy_cutoff = max(0, score_cutoff - PHONETIC_BONUS) if score_cutoff and spoken else score_cutoff
+        results = extract(self.store_id, self.version, "menu_unique", query, self.processed_names,
+                          limit=limit, score_cutoff=fuzzy_cutoff, preprocessed=True)
+        return self._rank(query, spoken, results, limit, score_cutoff)
+
+    def extract_batch(self, queries: Sequence[str], limit: Optional[int] = 5,
+                      score_cutoff: Optional[float] = None) -> List[List[Tuple[str, float, int]]]:
+        """``extract`` for every part of a multi-item order, with one fuzzy scoring pass for all of them."""
+        results: List[List[Tuple[str, float, int]]] = [[] for _ in queries]
+        fuzzy = []
+        for pos, query in enumerate(queries):
+            sole = self._sole_sound_alike(query, limit)
+            if sole:
+                results[pos] = sole
+            else:
+                fuzzy.append(pos)
+        if not fuzzy:
+            return results
+
+        fuzzy_cutoff = max(0, score_cutoff - PHONETIC_BONUS) if score_cutoff else score_cutoff
+        rows = extract_batch(self.store_id, self.version, "menu_unique", [queries[pos] for pos in fuzzy],
+                             self.processed_names, limit=limit, score_cutoff=fuzzy_cutoff, preprocessed=True)
+        for pos, row in zip(fuzzy, rows):
+            spoken = frozenset(phonetic_words(queries[pos]))
+            if not spoken and score_cutoff is not None:
+                row = [m for m in row if m[1] >= score_cutoff]
+            results[pos] = self._rank(queries[pos], spoken, row, limit, score_cutoff)
+        return results
+
+    def suggest(self, partial: str, limit: int = 5,
+                score_cutoff: float = SUGGEST_SCORE_CUTOFF) -> List[Tuple[str, float, int, str]]:
+        """
+        Ranked ``(name, score, idx, kind)`` completions of a partial utterance. Names with a
+        word starting with the typed text come first ("prefix"), then names whose sound it
+        begins ("phonetic", for mis-transcribed prefixes), then partial fuzzy matches ("fuzzy").
+        Within a kind, higher scores, then shorter names rank first; a prefix of the whole
+        name scores 100 and of a later word 95.
+        """
+        text = normalize_utterance(partial)
+        if not text or not limit:
+            return []
+
+        found: Dict[int, Tuple[int, float, str]] = {}
+        for idx, start in self.name_prefixes.lookup(text).items():
+            found[idx] = (0, 100.0 if start == 0 else 95.0, "prefix")
+        if len(found) < limit:
+            spoken = " ".join(phonetic_words(text))
+            if spoken:
+                # Consonant skeletons are short and collide; order by how close the spelling is.
+                for idx in self.phonetic_prefixes.lookup(spoken):
+                    if idx not in found:
+                        found[idx] = (1, fuzz.partial_ratio(text, self.processed_names[idx]), "phonetic")
+        # One or two characters match nearly everything fuzzily; wait for more.
+        if len(found) < limit and len(text) >= 3:
+            for _, score, idx in fuzz_process.extract(text, self.processed_names, scorer=fuzz.partial_ratio,
+                                                      processor=None, limit=limit, score_cutoff=score_cutoff):
+                found.setdefault(idx, (2, score, "fuzzy"))
+
+        ranked = sorted(found.items(), key=lambda hit: (hit[1][0], -hit[1][1], len(self.names[hit[0]]), self.names[hit[0]]))
+        return [(self.names[idx], score, idx, kind) for idx, (_, score, kind) in ranked[:limit]]
+
+    def _rank(self, query: str, spoken: frozenset, results: List[Tuple[str, float, int]],
+              limit: Optional[int], score_cutoff: Optional[float]) -> List[Tuple[str, float, int]]:
+        """Applies the phonetic boost and fallback to fuzzy results and maps them to display names."""
+        if results and spoken:
+            # Every sound-alike gets the same lift, at most to 100 for the best of them, so the
+            # bonus only moves them past names that sound different: between "Coke" and "Cake",
+            # which share a key, the text score alone still decides.
+            sounds = [spoken <= self.phonetic_word_sets[idx] for _, _, idx in results]
+            best = max((m[1] for m, alike in zip(results, sounds) if alike), default=100.0)
+            lift = max(0.0, min(PHONETIC_BONUS, 100.0 - best))
+            boosted = [(name, score + lift if alike else score, idx)
+                       for (name, score, idx), alike in zip(results, sounds)]
+            results = sorted((m for m in boosted if score_cutoff is None or m[1] >= score_cutoff),
+                             key=lambda m: m[1], reverse=True)
+        if not results and spoken and _distinctive(phonetic_words(query)):
+            # Whole keys against whole keys: a partial match would find "t" inside any key with a t.
+            results = extract(self.store_id, self.version, "phonetic", " ".join(phonetic_words(query)),
+                              self.phonetic_phrases, limit=limit,
+                              score_cutoff=max(score_cutoff or 0, PHONETIC_FALLBACK_CUTOFF), preprocessed=True,
+                              scorer=fuzz.ratio)
+            results = [m for m in results if self._spelled_like(query, m[2])]
+        # Scored against processed names or keys; hand back the display names.
+        return [(self.names[idx], score, idx) for _, score, idx in results]
+
+
+def match_cache_stats() -> Dict[str, Any]:
+    stats = match_cache.stats()
+    stats["stores"] = len(_store_versions)
+    return stats
@@ -0,0 +1,177 @@
+"""
+Where a worker's memory goes: sessions, caches and, on demand, allocation sites.
+
+Sizes are deep ``sys.getsizeof`` totals of what each structure references, so an
+object held by two caches (a MenuIndex is both the live and the last-good menu)
+counts in both. Walking the caches touches every object in them; this is for an
+operator's occasional look, not for monitoring scrapes.
+
+Allocation sites come from tracemalloc, which is started by the first snapshot and
+only sees allocations made after that, and slows the worker down while it runs;
+stop() switches it off again.
+"""
+import os
+import sys
+import time
+import threading
+import tracemalloc
+from collections import OrderedDict, defaultdict
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+# ─────────────────────────── CONFIG ───────────────────────────
+# Stack frames tracemalloc keeps per allocation (more = finer sites, more overhead).
+MEMORY_TRACE_FRAMES = int(os.getenv("MEMORY_TRACE_FRAMES", "1"))
+# Snapshots kept for diffing; the oldest is dropped first.
+MEMORY_SNAPSHOTS = int(os.getenv("MEMORY_SNAPSHOTS", "8"))
+MEMORY_TOP_SITES = int(os.getenv("MEMORY_TOP_SITES", "25"))
+# Sessions idle longer than this are reported as probably abandoned.
+MEMORY_IDLE_SESSION_SECONDS = float(os.getenv("MEMORY_IDLE_SESSION_SECONDS", "1800"))
+
+# Leaves that are not worth descending into.
+_ATOMIC = (str, bytes, bytearray, int, float, bool, complex, type(None), type)
+
+
+def deep_sizeof(obj: Any, seen: Optional[set] = None) -> int:
+    """Bytes of ``obj`` and everything it references, each object counted once per ``seen``."""
+    seen = set() if seen is None else seen
+    size = 0
+    stack = [obj]
+    while stack:
+        current = stack.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+        if isinstance(current, _ATOMIC) or callable(current):
+            continue
+        if isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            stack.extend(current)
+        else:
+            if hasattr(current, "__dict__"):
+                stack.append(vars(current))
+            for slot in getattr(type(current), "__slots__", ()):
+                if hasattr(current, slot):
+                    stack.append(getattr(current, slot))
+    return size
+
+
+def _distribution(values: List[float]) -> Dict[str, Any]:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+    pick = lambda pct: ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+    return {"count": len(ordered), "total": round(sum(ordered)), "min": round(ordered[0]),
+            "p50": round(pick(50)), "p90": round(pick(90)), "p99": round(pick(99)), "max": round(ordered[-1])}
+
+
+# ─────────────────────── SESSIONS & CACHES ───────────────────────
+def session_report(store: Any, largest: int = 5) -> Dict[str, Any]:
+    """Entry count, per-session byte and idle-time distributions, and the largest sessions of a SessionStore."""
+    sessions = [(session_id, idle, deep_sizeof(state)) for session_id, idle, state in store.snapshot()]
+    replies = store.reply_snapshot()
+    return {
+        "sessions": len(sessions),
+        "bytes": _distribution([size for _, _, size in sessions]),
+        "idle_seconds": _distribution([idle for _, idle, _ in sessions]),
+        "idle_over_threshold": sum(1 for _, idle, _ in sessions if idle > MEMORY_IDLE_SESSION_SECONDS),
+        "largest": [{"session_id": session_id, "bytes": size, "idle_seconds": round(idle)}
+                    for session_id, idle, size in sorted(sessions, key=lambda s: s[2], reverse=True)[:largest]],
+        "idempotent_replies": {"entries": len(replies), "bytes": deep_sizeof(replies)},
+    }
+
+
+def cache_report(cache: Any, store_of: Optional[Callable[[Hashable], Any]] = None) -> Dict[str, Any]:
+    """Entries and bytes of an LRUCache/TTLCache; with ``store_of(key)``, also split by store."""
+    entries = cache.snapshot()
+    report = {"entries": len(entries), "maxsize": cache.maxsize, "bytes": deep_sizeof(entries)}
+    if store_of is not None:
+        per_store: Dict[Any, Dict[str, int]] = defaultdict(lambda: {"entries": 0, "bytes": 0})
+        seen: set = set()
+        for key, value in entries:
+            row = per_store[store_of(key)]
+            row["entries"] += 1
+            row["bytes"] += deep_sizeof((key, value), seen)
+        report["by_store"] = {str(store): row for store, row in per_store.items()}
+    return report
+
+
+def menu_index_report(indexes: Iterable[Tuple[Any, Any]]) -> Dict[str, Dict[str, int]]:
+    """Per store: bytes of the menu rows and of the match structures a MenuIndex builds on top of them."""
+    report = {}
+    for store_id, index in indexes:
+        seen: set = set()
+        menu_bytes = deep_sizeof(index.menu, seen)
+        report[str(store_id)] = {"items": len(index.menu), "menu_bytes": menu_bytes,
+                                 "match_index_bytes": deep_sizeof(index, seen)}
+    return report
+
+
+# ───────────────────────── ALLOCATIONS ─────────────────────────
+_snapshots: "OrderedDict[int, Tuple[float, tracemalloc.Snapshot]]" = OrderedDict()
+_snapshot_ids = 0
+_snapshots_lock = threading.Lock()
+
+_NOISE = (tracemalloc.Filter(False, tracemalloc.__file__),
+          tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+          tracemalloc.Filter(False, "<unknown>"))
+
+
+def _site(stat: Any) -> str:
+    frame = stat.traceback[0]
+    return f"{frame.filename}:{frame.lineno}"
+
+
+def take_snapshot(top: int = MEMORY_TOP_SITES) -> Dict[str, Any]:
+    """Snapshots allocations (starting tracemalloc on first use) and returns the top sites by size."""
+    global _snapshot_ids
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(MEMORY_TRACE_FRAMES)
+    snapshot = tracemalloc.take_snapshot().filter_traces(_NOISE)
+    with _snapshots_lock:
+        _snapshot_ids += 1
+        snapshot_id = _snapshot_ids
+        _snapshots[snapshot_id] = (time.time(), snapshot)
+        while len(_snapshots) > MEMORY_SNAPSHOTS:
+            _snapshots.popitem(last=False)
+    stats = snapshot.statistics("lineno")
+    return {
+        "snapshot": snapshot_id,
+        "tracing_started": started,
+        "traced_bytes": sum(stat.size for stat in stats),
+        "top": [{"site": _site(stat), "bytes": stat.size, "count": stat.count} for stat in stats[:top]],
+    }
+
+
+def diff(old_id: int, new_id: int, top: int = MEMORY_TOP_SITES) -> Optional[Dict[str, Any]]:
+    """The sites whose allocations grew or shrank most between two snapshots; None for an unknown id."""
+    with _snapshots_lock:
+        old, new = _snapshots.get(old_id), _snapshots.get(new_id)
+    if old is None or new is None:
+        return None
+    stats = new[1].compare_to(old[1], "lineno")
+    return {
+        "from": old_id, "to": new_id, "seconds": round(new[0] - old[0], 1),
+        "growth_bytes": sum(stat.size_diff for stat in stats),
+        "top": [{"site": _site(stat), "bytes": stat.size, "bytes_diff": stat.size_diff,
+                 "count": stat.count, "count_diff": stat.count_diff} for stat in stats[:top]],
+    }
+
+
+def tracing_status() -> Dict[str, Any]:
+    with _snapshots_lock:
+        snapshots = [{"snapshot": snapshot_id, "taken_at": round(taken_at, 1)}
+                     for snapshot_id, (taken_at, _) in _snapshots.items()]
+    traced, peak = tracemalloc.get_traced_memory()
+    return {"tracing": tracemalloc.is_tracing(), "traced_bytes": traced, "peak_bytes": peak,
+            "snapshots": snapshots}
+
+
+def stop() -> None:
+    """Stops tracemalloc and drops the snapshots."""
+    tracemalloc.stop()
+    with _snapshots_lock:
+        _snapshots.clear()
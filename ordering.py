@@ -0,0 +1,377 @@
+"""
+Menu, question, parsing and cart logic shared by the web API (app.py) and the voice CLI (Final.py).
+Nothing here imports the audio libraries, so web workers never load them.
+"""
+import os
+import json
+import re
+import mysql.connector
+from typing import List, Dict, Any, Optional
+from word2number import w2n
+import matching
+import db
+import fastjson
+import tracing
+
+# ─────────────────── GLOBAL DATABASE CONNECTION ───────────────────
+_db_connection = None
+
+def get_db_connection():
+    global _db_connection
+    if db.DB_BACKEND == "sqlite":
+        # The SQLite stand-in the benchmarks run on (db_sqlite.py)
+        if _db_connection is None:
+            _db_connection = db.get_connection()
+        return _db_connection
+    if _db_connection is None or not _db_connection.is_connected():
+        try:
+            _db_connection = mysql.connector.connect(
+                host=os.getenv("DB_HOST"),
+                user=os.getenv("DB_USER"),
+                password=os.getenv("DB_PASSWORD"),
+                database=os.getenv("DB_NAME"),
+                autocommit=True,
+                charset="utf8mb4",
+                use_pure=True
+            ) 
+        except mysql.connector.Error as e:
+            print(f"Database connection failed: {e}")
+            return None
+    return _db_connection
+
+
+#-----------------------------------------------
+def extract_quantity(text: str) -> int:
+    
+    # Try direct digits
+    digit_match = re.search(r"\b\d+\b", text)
+    if digit_match:
+        return int(digit_match.group())
+
+    # Try word-to-number conversion
+    try:
+        return w2n.word_to_num(text)
+    except:
+        return 1  # Default quantity if not found
+
+
+# ------------------------------------------------
+def process_order(user_input: str, item: Dict[str, Any]) -> Dict[str, Any]:
+    
+    if 'quantity' not in item or item['quantity'] is None:
+        quantity = extract_quantity(user_input)
+        if quantity is not None:
+            item['quantity'] = quantity
+    return item
+
+#------------------------------------
+def ensure_mysql_connection_alive(obj):
+    try:
+        conn = getattr(obj, "connection", None) or getattr(obj, "_connection", None) or obj
+        conn.ping(reconnect=True, attempts=3, delay=2)
+    except mysql.connector.Error as e:
+        print(f"[MySQL Warning] Lost connection. Attempting to reconnect... ({e})")
+        raise
+
+#-------------------------------------
+
+
+USER_NAME_SQL = "SELECT name FROM tbl_user WHERE id = %s AND ustatus = 1;"
+
+def get_user_name(cur, id: int) -> str:
+    cur.execute(USER_NAME_SQL, (id,))
+    row = cur.fetchone()
+    return row["name"] if row and row["name"] else "Customer"
+
+#-----------------------------------
+def confirm_order(item_name: str, qty: int, variations: Optional[Dict[str, Any]] = None):
+    item_display = f"{item_name}{'s' if int(qty) > 1 and not item_name.endswith('s') else ''}"
+    if variations:
+        summary_text = _get_variation_summary(variations)
+        print(f"Got it. You want {qty} {item_display} with {summary_text}")
+    else:
+        print(f"Got it. You want {qty} {item_display}.") 
+
+# ----------------------------
+def _get_variation_summary(variations: Dict[str, Any]) -> str:
+    summary = []
+    if "selected_options" in variations:
+        option_summary = [f"{opt['quantity']} {opt['name']}" for opt in variations["selected_options"]]
+        summary.append(f"sizes: {', '.join(option_summary)}")
+    if "selected_addons" in variations:
+        addon_summary = [f"{addon['addon_name']}" for addon in variations["selected_addons"]]
+        summary.append(f"{', '.join(addon_summary)}")
+    return ", ".join(summary)
+
+
+
+# ───────────────────────── MENU FETCH ─────────────────────────
+def _flatten_attribute_titles(raw: Any) -> List[str]:
+    """Decodes the aggregated attribute titles; each title may itself be a JSON list of labels."""
+    if raw is None:
+        return []
+    if isinstance(raw, (bytes, bytearray)):
+        raw = raw.decode("utf-8")
+    titles = fastjson.loads(raw) if isinstance(raw, str) else raw
+    flat = []
+    for title in titles or []:
+        if not title:
+            continue
+        try:
+            decoded = fastjson.loads(title)
+        except (json.JSONDecodeError, TypeError):
+            decoded = title
+        if isinstance(decoded, list):
+            flat.extend(str(t) for t in decoded)
+        elif isinstance(decoded, str):
+            flat.append(decoded)
+        else:
+            flat.append(str(title))
+    return flat
+
+STORE_MENU_SQL = """
+    SELECT
+        s.title AS store_name,
+        p.id AS item_id,
+        p.title AS item_name,
+        p.store_id,
+        (SELECT JSON_ARRAYAGG(pa.title)
+         FROM tbl_product_attribute AS pa
+         WHERE pa.product_id = p.id) AS attribute_titles
+    FROM tbl_product AS p
+    LEFT JOIN service_details AS s ON s.id = p.store_id
+    WHERE p.store_id = %s AND p.status = 1
+"""
+
+@tracing.timed("fetch_store_menu")
+def load_store_menu(conn, store_id):
+    """
+    The store's menu projection: one row per active product with only the columns
+    matching needs. Attribute titles are aggregated in SQL instead of joined row by row.
+    Raises ``mysql.connector.Error`` / ``json.JSONDecodeError`` for the caller to handle.
+    """
+    with conn.cursor(dictionary=True, buffered=True) as cursor:
+        cursor.execute(STORE_MENU_SQL, (store_id,))
+        return menu_from_rows(cursor.fetchall())
+
+def menu_from_rows(rows):
+    """Decodes STORE_MENU_SQL rows in place."""
+    for row in rows:
+        row["attribute_titles"] = _flatten_attribute_titles(row["attribute_titles"])
+    return rows
+
+def fetch_store_menu(conn, store_id):
+    """load_store_menu, with errors reported and an empty menu returned."""
+    try:
+        return load_store_menu(conn, store_id)
+    except mysql.connector.Error as err:
+        print(f"Database error in fetch_store_menu: {err}")
+        return []
+    except json.JSONDecodeError as err:
+        print(f"JSON decode error for attribute titles: {err}")
+        return []
+
+def fetch_product_details(conn, item_id: int, store_id: Optional[int] = None):
+    """Fetches options, add-ons, price, discount and cart attribute id for a product in one round trip."""
+    details = {"options": [], "addons": [], "normal_price": None, "discount": 0.0, "attribute_id": 0}
+    try:
+        details = db.fetch_product_bundle(conn, item_id, store_id)
+    except mysql.connector.Error as err:
+        print(f"Database error in fetch_product_details: {err}")
+    except json.JSONDecodeError as err:
+        print(f"JSON decode error for product options: {err}")
+    return details
+
+def fetch_product_attributes(conn, item_id: int) -> List[str]:
+    """Fetches attributes for a specific product."""
+    try:
+        with conn.cursor(dictionary=True) as cursor:
+            cursor.execute("""
+                SELECT title FROM tbl_product_attribute WHERE product_id = %s;
+            """, (item_id,))
+            return [row['title'] for row in cursor.fetchall()]
+    except mysql.connector.Error as err:
+        print(f"Database error in fetch_product_attributes: {err}")
+        return []
+
+
+# ───────────────────────── QUESTIONS ──────────────────────────
+def fetch_menu_questions(cur, item_id: int) -> List[Dict[str, Any]]:
+    
+    """Fetches dynamic questions for a specific product from the menu_questions table."""
+    try:
+        cur.execute("""
+            SELECT question_text, question_type, required, sort_order
+            FROM menu_questions
+            WHERE item_id = %s
+            ORDER BY sort_order;
+        """, (item_id,))
+        return cur.fetchall()
+    except mysql.connector.Error as err:
+        print(f"Database error in fetch_menu_questions: {err}")
+        return []
+#-------------------------------------
+def _parse_multi_sizes(sentence: str, allowed: List[str]) -> List[Dict[str, Any]]:
+    sizes_found = {}
+    size_pat = "|".join(map(re.escape, allowed)) if allowed else r"[a-z0-9]+"
+    rex = re.compile(rf"(?:\b(\w+)\s*)?(?:x\s*)?\b({size_pat})\b", re.I)
+
+    for qty_word, size in rex.findall(sentence):
+        qty = w2n.word_to_num(qty_word) if qty_word and not qty_word.isdigit() else int(qty_word or 1)
+        sizes_found[size.lower()] = sizes_found.get(size.lower(), 0) + qty
+    
+    return [{"name": s.capitalize(), "quantity": q} for s, q in sizes_found.items()]
+
+#------------------------------------------
+def _parse_multi_options(sentence: str, allowed: List[str]) -> List[Dict[str, Any]]:
+    canon = {o.lower(): o for o in allowed}
+    rex = r"(?:(\d+)\s*)?(?:x\s*)?(" + "|".join(re.escape(o.lower()) for o in allowed) + r")"
+    found = re.findall(rex, sentence.lower())
+    result = []
+    for qty_s, opt_lc in found:
+        qty = int(qty_s) if qty_s else 1
+        result.append({"name": canon[opt_lc], "quantity": qty})
+    return result
+
+
+# ──────────────── VARIATION CONVERTER ────────────────
+def transform_variation(variation: Dict[str, Any]) -> str:
+    if not variation:
+        return None
+
+    structured = []
+    
+    # Options (e.g., Sizes)
+    if "selected_options" in variation:
+        for opt in variation["selected_options"]:
+            
+            price = opt.get("price", 0) # Assuming the price is part of the option dict now
+            structured.append({
+                "name": opt["name"],
+                "values": {"label": f"Quantity: {opt['quantity']}", "price": price}
+            })
+    
+    # Add-ons
+    if "selected_addons" in variation:
+        for addon in variation["selected_addons"]:
+            structured.append({
+                "name": addon["addon_name"],
+                "values": {"label": "Add-on", "price": str(addon["addon_price"])}
+            })
+
+    return fastjson.dumps_str(structured)
+
+
+# ───────────────────────── CART & ORDER ───────────────────────
+
+def cart_row(user_id: int,
+             store_id: int,
+             item: Dict[str, Any],
+             total_qty: int,
+             price: float,
+             variation: Optional[Dict[str, Any]],
+             visible: int,
+             attribute_id: int) -> tuple:
+    """Parameters of the "cart_insert" statement for one cart line."""
+    variation_str = transform_variation(variation) if variation else None
+    product_id = item.get("item_id")
+    product_title = item.get("item_name", "Unnamed Product")
+    product_img = item.get("image", "")
+    cart_type = "normal"
+    subscription_data = None
+
+    return (
+        user_id,
+        store_id,
+        product_id,
+        attribute_id,
+        total_qty,
+        price,
+        product_title,
+        product_img,
+        cart_type,
+        variation_str,
+        visible,
+        subscription_data
+    )
+
+@tracing.timed("add_to_cart")
+def add_to_cart(user_id: int,
+              store_id: int,
+              item: Dict[str, Any],
+              total_qty: int,
+              price: float,
+              variation: Optional[Dict[str, Any]],
+              visible: int,
+              conn=None,
+              attribute_id: Optional[int] = None) -> None:
+    conn = conn or get_db_connection()
+    if not conn:
+        print("Cart insert failed: No database connection.")
+        return
+
+    if attribute_id is None:
+        attribute_id = db.fetch_attribute_id(conn, item.get("item_id"), store_id)
+
+    db.execute_prepared(conn, "cart_insert", cart_row(
+        user_id, store_id, item, total_qty, price, variation, visible, attribute_id))
+
+    conn.commit()
+
+    # The confirmation message needs to be adjusted slightly to be accurate
+    confirm_order(item_name=item.get("item_name", "Unnamed Product"), qty=total_qty, variations=variation)
+
+
+# -------------------
+def _parse_free_form_order(
+    text: str,
+    options_map: Dict[str, Dict[str, Any]],
+    store_id: Optional[int] = None,
+    version: Optional[str] = None,
+    index: Optional[matching.MenuIndex] = None
+) -> List[Dict[str, Any]]:
+    
+    orders = []
+    parts = re.split(r"\s+(?:and|&|with|,)\s+", text.lower())
+    option_keys = list(options_map.keys())
+    # All parts scored against the menu in one pass; the same rows rank the candidates later.
+    ranked = index.extract_batch(parts, limit=20) if index else [None] * len(parts)
+
+    for part, candidates in zip(parts, ranked):
+        order_data = {
+            "item_name": part.strip(),
+            "quantity": extract_quantity(part),
+        }
+        
+        if candidates is not None:
+            if not candidates or candidates[0][1] < 70:
+                continue
+            best_match = index.items_by_name[candidates[0][0]]["item_name"].lower()
+            order_data["candidates"] = candidates
+        else:
+            match = matching.extract_one(store_id, version, "options", part, option_keys)
+            if not match or match[1] < 70:
+                continue
+            best_match = match[0]
+            
+        item_name_key = best_match
+        order_data["item_name"] = item_name_key
+
+        item_details = options_map.get(item_name_key, {})
+        
+        for opt_def in item_details.get("options", []):
+            opt_name = opt_def["name"].lower()
+            opt_values = [v.lower() for v in opt_def["values"]]
+            
+            for value in opt_values:
+                if value in part:
+                    order_data[opt_name] = value
+                    break
+        
+        for addon_name in item_details.get("addons", []):
+            if addon_name.lower() in part:
+                order_data[addon_name.lower()] = True
+
+        orders.append(order_data)
+
+    return orders
@@ -0,0 +1,165 @@
+"""
+Per-store product popularity from order history, used to settle tied matches.
+
+A background thread folds new tbl_cart_data lines into a table of
+store -> product -> recent-weighted cart count every POPULARITY_REFRESH_SECONDS.
+Each refresh only reads lines with an id above the last one it saw (a primary
+key range, grouped by store and product), and decays the counts already held by
+the time elapsed since the previous refresh, so an item's weight halves every
+POPULARITY_HALF_LIFE_SECONDS without anything being rescanned. Cart lines carry
+no timestamp: those present at the first refresh all count as new, and a line
+committed late with an id below the high-water mark is never counted.
+
+catalog attaches a store's counts to its MenuIndex when the menu is cached, and
+again after each refresh; ``prefer`` then picks a candidate that dominates the
+store's orders among matches tied on score, or orders the clarification options
+most-ordered first.
+"""
+import os
+import math
+import time
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+# ─────────────────────────── CONFIG ───────────────────────────
+# 0 disables the refresher; matching then behaves as if nobody had ordered anything.
+POPULARITY_REFRESH_SECONDS = float(os.getenv("POPULARITY_REFRESH_SECONDS", "300"))
+POPULARITY_HALF_LIFE_SECONDS = float(os.getenv("POPULARITY_HALF_LIFE_SECONDS", str(14 * 86400)))
+# Cart ids read per query, so the first refresh of a big table is a series of short range scans.
+POPULARITY_BATCH_IDS = int(os.getenv("POPULARITY_BATCH_IDS", "100000"))
+# A tie on match score is settled without asking when one candidate has at least this share
+# of the tied candidates' weighted orders, and they have at least POPULARITY_MIN_ORDERS between them.
+POPULARITY_AUTO_SHARE = float(os.getenv("POPULARITY_AUTO_SHARE", "0.9"))
+POPULARITY_MIN_ORDERS = float(os.getenv("POPULARITY_MIN_ORDERS", "20"))
+
+# Decayed counts below this are dropped.
+_NEGLIGIBLE = 0.01
+
+DELTA_SQL = """
+    SELECT store_id, product_id, COUNT(*) AS orders
+    FROM tbl_cart_data
+    WHERE id > %s AND id <= %s
+    GROUP BY store_id, product_id
+"""
+
+
+class PopularityTable:
+    def __init__(self, half_life: float = POPULARITY_HALF_LIFE_SECONDS):
+        self.half_life = half_life
+        # store_id -> {product_id: weighted orders}; replaced, never mutated, once published
+        self._stores: Dict[Any, Dict[Any, float]] = {}
+        self._last_id = 0
+        self._refreshed_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self.refreshes = 0
+        self.lines = 0
+        self.errors = 0
+
+    def refresh(self, conn, now: Optional[float] = None) -> int:
+        """Folds cart lines added since the last refresh into the table; returns how many were read."""
+        with conn.cursor(dictionary=True) as cur:
+            cur.execute("SELECT MAX(id) AS last_id FROM tbl_cart_data")
+            row = cur.fetchone()
+            upper = int(row["last_id"] or 0) if row else 0
+            added: Dict[Any, Dict[Any, float]] = {}
+            lines = 0
+            low = self._last_id
+            while low < upper:
+                high = min(upper, low + POPULARITY_BATCH_IDS)
+                cur.execute(DELTA_SQL, (low, high))
+                for r in cur.fetchall():
+                    store = added.setdefault(r["store_id"], {})
+                    store[r["product_id"]] = store.get(r["product_id"], 0.0) + r["orders"]
+                    lines += r["orders"]
+                low = high
+
+        now = time.time() if now is None else now
+        with self._lock:
+            decay = 1.0
+            if self._refreshed_at is not None and self.half_life > 0:
+                decay = 0.5 ** (max(0.0, now - self._refreshed_at) / self.half_life)
+            stores = {}
+            for store_id in set(self._stores) | set(added):
+                counts = {product: weight * decay for product, weight in self._stores.get(store_id, {}).items()}
+                for product, orders in added.get(store_id, {}).items():
+                    counts[product] = counts.get(product, 0.0) + orders
+                counts = {product: weight for product, weight in counts.items() if weight >= _NEGLIGIBLE}
+                if counts:
+                    stores[store_id] = counts
+            self._stores = stores
+            self._last_id = max(self._last_id, upper)
+            self._refreshed_at = now
+            self.refreshes += 1
+            self.lines += lines
+        return lines
+
+    def for_store(self, store_id: Any) -> Dict[Any, float]:
+        """product_id -> weighted orders for the store (read-only)."""
+        return self._stores.get(store_id, {})
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            age = None if self._refreshed_at is None else round(time.time() - self._refreshed_at, 1)
+            return {"stores": len(self._stores), "products": sum(len(s) for s in self._stores.values()),
+                    "last_cart_id": self._last_id, "refreshes": self.refreshes, "lines": self.lines,
+                    "errors": self.errors, "age_seconds": age}
+
+
+table = PopularityTable()
+
+_refresher: Optional[threading.Thread] = None
+_refresher_lock = threading.Lock()
+
+
+def start(connect: Callable[[], Any], on_refresh: Optional[Callable[[], None]] = None) -> None:
+    """
+    Starts the background refresher once per process. ``connect`` returns a connection
+    it closes after use; ``on_refresh`` is called after every successful refresh.
+    """
+    global _refresher
+    if POPULARITY_REFRESH_SECONDS <= 0 or _refresher is not None:
+        return
+    with _refresher_lock:
+        if _refresher is not None:
+            return
+        _refresher = threading.Thread(target=_refresh_forever, args=(connect, on_refresh), name="popularity", daemon=True)
+        _refresher.start()
+
+
+def _refresh_forever(connect: Callable[[], Any], on_refresh: Optional[Callable[[], None]]) -> None:
+    while True:
+        conn = None
+        try:
+            conn = connect()
+            table.refresh(conn)
+            if on_refresh is not None:
+                on_refresh()
+        except Exception as err:
+            table.errors += 1
+            print(f"[Popularity] Refresh failed: {err}")
+        finally:
+            if conn is not None:
+                conn.close()
+        time.sleep(POPULARITY_REFRESH_SECONDS)
+
+
+def prefer(items: List[Dict[str, Any]], scores: List[float], counts: Dict[Any, float]) -> List[Dict[str, Any]]:
+    """
+    Near-match menu rows (with their match scores, best first) ranked for the customer.
+    Rows tied on the best score are settled to one when it holds POPULARITY_AUTO_SHARE
+    of their weighted orders; otherwise rows keep the best score first and are listed
+    most ordered first within it and within the rest. Popularity never overrides a
+    row that matched strictly better than the others.
+    """
+    if len(items) < 2 or not counts:
+        return items
+    weights = [counts.get(item["item_id"], 0.0) for item in items]
+    top = max(scores)
+    tied = [i for i, score in enumerate(scores) if math.isclose(score, top)]
+    if len(tied) > 1:
+        total = sum(weights[i] for i in tied)
+        best = max(tied, key=lambda i: weights[i])
+        if total >= POPULARITY_MIN_ORDERS and weights[best] >= POPULARITY_AUTO_SHARE * total:
+            return [items[best]]
+    order = sorted(range(len(items)), key=lambda i: (i not in tied, -weights[i]))
+    return [items[i] for i in order]
@@ -0,0 +1,149 @@
+import os
+import sys
+import hmac
+import json
+import time
+import uuid
+import random
+import cProfile
+import threading
+import functools
+from collections import Counter
+from typing import Any, Callable, Dict
+from flask import request, g
+
+# ─────────────────────────── CONFIG ───────────────────────────
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# Requests carrying "X-Profile: <token>" are always profiled; unset disables the header.
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN", "")
+# Fraction of requests profiled without the header (0 disables sampling).
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# "sampling" writes collapsed stacks (flamegraph.pl / speedscope); "deterministic" writes cProfile .pstats.
+PROFILE_MODE = os.getenv("PROFILE_MODE", "sampling")
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "200"))
+# Overhead caps: profiles running at once per process, and the minimum gap between sampled profiles.
+PROFILE_MAX_CONCURRENT = int(os.getenv("PROFILE_MAX_CONCURRENT", "1"))
+PROFILE_MIN_INTERVAL = float(os.getenv("PROFILE_MIN_INTERVAL", "1.0"))
+
+_slots = threading.BoundedSemaphore(PROFILE_MAX_CONCURRENT)
+_last_sampled = 0.0
+_last_sampled_lock = threading.Lock()
+_rotate_lock = threading.Lock()
+
+
+class StackSampler:
+    """Samples one thread's Python stack on a timer and aggregates it into collapsed stacks."""
+
+    def __init__(self, thread_id: int, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as fh:
+            for stack, count in self.stacks.most_common():
+                fh.write(f"{stack} {count}\n")
+
+
+def _requested() -> bool:
+    """Whether this request should be profiled: admin header, or a sampling draw within the rate cap."""
+    global _last_sampled
+    token = request.headers.get("X-Profile")
+    if token and PROFILE_ADMIN_TOKEN and hmac.compare_digest(token, PROFILE_ADMIN_TOKEN):
+        return True
+    if PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE:
+        return False
+    with _last_sampled_lock:
+        now = time.monotonic()
+        if now - _last_sampled < PROFILE_MIN_INTERVAL:
+            return False
+        _last_sampled = now
+        return True
+
+
+def _rotate() -> None:
+    """Keeps only the newest PROFILE_MAX_FILES profiles (each is a data file plus a .json sidecar)."""
+    with _rotate_lock:
+        metas = sorted((f for f in os.listdir(PROFILE_DIR) if f.endswith(".json")),
+                       key=lambda f: os.path.getmtime(os.path.join(PROFILE_DIR, f)))
+        for meta in metas[:max(0, len(metas) - PROFILE_MAX_FILES)]:
+            stem = meta[:-len(".json")]
+            for suffix in (".json", ".collapsed", ".pstats"):
+                try:
+                    os.remove(os.path.join(PROFILE_DIR, stem + suffix))
+                except FileNotFoundError:
+                    pass
+
+
+def _save(profile_id: str, tags: Dict[str, Any], elapsed: float, writer: Callable[[str], None], suffix: str) -> None:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    writer(os.path.join(PROFILE_DIR, profile_id + suffix))
+    meta = dict(tags, profile_id=profile_id, endpoint=request.path, mode=PROFILE_MODE,
+                elapsed_ms=round(elapsed * 1000, 2), created_at=time.time())
+    with open(os.path.join(PROFILE_DIR, profile_id + ".json"), "w", encoding="utf-8") as fh:
+        json.dump(meta, fh, default=str)
+    _rotate()
+
+
+def profiled(describe: Callable[[], Dict[str, Any]]):
+    """
+    Profiles the wrapped view when requested (see _requested) and a profiling slot is free.
+    ``describe`` runs after the view and returns the tags stored with the profile
+    (session id, store id, branch, menu size).
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not _requested() or not _slots.acquire(blocking=False):
+                return view(*args, **kwargs)
+            try:
+                profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+                started = time.perf_counter()
+                if PROFILE_MODE == "deterministic":
+                    profiler = cProfile.Profile()
+                    profiler.enable()
+                    try:
+                        response = view(*args, **kwargs)
+                    finally:
+                        profiler.disable()
+                    writer, suffix = profiler.dump_stats, ".pstats"
+                else:
+                    sampler = StackSampler(threading.get_ident())
+                    sampler.start()
+                    try:
+                        response = view(*args, **kwargs)
+                    finally:
+                        sampler.stop()
+                    writer, suffix = sampler.write, ".collapsed"
+                elapsed = time.perf_counter() - started
+                try:
+                    _save(profile_id, describe(), elapsed, writer, suffix)
+                    g.profile_id = profile_id
+                except OSError as e:
+                    print(f"[Profiling] Could not write profile {profile_id}: {e}")
+                return response
+            finally:
+                _slots.release()
+        return wrapper
+    return decorator
@@ -0,0 +1,177 @@
+"""
+In-memory conversation sessions with per-session mutual exclusion.
+
+A turn takes its session's own lock, works on a private copy of the state and
+commits it back with a compare-and-swap on the state's version. Locks exist only
+while a turn holds or waits for them; the maps they live in are split over
+SESSION_LOCK_STRIPES shards, each with its own guard, so sessions never wait on
+each other. A turn that fails half-way leaves the session as it was, and a write
+that raced another one is refused instead of silently overwriting it.
+
+Replies of turns sent with an idempotency key are remembered for
+IDEMPOTENCY_TTL seconds, so a client retrying a turn (a confirmation whose
+response was lost, say) is answered again instead of the turn running twice.
+"""
+import os
+import copy
+import asyncio
+import time
+import hashlib
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from cache import TTLCache
+
+# ─────────────────────────── CONFIG ───────────────────────────
+SESSION_LOCK_STRIPES = int(os.getenv("SESSION_LOCK_STRIPES", "256"))
+# How long a turn waits for another turn of the same session before it is turned away.
+SESSION_LOCK_TIMEOUT = float(os.getenv("SESSION_LOCK_TIMEOUT", "2"))
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "600"))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "16384"))
+
+
+class SessionBusy(Exception):
+    """Another turn of the session held its lock for longer than SESSION_LOCK_TIMEOUT."""
+
+
+class KeyReused(Exception):
+    """An idempotency key sent again with a different request."""
+
+
+def _fingerprint(request: Any) -> str:
+    return hashlib.sha1(repr(request).encode("utf-8")).hexdigest()
+
+
+class SessionStore:
+    def __init__(self, stripes: int = SESSION_LOCK_STRIPES):
+        # session_id -> (version, state)
+        self._entries: Dict[str, Tuple[int, dict]] = {}
+        # session_id -> time.monotonic() of its last write, to spot abandoned sessions
+        self._touched: Dict[str, float] = {}
+        self._entries_lock = threading.Lock()
+        # per shard: (guard, session_id -> [lock, turns holding or waiting for it])
+        self._stripes = [(threading.Lock(), {}) for _ in range(max(1, stripes))]
+        # session_id -> [asyncio.Lock, turns holding or waiting for it]; only touched from the event loop
+        self._async_locks: Dict[str, list] = {}
+        # (session_id, key) -> (request fingerprint, status, body)
+        self._replies = TTLCache(maxsize=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL)
+        self.conflicts = 0
+        self.replays = 0
+
+    # ── locking ──
+    @contextmanager
+    def lock(self, session_id: str, timeout: float = SESSION_LOCK_TIMEOUT) -> Iterator[None]:
+        """Holds the session's lock; raises ``SessionBusy`` after ``timeout`` seconds."""
+        guard, locks = self._stripes[hash(session_id) % len(self._stripes)]
+        with guard:
+            entry = locks.setdefault(session_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            if not entry[0].acquire(timeout=timeout):
+                raise SessionBusy("another turn for this session is in progress")
+            try:
+                yield
+            finally:
+                entry[0].release()
+        finally:
+            with guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del locks[session_id]
+
+    @asynccontextmanager
+    async def async_lock(self, session_id: str, timeout: float = SESSION_LOCK_TIMEOUT) -> AsyncIterator[None]:
+        """``lock`` for turns on an asyncio event loop, which interleave at every await."""
+        entry = self._async_locks.setdefault(session_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            try:
+                await asyncio.wait_for(entry[0].acquire(), timeout)
+            except asyncio.TimeoutError:
+                raise SessionBusy("another turn for this session is in progress") from None
+            try:
+                yield
+            finally:
+                entry[0].release()
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._async_locks[session_id]
+
+    # ── state ──
+    def create(self, session_id: str, state: dict) -> None:
+        with self._entries_lock:
+            self._entries[session_id] = (1, state)
+            self._touched[session_id] = time.monotonic()
+
+    def peek(self, session_id: str) -> Optional[dict]:
+        """The committed state, for reading only."""
+        entry = self._entries.get(session_id)
+        return entry[1] if entry else None
+
+    def checkout(self, session_id: str) -> Optional[Tuple[int, dict]]:
+        """``(version, private copy of the state)``, or None for an unknown session."""
+        entry = self._entries.get(session_id)
+        if entry is None:
+            return None
+        version, state = entry
+        return version, copy.deepcopy(state)
+
+    def commit(self, session_id: str, version: int, state: dict) -> bool:
+        """Stores ``state`` if the session is still at ``version``; False if it changed or ended meanwhile."""
+        with self._entries_lock:
+            current = self._entries.get(session_id)
+            if current is None or current[0] != version:
+                self.conflicts += 1
+                return False
+            self._entries[session_id] = (version + 1, state)
+            self._touched[session_id] = time.monotonic()
+            return True
+
+    def delete(self, session_id: str, version: int) -> bool:
+        """Ends the session if it is still at ``version``."""
+        with self._entries_lock:
+            current = self._entries.get(session_id)
+            if current is None or current[0] != version:
+                self.conflicts += 1
+                return False
+            del self._entries[session_id]
+            self._touched.pop(session_id, None)
+            return True
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def snapshot(self) -> List[Tuple[str, float, dict]]:
+        """``(session_id, seconds since its last write, committed state)`` of every session, for inspection."""
+        now = time.monotonic()
+        with self._entries_lock:
+            return [(session_id, now - self._touched.get(session_id, now), state)
+                    for session_id, (_, state) in self._entries.items()]
+
+    def reply_snapshot(self) -> List[Tuple[Any, Any]]:
+        """The remembered idempotent replies, as ``((session_id, key), (fingerprint, status, body))``."""
+        return self._replies.snapshot()
+
+    # ── idempotent replies ──
+    def replay(self, session_id: str, key: str, request: Any) -> Optional[Tuple[int, bytes]]:
+        """
+        The ``(status, body)`` remembered for this key, or None for a new one. Raises
+        ``KeyReused`` when the key was used for a different request.
+        """
+        remembered = self._replies.get((session_id, key))
+        if remembered is None:
+            return None
+        fingerprint, status, body = remembered
+        if fingerprint != _fingerprint(request):
+            raise KeyReused("Idempotency-Key was already used for a different request")
+        self.replays += 1
+        return status, body
+
+    def remember(self, session_id: str, key: str, request: Any, status: int, body: bytes) -> None:
+        self._replies.put((session_id, key), (_fingerprint(request), status, body))
+
+    def stats(self) -> Dict[str, Any]:
+        return {"sessions": len(self), "conflicts": self.conflicts, "replays": self.replays,
+                "remembered_replies": len(self._replies)}
@@ -0,0 +1,81 @@
+"""
+Coalesces identical concurrent reads.
+
+The first caller for a key runs the read; callers arriving while it is in flight
+wait for it and get the same result, or the same exception, instead of sending the
+same query again. A store going viral then costs one menu query per cache miss
+rather than one per session. Results are shared between threads: read-only.
+"""
+import os
+import threading
+from typing import Any, Callable, Dict, Hashable
+
+# ─────────────────────────── CONFIG ───────────────────────────
+# How long a caller waits for another caller's read before giving up.
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv("SINGLE_FLIGHT_TIMEOUT", "5"))
+
+
+class Timeout(TimeoutError):
+    """The in-flight read being waited for did not finish within the timeout."""
+
+
+class _Call:
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value: Any = None
+        self.error: Any = None
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self.executed = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.timeouts = 0
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, fn: Callable[[], Any], timeout: float = SINGLE_FLIGHT_TIMEOUT) -> Any:
+        """
+        ``fn()``, run once for all concurrent callers with the same ``key``. Waiting
+        callers raise ``Timeout`` after ``timeout`` seconds; the running read is not
+        interrupted and still serves whoever keeps waiting.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        if leader:
+            try:
+                call.value = fn()
+            except BaseException as err:
+                call.error = err
+                with self._lock:
+                    self.errors += 1
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+            return call.value
+
+        if not call.done.wait(timeout):
+            with self._lock:
+                self.timeouts += 1
+            raise Timeout(f"{self.name}: read of {key!r} still running after {timeout}s")
+        if call.error is not None:
+            raise call.error
+        return call.value
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"executed": self.executed, "coalesced": self.coalesced, "errors": self.errors,
+                    "timeouts": self.timeouts, "in_flight": len(self._calls)}
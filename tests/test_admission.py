@@ -0,0 +1,48 @@
+import flask
+import pytest
+
+import admission
+
+
+@pytest.fixture
+def stores(monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_STORE_LIMIT", 1)
+    monkeypatch.setattr(admission, "ADMISSION_STORE_LIMITERS", 2)
+    monkeypatch.setattr(admission, "_stores", {})
+    with flask.Flask(__name__).app_context():
+        yield admission._stores
+
+
+def test_busy_store_keeps_its_limiter_past_the_cap(stores):
+    admission.admit("busy")
+    busy = stores["busy"]
+    for store_id in range(5):
+        admission._store_limiter(store_id)
+
+    assert stores["busy"] is busy
+    assert len(stores) <= 3
+    with pytest.raises(admission.Rejected):
+        busy.acquire()
+    admission.release_all()
+    assert busy.idle()
+
+
+def test_idle_limiters_are_dropped(stores):
+    for store_id in range(5):
+        admission._store_limiter(store_id)
+    assert len(stores) <= 2 and 4 in stores
+
+
+def test_limiter_dropped_before_acquire_is_not_held(stores, monkeypatch):
+    stale = admission.Limiter("store:1", 1, status=429)
+    current = admission.Limiter("store:1", 1, status=429)
+    handed_out = iter([stale, current])
+    stores[1] = current
+    monkeypatch.setattr(admission, "_store_limiter", lambda store_id: next(handed_out))
+
+    admission.admit(1)
+
+    assert stale.idle()
+    assert current.in_flight == 1
+    admission.release_all()
+    assert current.idle()
@@ -0,0 +1,50 @@
+import pytest
+
+import matching
+
+MENU = ["Naan", "Tea", "Masala Tea", "Coke", "Cake", "Chicken Biryani", "Veg Biryani", "Aloo Tikki",
+        "Chicken Tikka", "Paneer Butter Masala", "Dal Makhani", "Gulab Jamun", "Lassi", "Samosa"]
+
+
+@pytest.fixture(scope="module")
+def index():
+    return matching.MenuIndex(None, [{"item_id": i, "item_name": name} for i, name in enumerate(MENU)])
+
+
+def names(matches):
+    return [name for name, _, _ in matches]
+
+
+@pytest.mark.parametrize("utterance", ["none", "to", "wait", "sorry what", "can you repeat that",
+                                       "i am not sure", "thanks", "burn"])
+def test_chatter_matches_nothing(index, utterance):
+    assert index.extract(utterance, score_cutoff=75) == []
+    assert index.extract_batch([utterance], score_cutoff=75) == [[]]
+
+
+@pytest.mark.parametrize("utterance, expected", [
+    ("gulab jamoon", "Gulab Jamun"),
+    ("dal makni", "Dal Makhani"),
+    ("panir butter masala", "Paneer Butter Masala"),
+    ("samosa please", "Samosa"),
+])
+def test_sole_sound_alike_short_circuits(index, utterance, expected):
+    assert index.extract(utterance, score_cutoff=75) == [(expected, 100.0, MENU.index(expected))]
+
+
+@pytest.mark.parametrize("utterance, expected", [("naan", "Naan"), ("nan", "Naan"), ("lasi", "Lassi"),
+                                                 ("tea", "Tea")])
+def test_short_keys_still_match_on_text(index, utterance, expected):
+    assert names(index.extract(utterance, score_cutoff=75))[0] == expected
+
+
+def test_shared_key_is_settled_by_text(index):
+    matches = index.extract("coke", score_cutoff=75)
+    assert names(matches) == ["Coke", "Cake"]
+    assert matches[0][1] - matches[1][1] > 5
+
+
+def test_shortcut_needs_a_close_spelling():
+    index = matching.MenuIndex(None, [{"item_id": 1, "item_name": "Biryani"}])
+    assert index.phonetic_exact("burn") == [0]
+    assert index.extract("burn", score_cutoff=75) == []
@@ -0,0 +1,36 @@
+import pytest
+
+import catalog
+from cache import TTLCache
+
+
+def test_ttl_cache_pop_skips_expired_entries():
+    cache = TTLCache(maxsize=4, ttl=60)
+    cache.put("fresh", 1)
+    cache.put("stale", 2, ttl=0)
+    assert cache.pop("stale", "gone") == "gone"
+    assert "stale" not in cache
+    assert cache.pop("fresh") == 1
+
+
+@pytest.fixture
+def prefetched(monkeypatch):
+    cache = TTLCache(maxsize=16, ttl=60)
+    monkeypatch.setattr(catalog, "_prefetched", cache)
+    monkeypatch.setattr(catalog, "_load_details_pooled", lambda item_id, store_id: {"item_id": item_id})
+    return cache
+
+
+def test_take_prefetched_drops_only_its_session(prefetched):
+    catalog.prefetch_candidates("s1", 1, [10, 11], plan=lambda details: ["q"])
+    catalog.prefetch_candidates("s2", 1, [10], plan=lambda details: ["q"])
+
+    assert catalog.take_prefetched("s1", 11) == ({"item_id": 11}, ["q"])
+    assert catalog.take_prefetched("s1", 10) is None
+    assert catalog.take_prefetched("s2", 10) == ({"item_id": 10}, ["q"])
+
+
+def test_expired_prefetch_is_not_used(prefetched):
+    prefetched.ttl = 0
+    catalog.prefetch_candidates("s1", 1, [10], plan=lambda details: ["q"])
+    assert catalog.take_prefetched("s1", 10) is None
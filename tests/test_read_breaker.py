@@ -0,0 +1,39 @@
+import pytest
+import mysql.connector
+
+import admission
+import catalog
+import db
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    """db.read_breaker replaced by one that is half-open on the next allow()."""
+    breaker = db.CircuitBreaker("test", failures=1, reset_timeout=0)
+    breaker.record(0.0, ok=False)
+    monkeypatch.setattr(db, "read_breaker", breaker)
+    return breaker
+
+
+def test_trial_raising_a_non_database_error_is_released(breaker):
+    def load():
+        raise admission.Rejected("menu_load", "over budget", 503)
+
+    with pytest.raises(admission.Rejected):
+        catalog._guarded(load, "fetch_store_menu")
+
+    assert breaker.allow()
+
+
+def test_trial_database_error_reopens(breaker):
+    def load():
+        raise mysql.connector.Error("gone away")
+
+    assert catalog._guarded(load, "fetch_store_menu") == (None, False)
+    assert breaker.state == "open"
+    assert breaker.times_opened == 2
+
+
+def test_trial_success_closes(breaker):
+    assert catalog._guarded(lambda: "menu", "fetch_store_menu") == ("menu", True)
+    assert breaker.state == "closed"
@@ -0,0 +1,60 @@
+import asyncio
+import threading
+
+import pytest
+
+import asgi_app
+import session_store
+
+
+@pytest.fixture
+def sessions(monkeypatch):
+    store = session_store.SessionStore()
+    monkeypatch.setattr(asgi_app, "session_cache", store)
+    return store
+
+
+def test_concurrent_confirmations_write_the_order_once(sessions, monkeypatch):
+    sessions.create("s1", {"store_id": 1, "status": "awaiting_confirmation", "completed_items": [{"item_id": 7}]})
+    written = []
+
+    async def confirm(turn, session_id, state, user_input):
+        written.extend(state["completed_items"])
+        await asyncio.sleep(0.01)  # the cart insert
+        turn.ended = True
+        return 200, {"status": "order_confirmed"}
+
+    monkeypatch.setattr(asgi_app, "chat_turn", confirm)
+
+    async def both():
+        return await asyncio.gather(*(asgi_app.chat_step(asgi_app.Turn(), {"session_id": "s1", "user_input": "yes"})
+                                      for _ in range(2)))
+
+    statuses = sorted(status for status, _ in asyncio.run(both()))
+    assert statuses == [200, 404]
+    assert len(written) == 1
+
+
+def test_sessions_sharing_a_stripe_do_not_wait_on_each_other():
+    store = session_store.SessionStore(stripes=1)
+    entered = threading.Event()
+    release = threading.Event()
+
+    def slow_turn():
+        with store.lock("a"):
+            entered.set()
+            release.wait(5)
+
+    worker = threading.Thread(target=slow_turn)
+    worker.start()
+    entered.wait(5)
+    try:
+        with store.lock("b", timeout=0.1):
+            pass
+        with pytest.raises(session_store.SessionBusy):
+            with store.lock("a", timeout=0.1):
+                pass
+    finally:
+        release.set()
+        worker.join()
+    assert store._stripes[0][1] == {}
@@ -0,0 +1,95 @@
+import os
+import json
+import time
+import threading
+import functools
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+# ─────────────────────────── CONFIG ───────────────────────────
+# Turns slower than this are written to TURN_TRACE_PATH as one JSON line each; 0 disables tracing.
+TURN_TRACE_BUDGET_MS = float(os.getenv("TURN_TRACE_BUDGET_MS", "500"))
+TURN_TRACE_PATH = os.getenv("TURN_TRACE_PATH", "slow_turns.jsonl")
+
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+class TurnTrace:
+    """Wall time per named stage of one turn. Stages may nest, so their sum can exceed the turn time."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: Dict[str, list] = {}
+
+    def add(self, name: str, elapsed: float) -> None:
+        entry = self.stages.setdefault(name, [0.0, 0])
+        entry[0] += elapsed
+        entry[1] += 1
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def stages_ms(self) -> Dict[str, Dict[str, Any]]:
+        return {name: {"ms": round(total * 1000, 2), "calls": calls} for name, (total, calls) in self.stages.items()}
+
+
+def begin() -> None:
+    """Starts tracing the current thread's turn."""
+    _local.trace = TurnTrace() if TURN_TRACE_BUDGET_MS > 0 else None
+
+
+def end() -> Optional[TurnTrace]:
+    trace = getattr(_local, "trace", None)
+    _local.trace = None
+    return trace
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Adds the block's wall time to the current turn's trace; a no-op outside a traced turn."""
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - started)
+
+
+def timed(name: str):
+    """Decorator form of stage()."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def merge(other: TurnTrace) -> None:
+    """Adds the stages another thread recorded on the current turn's behalf."""
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        return
+    for name, (total, calls) in other.stages.items():
+        entry = trace.stages.setdefault(name, [0.0, 0])
+        entry[0] += total
+        entry[1] += calls
+
+
+def is_slow(trace: TurnTrace) -> bool:
+    return trace.elapsed_ms() > TURN_TRACE_BUDGET_MS
+
+
+def write(record: Dict[str, Any]) -> None:
+    line = json.dumps(record, default=str)
+    with _write_lock:
+        try:
+            with open(TURN_TRACE_PATH, "a", encoding="utf-8") as fh:
+                fh.write(line + "\n")
+        except OSError as e:
+            print(f"[Tracing] Could not write slow-turn trace: {e}")